@@ -0,0 +1,130 @@
+# bench_startup.py — бенчмарк холодного старта
+#
+# Каждый сценарий запускается в отдельном процессе (чистые импорты и кэши):
+#   import          — время `import main` и подтянулся ли googleapiclient
+#   cold            — старт без снимка каталога на диске
+#   snapshot        — старт с last-known-good снимком каталога
+#
+# Для cold/snapshot меряется время от post_init до первой карточки товара
+# (/start -> каталог -> категория -> товар) при медленном Sheets и сколько
+# чтений Sheets пришлось на этот путь.
+#
+#   python bench_startup.py --sheets-latency-ms 400
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def child_import() -> dict:
+    t0 = time.perf_counter()
+    import main  # noqa: F401
+    return {
+        "import_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "googleapiclient_loaded": "googleapiclient.discovery" in sys.modules,
+    }
+
+
+async def child_first_browse(latency: float) -> dict:
+    import loadgen
+    import main
+    from standins import FakeSheetsService, FakeTelegramRequest, demo_spreadsheet
+
+    book = demo_spreadsheet(latency=latency)
+    service = FakeSheetsService(book)
+    main.get_sheets_service = lambda: service
+
+    fake_tg = FakeTelegramRequest()
+    app = main.build_application(request=fake_tg)
+    stats = loadgen.Stats()
+
+    async with app:
+        t0 = time.perf_counter()
+        await app.post_init(app)
+        post_init_ms = (time.perf_counter() - t0) * 1000
+        await app.start()
+
+        buyer = loadgen.VirtualBuyer(app, fake_tg, stats, loadgen.BUYER_ID_BASE, loadgen.random.Random(1), 0)
+        with main.count_api_calls() as calls:
+            categories = sorted({row[4] for row in book.sheets["products"][1:]})
+            products = {c: [r[0] for r in book.sheets["products"][1:] if r[4] == c] for c in categories}
+            await buyer.browse(categories, products)
+        first_card_ms = (time.perf_counter() - t0) * 1000
+
+        # дожидаемся фонового прогрева, чтобы процесс завершился чисто
+        await asyncio.sleep(latency * 3 + 0.05)
+        await app.stop()
+
+    return {
+        "post_init_ms": round(post_init_ms, 1),
+        "first_product_card_ms": round(first_card_ms, 1),
+        "sheets_reads_on_path": calls.sheets_reads,
+        "catalog_source": main.current_tenant().catalog.source,
+    }
+
+
+def run_child(mode: str, args, env: dict) -> dict:
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", mode, "--sheets-latency-ms", str(args.sheets_latency_ms)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main_bench(args):
+    env = dict(os.environ)
+    # значения-заглушки как в loadgen.py
+    env.setdefault("BOT_TOKEN", "123456:BENCH")
+    env.setdefault("ADMIN_CHAT_ID", "1")
+    env.setdefault("OWNER_CHAT_ID", "1")
+    env.setdefault("STAFF_CHAT_IDS", "900001")
+    env.setdefault("GOOGLE_CREDENTIALS_JSON", "{}")
+    env.setdefault("SPREADSHEET_ID", "bench")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env["CATALOG_SNAPSHOT_PATH"] = os.path.join(tmp, "catalog.json")
+        env["REPLICA_PATH"] = os.path.join(tmp, "replica.sqlite3")
+        env["SESSION_DIR"] = os.path.join(tmp, "sessions")
+
+        results = {"import": run_child("import", args, env)}
+        results["cold"] = run_child("browse", args, env)       # снимка еще нет, создается
+        results["snapshot"] = run_child("browse", args, env)   # снимок с прошлого запуска
+
+    print(f"import main: {results['import']['import_ms']} ms "
+          f"(googleapiclient loaded: {results['import']['googleapiclient_loaded']})")
+    print(f"\n{'scenario':<10}{'post_init ms':>14}{'first card ms':>15}{'sheets reads':>14}  catalog")
+    for name in ("cold", "snapshot"):
+        r = results[name]
+        print(
+            f"{name:<10}{r['post_init_ms']:>14}{r['first_product_card_ms']:>15}"
+            f"{r['sheets_reads_on_path']:>14}  {r['catalog_source']}"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Cold start benchmark for FlowerShopKR")
+    p.add_argument("--sheets-latency-ms", type=float, default=400.0)
+    p.add_argument("--child", choices=("import", "browse"))
+    p.add_argument("--json", dest="json_path")
+    args = p.parse_args()
+
+    if args.child == "import":
+        print(json.dumps(child_import()))
+    elif args.child == "browse":
+        import logging
+        logging.disable(logging.WARNING)
+        print(json.dumps(asyncio.run(child_first_browse(args.sheets_latency_ms / 1000))))
+    else:
+        main_bench(args)
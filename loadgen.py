@@ -0,0 +1,408 @@
+# loadgen.py — нагрузочный генератор "виртуальных покупателей"
+#
+# Прогоняет реалистичные сессии покупателей через тот же Application,
+# что собирает main.build_application(), но против локальных заменителей
+# Google Sheets и Telegram Bot API (standins.py):
+#
+#   /start -> каталог -> категория -> товар -> cart:inc -> корзина ->
+#   checkout:start -> имя -> телефон -> способ -> (адрес) -> комментарий ->
+#   фото оплаты -> checkout:final_send
+#
+# Пример (Valentine's Day):
+#   python loadgen.py --buyers 500 --checkouts 50 --duration 60 --profile ramp \
+#       --sheets-latency-ms 120 --bot-latency-ms 40
+#
+# Отчет: латентность по шагам (p50/p95/max), доля ошибок, потерянные заказы,
+# среднее число вызовов Sheets / Bot API на шаг. В конце — проверка BUDGETS
+# (main.api_budget) на прогретом боте: превышение дает код выхода 1.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+# main.py требует ENV при импорте — для локального прогона подставляем заглушки
+os.environ.setdefault("BOT_TOKEN", "123456:LOADGEN")
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+os.environ.setdefault("OWNER_CHAT_ID", "1")
+os.environ.setdefault("STAFF_CHAT_IDS", "900001,900002")
+os.environ.setdefault("GOOGLE_CREDENTIALS_JSON", "{}")
+os.environ.setdefault("SPREADSHEET_ID", "loadgen")
+os.environ.setdefault(
+    "CATALOG_SNAPSHOT_PATH",
+    os.path.join(tempfile.gettempdir(), "flowershop_loadgen_catalog.json"),
+)
+os.environ.setdefault(
+    "REPLICA_PATH",
+    os.path.join(tempfile.gettempdir(), "flowershop_loadgen_replica.sqlite3"),
+)
+os.environ.setdefault(
+    "SESSION_DIR",
+    os.path.join(tempfile.gettempdir(), "flowershop_loadgen_sessions"),
+)
+
+from telegram import Update  # noqa: E402
+
+import main  # noqa: E402
+from standins import FakeSheetsService, FakeTelegramRequest, demo_spreadsheet  # noqa: E402
+
+BUYER_ID_BASE = 2_000_000
+
+# бюджеты вызовов API на шаг (main.api_budget): проверяются после прогона
+# на "теплом" боте, превышение — ненулевой код выхода
+BUDGETS = {
+    # повторный показ карточки — из каталога в памяти, без Sheets
+    "browse:product": {"sheets_reads": 0, "sheets_writes": 0},
+    # заказ: append строки + batchUpdate I/J, не больше одного чтения
+    "checkout:final_send": {"sheets_reads": 1, "sheets_writes": 2},
+}
+
+
+# -------------------------
+# профили нарастания нагрузки
+# -------------------------
+def start_offsets(profile: str, n: int, duration: float, rnd: random.Random) -> List[float]:
+    if n <= 0:
+        return []
+    if profile == "spike":
+        return [rnd.uniform(0, min(1.0, duration)) for _ in range(n)]
+    if profile == "ramp":
+        # интенсивность растет линейно: t_i = D * sqrt(i / n)
+        return [duration * ((i + 1) / n) ** 0.5 for i in range(n)]
+    # steady
+    return [duration * i / n for i in range(n)]
+
+
+# -------------------------
+# статистика
+# -------------------------
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.calls: Dict[str, main.ApiCalls] = {}
+        self.failed_updates: set = set()
+
+    def record(self, step: str, seconds: float, ok: bool, calls: main.ApiCalls):
+        self.latency.setdefault(step, []).append(seconds)
+        self.calls.setdefault(step, main.ApiCalls()).add(calls)
+        if not ok:
+            self.errors[step] = self.errors.get(step, 0) + 1
+
+    def report(self) -> dict:
+        steps = {}
+        for step, values in self.latency.items():
+            values = sorted(values)
+            calls = self.calls[step]
+            steps[step] = {
+                "count": len(values),
+                "errors": self.errors.get(step, 0),
+                "p50_ms": round(_pct(values, 0.50) * 1000, 1),
+                "p95_ms": round(_pct(values, 0.95) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+                "mean_ms": round(statistics.fmean(values) * 1000, 1),
+                "sheets_reads": round(calls.sheets_reads / len(values), 2),
+                "sheets_writes": round(calls.sheets_writes / len(values), 2),
+                "bot_calls": round(calls.bot_calls / len(values), 2),
+            }
+        return steps
+
+
+def _pct(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+# -------------------------
+# виртуальный покупатель
+# -------------------------
+class VirtualBuyer:
+    def __init__(self, app, fake_tg: FakeTelegramRequest, stats: Stats, user_id: int,
+                 rnd: random.Random, think: float):
+        self.app = app
+        self.tg = fake_tg
+        self.stats = stats
+        self.user_id = user_id
+        self.rnd = rnd
+        self.think = think
+        self.user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"Buyer{user_id}",
+            "username": f"buyer{user_id}",
+        }
+
+    # --- конструкторы апдейтов ---
+    def _next_update_id(self) -> int:
+        self.app.bot_data["_loadgen_update_id"] = self.app.bot_data.get("_loadgen_update_id", 0) + 1
+        return self.app.bot_data["_loadgen_update_id"]
+
+    def _message(self, **extra) -> dict:
+        msg = {
+            "message_id": self.rnd.randint(1, 10 ** 9),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.user,
+        }
+        msg.update(extra)
+        return msg
+
+    def _bot_message(self) -> Optional[dict]:
+        return self.tg.last_message.get(self.user_id)
+
+    def command(self, cmd: str) -> dict:
+        return {
+            "update_id": self._next_update_id(),
+            "message": self._message(
+                text=cmd,
+                entities=[{"type": "bot_command", "offset": 0, "length": len(cmd.split()[0])}],
+            ),
+        }
+
+    def callback(self, data: str) -> dict:
+        bot_msg = self._bot_message() or self._message(text="")
+        return {
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self.rnd.randint(1, 10 ** 12)),
+                "from": self.user,
+                "chat_instance": str(self.user_id),
+                "data": data,
+                "message": bot_msg,
+            },
+        }
+
+    def reply_text(self, text: str) -> dict:
+        return {
+            "update_id": self._next_update_id(),
+            "message": self._message(text=text, reply_to_message=self._bot_message()),
+        }
+
+    def reply_photo(self) -> dict:
+        file_id = f"payment-{self.user_id}"
+        return {
+            "update_id": self._next_update_id(),
+            "message": self._message(
+                photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 1200}],
+                reply_to_message=self._bot_message(),
+            ),
+        }
+
+    # --- шаг сценария ---
+    async def step(self, name: str, payload: dict):
+        t0 = time.perf_counter()
+        ok = True
+        with main.count_api_calls() as calls:
+            try:
+                update = Update.de_json(payload, self.app.bot)
+                await self.app.update_processor.process_update(update, self.app.process_update(update))
+                ok = payload["update_id"] not in self.stats.failed_updates
+            except Exception:
+                ok = False
+        self.stats.record(name, time.perf_counter() - t0, ok, calls)
+
+        # даже без "раздумий" отдаем управление циклу — фоновые задачи бота
+        # (регистрация пользователя и т.п.) идут между шагами, как в реальности
+        await asyncio.sleep(self.rnd.uniform(0.5, 1.5) * self.think if self.think else 0)
+        return ok
+
+    async def browse(self, categories: List[str], products_by_cat: Dict[str, List[str]]) -> str:
+        await self.step("start", self.command("/start"))
+        await self.step("browse:categories", self.callback("home:catalog"))
+
+        cat = self.rnd.choice(categories)
+        await self.step("browse:category", self.callback(f"cat:{cat}"))
+
+        pid = self.rnd.choice(products_by_cat[cat])
+        await self.step("browse:product", self.callback(f"prod:{pid}"))
+        return pid
+
+    async def fill_checkout(self, pid: str):
+        for _ in range(self.rnd.randint(1, 3)):
+            await self.step("cart:inc", self.callback(f"cart:inc:{pid}"))
+        await self.step("cart:view", self.callback("nav:cart"))
+
+        await self.step("checkout:start", self.callback("checkout:start"))
+        await self.step("checkout:name", self.reply_text(f"Покупатель {self.user_id}"))
+        await self.step("checkout:phone", self.reply_text(f"010-{self.user_id % 10000:04d}-0000"))
+
+        kind = self.rnd.choice(("pickup", "delivery"))
+        await self.step("checkout:type", self.callback(f"checkout:type:{kind}"))
+        if kind == "delivery":
+            await self.step("checkout:address", self.reply_text("서울시 강남구 테헤란로 1"))
+
+        await self.step("checkout:comment", self.reply_text("-"))
+        await self.step("checkout:attach", self.callback("checkout:attach"))
+        await self.step("checkout:photo", self.reply_photo())
+
+    async def checkout(self, pid: str) -> bool:
+        await self.fill_checkout(pid)
+        return await self.step("checkout:final_send", self.callback("checkout:final_send"))
+
+    async def within_budget(self, name: str, payload: dict, failures: List[str]) -> bool:
+        try:
+            with main.api_budget(**BUDGETS[name]):
+                return await self.step(name, payload)
+        except main.ApiBudgetExceeded as e:
+            failures.append(f"{name}: {e}")
+            return False
+
+
+# -------------------------
+# прогон
+# -------------------------
+async def check_budgets(app, fake_tg, categories, products_by_cat) -> List[str]:
+    """Один покупатель на прогретом боте: карточка и заказ укладываются в BUDGETS."""
+    failures: List[str] = []
+    buyer = VirtualBuyer(app, fake_tg, Stats(), BUYER_ID_BASE - 1, random.Random(0), 0)
+
+    pid = await buyer.browse(categories, products_by_cat)
+    await buyer.within_budget("browse:product", buyer.callback(f"prod:{pid}"), failures)
+
+    await buyer.fill_checkout(pid)
+    await buyer.within_budget("checkout:final_send", buyer.callback("checkout:final_send"), failures)
+    return failures
+
+
+async def run(args) -> dict:
+    rnd = random.Random(args.seed)
+
+    book = demo_spreadsheet(
+        products=args.products,
+        categories=args.categories,
+        latency=args.sheets_latency_ms / 1000,
+    )
+    service = FakeSheetsService(book)
+    main.get_sheets_service = lambda: service
+
+    fake_tg = FakeTelegramRequest(latency=args.bot_latency_ms / 1000)
+    app = main.build_application(request=fake_tg)
+
+    stats = Stats()
+
+    async def on_error(update, context):
+        if isinstance(update, Update):
+            stats.failed_updates.add(update.update_id)
+
+    app.add_error_handler(on_error)
+
+    products_by_cat: Dict[str, List[str]] = {}
+    for row in book.sheets["products"][1:]:
+        products_by_cat.setdefault(row[4], []).append(row[0])
+    categories = sorted(products_by_cat)
+
+    checkout_ids = set(rnd.sample(range(args.buyers), min(args.checkouts, args.buyers)))
+    offsets = start_offsets(args.profile, args.buyers, args.duration, rnd)
+    submitted: List[int] = []
+
+    async def session(i: int, delay: float):
+        await asyncio.sleep(delay)
+        buyer = VirtualBuyer(app, fake_tg, stats, BUYER_ID_BASE + i, random.Random(rnd.random()), args.think_ms / 1000)
+        pid = await buyer.browse(categories, products_by_cat)
+        if i in checkout_ids and await buyer.checkout(pid):
+            submitted.append(buyer.user_id)
+
+    t0 = time.perf_counter()
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        await asyncio.gather(*(session(i, d) for i, d in enumerate(offsets)))
+        budget_failures = await check_budgets(app, fake_tg, categories, products_by_cat)
+        await app.stop()
+    wall = time.perf_counter() - t0
+
+    # --- потерянные заказы: отправлено покупателем, но нет строки pending в orders ---
+    pending_by_user: Dict[str, int] = {}
+    for row in book.sheets["orders"][1:]:
+        if len(row) > 9 and row[9] == "pending":
+            pending_by_user[str(row[2])] = pending_by_user.get(str(row[2]), 0) + 1
+
+    lost = [uid for uid in submitted if not pending_by_user.get(str(uid))]
+    duplicates = sum(n - 1 for n in pending_by_user.values() if n > 1)
+
+    steps = stats.report()
+    total = sum(s["count"] for s in steps.values())
+    errors = sum(s["errors"] for s in steps.values())
+
+    return {
+        "profile": args.profile,
+        "buyers": args.buyers,
+        "checkouts_planned": len(checkout_ids),
+        "checkouts_submitted": len(submitted),
+        "orders_lost": len(lost) + (len(checkout_ids) - len(submitted)),
+        "orders_duplicated": duplicates,
+        "updates": total,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "wall_seconds": round(wall, 2),
+        "sheets_calls": dict(book.calls),
+        "bot_api_calls": dict(fake_tg.calls),
+        "steps": steps,
+        "budget_failures": budget_failures,
+    }
+
+
+def print_report(report: dict):
+    print(
+        f"\nprofile={report['profile']} buyers={report['buyers']} "
+        f"checkouts={report['checkouts_submitted']}/{report['checkouts_planned']} "
+        f"wall={report['wall_seconds']}s"
+    )
+    print(
+        f"updates={report['updates']} error_rate={report['error_rate']:.2%} "
+        f"orders_lost={report['orders_lost']} orders_duplicated={report['orders_duplicated']}"
+    )
+    print(f"sheets={report['sheets_calls']}")
+    print(f"bot_api={report['bot_api_calls']}")
+    for failure in report["budget_failures"]:
+        print(f"BUDGET EXCEEDED {failure}")
+    print()
+
+    print(
+        f"{'step':<22}{'count':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+        f"{'sheets r':>10}{'sheets w':>10}{'bot':>7}"
+    )
+    for step, s in report["steps"].items():
+        print(
+            f"{step:<22}{s['count']:>7}{s['errors']:>6}"
+            f"{s['p50_ms']:>10}{s['p95_ms']:>10}{s['max_ms']:>10}"
+            f"{s['sheets_reads']:>10}{s['sheets_writes']:>10}{s['bot_calls']:>7}"
+        )
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Virtual-buyer load generator for FlowerShopKR")
+    p.add_argument("--buyers", type=int, default=500, help="сколько покупателей просматривают каталог")
+    p.add_argument("--checkouts", type=int, default=50, help="сколько из них оформляют заказ")
+    p.add_argument("--duration", type=float, default=60.0, help="окно прихода покупателей, сек")
+    p.add_argument("--profile", choices=("steady", "ramp", "spike"), default="ramp")
+    p.add_argument("--think-ms", type=float, default=0.0, help="пауза покупателя между шагами")
+    p.add_argument("--sheets-latency-ms", type=float, default=0.0)
+    p.add_argument("--bot-latency-ms", type=float, default=0.0)
+    p.add_argument("--products", type=int, default=40)
+    p.add_argument("--categories", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", dest="json_path", help="сохранить отчет в JSON")
+    p.add_argument("--log-level", default="WARNING", help="уровень логов бота во время прогона")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report["budget_failures"]:
+        sys.exit(1)
@@ -8,6 +8,8 @@
 # ENV:
 #   BOT_TOKEN=...
 #   ADMIN_CHAT_ID=123456789
+#   или TENANTS_JSON=[...] — несколько магазинов в одном процессе (см. config)
+#   WORKERS=4 — апдейты по chat_id на несколько процессов (см. sharding)
 #
 # Файлы рядом:
 #   main.py
@@ -19,46 +21,109 @@
 
 
 import os
+import re
+import io
+import csv
+import signal
+import fcntl
+import sys
+import time
+import asyncio
+import html
+import hashlib
+import pickle
+import sqlite3
+import heapq
+import math
+import unicodedata
 import logging
-from typing import Dict, List, Optional
-from contextlib import ExitStack
+import threading
+import multiprocessing
+from bisect import bisect_left, bisect_right, insort
+from typing import Callable, Dict, List, NamedTuple, Optional
+from collections import OrderedDict
+from queue import Empty
+from functools import lru_cache
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
 import json
-from datetime import datetime, timedelta
-
-from google.oauth2.service_account import Credentials
+from datetime import datetime, timedelta, time as dtime, timezone
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto,
     InputMediaPhoto,
+    InputTextMessageContent,
 )
 
 from telegram import ForceReply
 
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
-    ConversationHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from catalog import SHOP_NAME, SHOP_NOTE, SHOP_PHONE
+
+# google-api-python-client / google-auth импортируются лениво (см. get_sheets_service):
+# discovery тянет ~200 мс импортов, которые не нужны до первого обращения к Sheets
 
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
-SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 
-if not GOOGLE_CREDENTIALS_JSON or not SPREADSHEET_ID:
+if not GOOGLE_CREDENTIALS_JSON:
     raise RuntimeError("Google Sheets ENV vars missing")
 
 GOOGLE_CREDS_INFO = json.loads(GOOGLE_CREDENTIALS_JSON)
 
+# последний удачный каталог на диске: бот показывает его сразу после старта,
+# пока свежая копия грузится из Sheets (у каждого магазина свой файл, см. tenants)
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.json")
+CATALOG_TTL_SECONDS = int(os.getenv("CATALOG_TTL_SECONDS", "30"))
+# фоновая синхронизация каталога (JobQueue): как быстро видны ручные правки в таблице
+CATALOG_SYNC_SECONDS = int(os.getenv("CATALOG_SYNC_SECONDS", "15"))
+# inline_query — поиск "@bot роза" (inline mode включается в BotFather: /setinline)
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+# WORKERS > 1: апдейты раскладываются по процессам по chat_id (см. sharding)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# воркеры-последователи подхватывают снимок каталога, записанный лидером
+CATALOG_FOLLOW_SECONDS = float(os.getenv("CATALOG_FOLLOW_SECONDS", "2"))
+# правки товаров сотрудниками копятся столько секунд и пишутся одним batchUpdate
+PRODUCT_WRITE_DELAY_SECONDS = float(os.getenv("PRODUCT_WRITE_DELAY_SECONDS", "1.5"))
+# закрытые заказы старше N дней уезжают в помесячные архивные листы;
+# N больше окна /dash (месяц), чтобы дашборд их не терял
+ORDERS_ARCHIVE_DAYS = int(os.getenv("ORDERS_ARCHIVE_DAYS", "45"))
+ORDERS_ARCHIVE_HOUR_UTC = int(os.getenv("ORDERS_ARCHIVE_HOUR_UTC", "19"))  # 04:00 KST
+# брошенное оформление заказа сбрасывается через столько секунд без ответа;
+# ожидание фото оплаты дольше — перевод занимает время
+CHECKOUT_TIMEOUT_SECONDS = int(os.getenv("CHECKOUT_TIMEOUT_SECONDS", "900"))
+CHECKOUT_PAYMENT_TIMEOUT_SECONDS = int(os.getenv("CHECKOUT_PAYMENT_TIMEOUT_SECONDS", "3600"))
+CHECKOUT_SWEEP_SECONDS = 60
+# user_data неактивных пользователей уходит на диск (см. sessions)
+SESSION_DIR = os.getenv("SESSION_DIR", "sessions")
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", str(3 * 3600)))
+SESSION_MAX_RESIDENT = int(os.getenv("SESSION_MAX_RESIDENT", "5000"))
+# локальная копия products / orders / users (SQLite, общая для воркеров магазина):
+# чтения идут в нее, Sheets — зеркало записей; "" — читать прямо из Sheets
+REPLICA_PATH = os.getenv("REPLICA_PATH", "replica.sqlite3")
+# лидер подтверждает копию на каждой синхронизации каталога;
+# копия старше этого (лидер не сверял) не используется — чтения идут в Sheets
+REPLICA_MAX_AGE_SECONDS = int(os.getenv("REPLICA_MAX_AGE_SECONDS", "120"))
+# между полными сверками orders / users лидер дочитывает только новые строки
+REPLICA_RECONCILE_SECONDS = int(os.getenv("REPLICA_RECONCILE_SECONDS", "900"))
+
 # -------------------------
 # logging
 # -------------------------
@@ -72,106 +137,848 @@ log = logging.getLogger("FlowerShopKR")
 # -------------------------
 # config
 # -------------------------
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# Один процесс может вести несколько магазинов: у каждого свой бот, своя
+# таблица и свои сотрудники. TENANTS_JSON — JSON-список магазинов
+# (или путь к .json файлу с таким списком):
+#   [{"name": "gangnam", "bot_token": "...", "spreadsheet_id": "...",
+#     "owner_chat_id": 1, "admin_chat_id": 1, "staff_chat_ids": [2, 3],
+#     "shop_name": "...", "shop_phone": "...", "shop_note": "...", "title": "..."}]
+# Без TENANTS_JSON — один магазин из BOT_TOKEN / SPREADSHEET_ID / OWNER_CHAT_ID / ...
+
+TENANT_REQUIRED_KEYS = ("name", "bot_token", "spreadsheet_id", "owner_chat_id", "admin_chat_id")
+
+
+def _single_tenant_config() -> dict:
+    BOT_TOKEN = os.getenv("BOT_TOKEN")
+    ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+    SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+
+    OWNER_CHAT_ID = os.getenv("OWNER_CHAT_ID")
+    if not OWNER_CHAT_ID:
+        raise RuntimeError("OWNER_CHAT_ID is not set")
+
+    if not SPREADSHEET_ID:
+        raise RuntimeError("Google Sheets ENV vars missing")
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is not set")
+    if not ADMIN_CHAT_ID:
+        raise RuntimeError("ADMIN_CHAT_ID is not set")
+
+    return {
+        "name": "default",
+        "bot_token": BOT_TOKEN,
+        "spreadsheet_id": SPREADSHEET_ID,
+        "owner_chat_id": int(OWNER_CHAT_ID),
+        "admin_chat_id": int(ADMIN_CHAT_ID),
+        "staff_chat_ids": [
+            int(x) for x in os.getenv("STAFF_CHAT_IDS", "").split(",")
+            if x.strip().isdigit()
+        ],
+    }
 
-OWNER_CHAT_ID = os.getenv("OWNER_CHAT_ID")
-if not OWNER_CHAT_ID:
-    raise RuntimeError("OWNER_CHAT_ID is not set")
 
-OWNER_CHAT_ID_INT = int(OWNER_CHAT_ID)
+def load_tenant_configs() -> list[dict]:
+    raw = os.getenv("TENANTS_JSON", "").strip()
+    if not raw:
+        return [_single_tenant_config()]
 
+    if not raw.startswith("["):
+        with open(raw, "r", encoding="utf-8") as f:
+            raw = f.read()
 
-STAFF_CHAT_IDS = {
-    int(x) for x in os.getenv("STAFF_CHAT_IDS", "").split(",")
-    if x.strip().isdigit()
-}
+    configs = json.loads(raw)
+    if not isinstance(configs, list) or not configs:
+        raise RuntimeError("TENANTS_JSON must be a non-empty list")
+
+    names = set()
+    for cfg in configs:
+        for key in TENANT_REQUIRED_KEYS:
+            if not cfg.get(key):
+                raise RuntimeError(f"tenant {cfg.get('name', '?')}: {key} is not set")
+        if cfg["name"] in names:
+            raise RuntimeError(f"tenant {cfg['name']}: duplicate name")
+        names.add(cfg["name"])
 
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN is not set")
-if not ADMIN_CHAT_ID:
-    raise RuntimeError("ADMIN_CHAT_ID is not set")
+    return configs
 
-ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID)
+
+TENANT_CONFIGS = load_tenant_configs()
 
 
 # -------------------------
-# helpers: storage
+# api call accounting
 # -------------------------
+# Каждый обработанный апдейт получает свой счетчик вызовов Sheets / Bot API.
+# Счетчик живет в ContextVar, поэтому всё, что вызвано из хендлера
+# (notify_staff, save_order_to_sheets, ...), попадает в счет этого апдейта.
+
+class ApiCalls:
+    __slots__ = ("sheets_reads", "sheets_writes", "bot_calls", "bot_methods")
+
+    def __init__(self):
+        self.sheets_reads = 0
+        self.sheets_writes = 0
+        self.bot_calls = 0
+        self.bot_methods: Dict[str, int] = {}
+
+    def add(self, other: "ApiCalls"):
+        self.sheets_reads += other.sheets_reads
+        self.sheets_writes += other.sheets_writes
+        self.bot_calls += other.bot_calls
+        for method, n in other.bot_methods.items():
+            self.bot_methods[method] = self.bot_methods.get(method, 0) + n
+
+    def __repr__(self) -> str:
+        return (
+            f"ApiCalls(sheets_reads={self.sheets_reads}, "
+            f"sheets_writes={self.sheets_writes}, bot_calls={self.bot_calls})"
+        )
 
-def save_user_contacts(user_id: int, real_name: str, phone_number: str):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="users!A2:F",
-    ).execute()
+class ApiBudgetExceeded(AssertionError):
+    pass
 
-    rows = result.get("values", [])
-    target_row = None
 
-    for idx, row in enumerate(rows, start=2):
-        if row and row[0] == str(user_id):
-            target_row = idx
-            break
+_api_calls: ContextVar[Optional[ApiCalls]] = ContextVar("api_calls", default=None)
 
-    if not target_row:
-        return False
 
-    sheet.values().batchUpdate(
-        spreadsheetId=SPREADSHEET_ID,
-        body={
-            "valueInputOption": "RAW",
-            "data": [
-                {"range": f"users!E{target_row}", "values": [[real_name]]},
-                {"range": f"users!F{target_row}", "values": [[phone_number]]},
-            ],
-        },
+def _count_sheets_call(kind: str):
+    calls = _api_calls.get()
+    if calls is not None:
+        setattr(calls, kind, getattr(calls, kind) + 1)
+
+
+@contextmanager
+def count_api_calls():
+    """
+    Считает вызовы Sheets / Bot API внутри блока.
+    Вложенные счетчики по выходу добавляются к внешнему.
+    """
+    parent = _api_calls.get()
+    calls = ApiCalls()
+    token = _api_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _api_calls.reset(token)
+        if parent is not None:
+            parent.add(calls)
+
+
+@contextmanager
+def api_budget(
+    sheets_reads: int | None = None,
+    sheets_writes: int | None = None,
+    bot_calls: int | None = None,
+):
+    """
+    Для тестов / бенчмарков:
+        with api_budget(sheets_reads=0):
+            await render_product_card(context, chat_id, pid)
+    """
+    with count_api_calls() as calls:
+        yield calls
+
+    limits = {
+        "sheets_reads": sheets_reads,
+        "sheets_writes": sheets_writes,
+        "bot_calls": bot_calls,
+    }
+    for name, limit in limits.items():
+        if limit is not None and getattr(calls, name) > limit:
+            raise ApiBudgetExceeded(f"{name}={getattr(calls, name)} > budget {limit}")
+
+
+def update_label(update: object) -> str:
+    if not isinstance(update, Update):
+        return type(update).__name__
+
+    if update.callback_query:
+        parts = (update.callback_query.data or "").split(":")
+        if len(parts) > 2:
+            return ":".join(parts[:2])
+        if parts[0] in ("cat", "prod"):
+            return parts[0]
+        return ":".join(parts)
+
+    if update.inline_query:
+        return "inline"
+
+    msg = update.message
+    if msg:
+        if msg.text and msg.text.startswith("/"):
+            return msg.text.split()[0].split("@")[0]
+        if msg.photo:
+            return "photo"
+        if msg.reply_to_message:
+            return "reply"
+        return "text"
+
+    return "other"
+
+
+def record_api_calls(label: str, calls: ApiCalls):
+    # label обработчика -> [updates, sheets_reads, sheets_writes, bot_calls]
+    stats = current_tenant().api_stats.setdefault(label, [0, 0, 0, 0])
+    stats[0] += 1
+    stats[1] += calls.sheets_reads
+    stats[2] += calls.sheets_writes
+    stats[3] += calls.bot_calls
+
+    log.info(
+        f"📈 API {label}: sheets r={calls.sheets_reads} w={calls.sheets_writes}, "
+        f"bot={calls.bot_calls} {calls.bot_methods}"
+    )
+
+
+class AccountingUpdateProcessor(BaseUpdateProcessor):
+    """Оборачивает обработку каждого апдейта в count_api_calls()."""
+
+    def __init__(self, max_concurrent_updates: int, tenant: "Tenant"):
+        super().__init__(max_concurrent_updates)
+        self.tenant = tenant
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # все хендлеры апдейта видят свой магазин через current_tenant()
+        with use_tenant(self.tenant):
+            user = getattr(update, "effective_user", None)
+            if user is not None:
+                touch_session(self.tenant, user.id)
+            with count_api_calls() as calls:
+                await coroutine
+            record_api_calls(update_label(update), calls)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class CountingRequest(BaseRequest):
+    """
+    Прослойка над HTTPXRequest: считает вызовы Bot API.
+    Один inner может быть общим для ботов нескольких магазинов —
+    пул соединений закрывается, когда его отпустил последний бот.
+    """
+
+    _users: Dict[int, int] = {}
+
+    def __init__(self, inner: BaseRequest):
+        self._inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self._inner.read_timeout
+
+    async def initialize(self) -> None:
+        key = id(self._inner)
+        if not self._users.get(key):
+            await self._inner.initialize()
+        self._users[key] = self._users.get(key, 0) + 1
+
+    async def shutdown(self) -> None:
+        key = id(self._inner)
+        left = self._users.get(key, 1) - 1
+        self._users[key] = left
+        if left <= 0:
+            self._users.pop(key, None)
+            await self._inner.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        *args,
+        **kwargs,
+    ):
+        calls = _api_calls.get()
+        if calls is not None:
+            api_method = url.rsplit("/", 1)[-1]
+            calls.bot_calls += 1
+            calls.bot_methods[api_method] = calls.bot_methods.get(api_method, 0) + 1
+
+        return await self._inner.do_request(url, method, request_data, *args, **kwargs)
+
+
+# -------------------------
+# helpers: sheets api
+# -------------------------
+# Все обращения к Google Sheets идут через эти функции.
+#
+# Чтения совмещаются (single-flight): если тот же диапазон того же магазина
+# уже читается в другом потоке, вызов ждет этот запрос и получает его
+# результат, а не идет в Sheets сам. Так всплеск покупателей на холодном
+# каталоге (или экраны сотрудников поверх фоновой синхронизации) стоит
+# одного чтения. Кэша здесь нет — после ответа ключ сразу освобождается.
+# В ключе поколение записей: чтение, начатое после записи, не подхватит
+# ответ, запрошенный до нее.
+
+class ReadFlight:
+    __slots__ = ("done", "rows", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.rows: list[list[str]] = []
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+def _sheets_fetch(t: "Tenant", range_: str, unformatted: bool) -> list[list[str]]:
+    _count_sheets_call("sheets_reads")
+    # unformatted: числа приходят числами — для перезаписи строк как есть
+    params = {"valueRenderOption": "UNFORMATTED_VALUE"} if unformatted else {}
+    result = get_sheets_service().spreadsheets().values().get(
+        spreadsheetId=t.spreadsheet_id,
+        range=range_,
+        **params,
+    ).execute()
+    return result.get("values", [])
+
+def _sheets_batch_fetch(t: "Tenant", ranges: list[str], unformatted: bool) -> list[list[list[str]]]:
+    _count_sheets_call("sheets_reads")
+    params = {"valueRenderOption": "UNFORMATTED_VALUE"} if unformatted else {}
+    result = get_sheets_service().spreadsheets().values().batchGet(
+        spreadsheetId=t.spreadsheet_id,
+        ranges=ranges,
+        **params,
     ).execute()
+    return [vr.get("values", []) for vr in result.get("valueRanges", [])]
+
+def _copy_rows(rows: list[list]) -> list[list]:
+    return [list(r) for r in rows]
+
+def _single_flight(t: "Tenant", key: tuple, fetch: Callable, copy: Callable):
+    with t.read_flights_lock:
+        flight = t.read_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = t.read_flights[key] = ReadFlight()
+        else:
+            flight.waiters += 1
+            t.reads_shared += 1
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        # у каждого вызывающего свой список: строки правят на месте
+        return copy(flight.rows)
+
+    try:
+        flight.rows = fetch()
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with t.read_flights_lock:
+            t.read_flights.pop(key, None)
+        flight.done.set()
+    return copy(flight.rows) if flight.waiters else flight.rows
+
+def sheets_read(range_: str, unformatted: bool = False) -> list[list[str]]:
+    if not unformatted:
+        rows = replica_read(range_)
+        if rows is not None:
+            return rows
+    t = current_tenant()
+    return _single_flight(
+        t,
+        (range_, unformatted, t.sheets_write_gen),
+        lambda: _sheets_fetch(t, range_, unformatted),
+        _copy_rows,
+    )
+
+def sheets_batch_read(ranges: list[str], unformatted: bool = False) -> list[list[list[str]]]:
+    """Несколько диапазонов одним values.batchGet; ответы в порядке ranges."""
+    t = current_tenant()
+    return _single_flight(
+        t,
+        ("batch", tuple(ranges), unformatted, t.sheets_write_gen),
+        lambda: _sheets_batch_fetch(t, ranges, unformatted),
+        lambda results: [_copy_rows(rows) for rows in results],
+    )
+
+
+class ReadPlan:
+    """
+    Диапазоны, нужные сценарию, читаются одним batchGet вместо цепочки get:
+
+        plan = ReadPlan()
+        order = plan.add("orders!A12:N12", lambda rows: rows[0] if rows else [])
+        ids = plan.add("users!A:A")
+        plan.run()
+        plan[order], plan[ids]
+
+    parse получает строки своего диапазона. Одинаковые диапазоны
+    запрашиваются один раз. Берите только нужные колонки (users!A:A + E:F,
+    а не users!A:F): диапазоны, начатые с одной строки, идут строка в строку.
+    """
+
+    __slots__ = ("ranges", "parsers", "results", "unformatted")
+
+    def __init__(self, unformatted: bool = False):
+        self.ranges: list[str] = []
+        self.parsers: list[Callable | None] = []
+        self.results: list = []
+        self.unformatted = unformatted
+
+    def add(self, range_: str, parse: Callable | None = None) -> int:
+        self.ranges.append(range_)
+        self.parsers.append(parse)
+        return len(self.ranges) - 1
+
+    def run(self) -> "ReadPlan":
+        by_range: dict[str, list] = {}
+        remote = []
+        for range_ in dict.fromkeys(self.ranges):
+            rows = None if self.unformatted else replica_read(range_)
+            if rows is None:
+                remote.append(range_)
+            else:
+                by_range[range_] = rows
+        if len(remote) == 1:
+            by_range[remote[0]] = sheets_read(remote[0], self.unformatted)
+        elif remote:
+            by_range.update(zip(remote, sheets_batch_read(remote, self.unformatted)))
+
+        seen = set()
+        self.results = []
+        for range_, parse in zip(self.ranges, self.parsers):
+            rows = by_range.get(range_, [])
+            if range_ in seen:
+                rows = _copy_rows(rows)
+            seen.add(range_)
+            self.results.append(rows if parse is None else parse(rows))
+        return self
+
+    def __getitem__(self, handle: int):
+        return self.results[handle]
+
+
+def _sheets_written():
+    t = current_tenant()
+    with t.read_flights_lock:
+        t.sheets_write_gen += 1
+
+def sheets_update(range_: str, values: list[list]):
+    _count_sheets_call("sheets_writes")
+    try:
+        result = get_sheets_service().spreadsheets().values().update(
+            spreadsheetId=current_tenant().spreadsheet_id,
+            range=range_,
+            valueInputOption="RAW",
+            body={"values": values},
+        ).execute()
+    finally:
+        _sheets_written()
+    replica_written(range_, values)
+    return result
 
+def sheets_batch_update(data: list[dict]):
+    _count_sheets_call("sheets_writes")
+    try:
+        result = get_sheets_service().spreadsheets().values().batchUpdate(
+            spreadsheetId=current_tenant().spreadsheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": data,
+            },
+        ).execute()
+    finally:
+        _sheets_written()
+    for item in data:
+        replica_written(item["range"], item.get("values", []))
+    return result
+
+def sheets_add_sheet(title: str) -> bool:
+    """Создает лист. False — лист с таким именем уже есть."""
+    _count_sheets_call("sheets_writes")
+    try:
+        get_sheets_service().spreadsheets().batchUpdate(
+            spreadsheetId=current_tenant().spreadsheet_id,
+            body={"requests": [{"addSheet": {"properties": {"title": title}}}]},
+        ).execute()
+    except Exception as e:
+        if "already exists" in str(e):
+            return False
+        raise
+    finally:
+        _sheets_written()
     return True
 
+def sheets_append(range_: str, values: list[list], insert_rows: bool = False):
+    _count_sheets_call("sheets_writes")
+    params = {"insertDataOption": "INSERT_ROWS"} if insert_rows else {}
+    try:
+        result = get_sheets_service().spreadsheets().values().append(
+            spreadsheetId=current_tenant().spreadsheet_id,
+            range=range_,
+            valueInputOption="RAW",
+            body={"values": values},
+            **params,
+        ).execute()
+    finally:
+        _sheets_written()
+    # куда легли строки, известно только из ответа
+    updated = (result.get("updates") or {}).get("updatedRange")
+    if updated:
+        replica_written(updated, values)
+    return result
 
-def pop_waiting_desc(context: ContextTypes.DEFAULT_TYPE) -> str | None:
-    return context.user_data.pop("waiting_desc_for", None)
 
-def _get_cart(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, int]:
-    cart = context.user_data.get("cart")
-    if not isinstance(cart, dict):
-        cart = {}
-        context.user_data["cart"] = cart
-    return cart
-
-def set_product_price(product_id: str, price: int):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
-
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="products!A2:A",
-    ).execute()
+# -------------------------
+# replica: локальная копия таблицы (SQLite)
+# -------------------------
+# products, orders и users целиком лежат в SQLite-файле магазина (один на все
+# воркеры, WAL). Лидер заливает копию одним batchGet при старте; на каждой
+# синхронизации каталога перезаливает products, если лист изменился, и
+# дочитывает новые строки orders / users, а целиком сверяет их раз в
+# REPLICA_RECONCILE_SECONDS (ручные правки в Sheets); записи бота (sheets_update / batch_update / append) сразу дублируются
+# в копию. sheets_read и ReadPlan отвечают из копии, пока она свежая,
+# точечные поиски (заказ / пользователь по id, заказы с даты) — по индексам.
+#
+# Строка хранится как в листе (номер строки, значения текстом) с временем
+# записи: сверка заменяет только строки старше начала своего чтения, поэтому
+# заказ, записанный любым воркером во время сверки, не пропадает.
+# Чтения без форматирования (архивация) всегда идут в Sheets.
+
+REPLICA_SHEETS = {"products": "G", "orders": "O", "users": "F"}  # лист -> последняя колонка
+
+REPLICA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    sheet TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    a TEXT NOT NULL,
+    b TEXT NOT NULL,
+    vals TEXT NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (sheet, row)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sheet_rows_a ON sheet_rows (sheet, a);
+CREATE INDEX IF NOT EXISTS sheet_rows_b ON sheet_rows (sheet, b);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+_A1_CELL_RE = re.compile(r"^([A-Z]*)(\d*)$")
+
+
+def _col_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - ord("A") + 1)
+    return n - 1
+
+
+def parse_a1(range_: str) -> tuple[str, int, int, int | None, int | None]:
+    """
+    "orders!A2:O" -> ("orders", 0, 2, 14, None):
+    колонки с 0, строки — номера строк листа, None — до конца.
+    """
+    if "!" not in range_:
+        return range_.strip("'"), 0, 1, None, None
+    sheet, _, cells = range_.rpartition("!")
+    start, _, end = cells.partition(":")
+    m1 = _A1_CELL_RE.match(start)
+    m2 = _A1_CELL_RE.match(end or start)
+    if not m1 or not m2:
+        raise ValueError(f"bad range: {range_}")
+    return (
+        sheet.strip("'"),
+        _col_number(m1.group(1)) if m1.group(1) else 0,
+        int(m1.group(2)) if m1.group(2) else 1,
+        _col_number(m2.group(1)) if m2.group(1) else None,
+        int(m2.group(2)) if m2.group(2) else None,
+    )
 
-    rows = result.get("values", [])
-    row_index = None
 
-    for idx, row in enumerate(rows, start=2):
-        if row and row[0] == product_id:
-            row_index = idx
-            break
+def _cell_text(v) -> str:
+    # как Sheets отдает записанное RAW значение при обычном чтении
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return "" if v is None else str(v)
 
-    if row_index is None:
+
+def _trim_cells(cells: list[str]) -> list[str]:
+    while cells and cells[-1] == "":
+        cells.pop()
+    return cells
+
+
+class Replica:
+    __slots__ = ("path", "db", "lock")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(REPLICA_SCHEMA)
+        self.lock = threading.Lock()
+
+    def load(self, sheet: str, rows: list[list[str]], started: float, first_row: int = 1):
+        """Строки листа с first_row до конца; записи новее started остаются."""
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM sheet_rows WHERE sheet = ? AND row >= ? AND ts < ?", (sheet, first_row, started)
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO sheet_rows (sheet, row, a, b, vals, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (sheet, idx, row[0], row[1] if len(row) > 1 else "",
+                     json.dumps(row, ensure_ascii=False), started)
+                    for idx, row in enumerate(rows, start=first_row) if row
+                ],
+            )
+
+    def write(self, range_: str, values: list[list]):
+        sheet, c0, r0, _c1, _r1 = parse_a1(range_)
+        now = time.time()
+        with self.lock, self.db:
+            for i, src in enumerate(values):
+                cur = self.db.execute(
+                    "SELECT vals FROM sheet_rows WHERE sheet = ? AND row = ?", (sheet, r0 + i)
+                ).fetchone()
+                cells = json.loads(cur[0]) if cur else []
+                if len(cells) < c0 + len(src):
+                    cells += [""] * (c0 + len(src) - len(cells))
+                for j, v in enumerate(src):
+                    cells[c0 + j] = _cell_text(v)
+                cells = _trim_cells(cells)
+                # пустая строка остается записью (с временем), а не удаляется
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sheet_rows (sheet, row, a, b, vals, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                    (sheet, r0 + i, cells[0] if cells else "", cells[1] if len(cells) > 1 else "",
+                     json.dumps(cells, ensure_ascii=False), now),
+                )
+
+    def read(self, range_: str) -> list[list[str]]:
+        """Как values.get: пустые строки внутри — [], хвост обрезан."""
+        sheet, c0, r0, c1, r1 = parse_a1(range_)
+        sql = "SELECT row, vals FROM sheet_rows WHERE sheet = ? AND row >= ?"
+        args: list = [sheet, r0]
+        if r1 is not None:
+            sql += " AND row <= ?"
+            args.append(r1)
+        with self.lock:
+            found = self.db.execute(sql + " ORDER BY row", args).fetchall()
+
+        out: list[list[str]] = []
+        for row, vals in found:
+            while len(out) < row - r0:
+                out.append([])
+            cells = json.loads(vals)
+            out.append(_trim_cells(cells[c0:] if c1 is None else cells[c0:c1 + 1]))
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def find(self, sheet: str, key: str) -> tuple[int, list[str]] | None:
+        """Первая строка листа с колонкой A == key (без заголовка)."""
+        if not key:
+            return None
+        with self.lock:
+            found = self.db.execute(
+                "SELECT row, vals FROM sheet_rows WHERE sheet = ? AND a = ? AND row > 1 ORDER BY row LIMIT 1",
+                (sheet, key),
+            ).fetchone()
+        return (found[0], json.loads(found[1])) if found else None
+
+    def since(self, sheet: str, b_min: str) -> list[list[str]]:
+        """Строки с колонкой B >= b_min (orders: created_at) по порядку листа."""
+        with self.lock:
+            found = self.db.execute(
+                "SELECT vals FROM sheet_rows WHERE sheet = ? AND b >= ? AND row > 1 ORDER BY row",
+                (sheet, b_min),
+            ).fetchall()
+        return [json.loads(vals) for (vals,) in found]
+
+    def last_row(self, sheet: str) -> int:
+        """Номер последней непустой строки листа (0 — лист пуст)."""
+        with self.lock:
+            found = self.db.execute(
+                "SELECT MAX(row) FROM sheet_rows WHERE sheet = ? AND vals != '[]'", (sheet,)
+            ).fetchone()
+        return found[0] or 0
+
+    def synced_at(self, key: str = "synced_at") -> float:
+        with self.lock:
+            found = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return float(found[0]) if found else 0.0
+
+    def set_synced(self, ts: float, key: str = "synced_at"):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, repr(ts)))
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            found = self.db.execute(
+                "SELECT sheet, COUNT(*) FROM sheet_rows WHERE vals != '[]' GROUP BY sheet"
+            ).fetchall()
+        return dict(found)
+
+
+def get_replica(t: "Tenant") -> Replica | None:
+    if not t.replica_path:
+        return None
+    if t.replica is None:
+        with t.replica_open_lock:
+            if t.replica is None and t.replica_path:
+                try:
+                    t.replica = Replica(t.replica_path)
+                except Exception as e:
+                    log.warning(f"⚠️ [{t.name}] replica disabled: {e!r}")
+                    t.replica_path = ""
+    return t.replica
+
+
+def replica_ready(t: "Tenant") -> Replica | None:
+    """Копия, если лидер сверял ее недавно; иначе None — читать из Sheets."""
+    replica = get_replica(t)
+    if replica is None:
+        return None
+    try:
+        if time.time() - replica.synced_at() <= REPLICA_MAX_AGE_SECONDS:
+            return replica
+    except Exception as e:
+        log.warning(f"⚠️ [{t.name}] replica unreadable: {e!r}")
+    return None
+
+
+def replica_read(range_: str) -> list[list[str]] | None:
+    if parse_a1(range_)[0] not in REPLICA_SHEETS:
+        return None
+    t = current_tenant()
+    replica = replica_ready(t)
+    if replica is None:
+        return None
+    try:
+        return replica.read(range_)
+    except Exception as e:
+        log.warning(f"⚠️ [{t.name}] replica read {range_} failed: {e!r}")
+        return None
+
+
+def replica_written(range_: str, values: list[list]):
+    """Запись в Sheets прошла — повторяем ее в копии."""
+    if parse_a1(range_)[0] not in REPLICA_SHEETS:
+        return
+    t = current_tenant()
+    replica = get_replica(t)
+    if replica is None:
+        return
+    try:
+        replica.write(range_, values)
+    except Exception as e:
+        # копия разошлась с таблицей — не читаем из нее до следующей сверки
+        log.warning(f"⚠️ [{t.name}] replica write {range_} failed: {e!r}")
+        try:
+            replica.set_synced(0.0)
+            replica.set_synced(0.0, "reconciled_at")
+        except Exception:
+            pass
+
+
+def sync_replica() -> bool:
+    """Лидер: полная сверка — все листы копии одним batchGet. False — копия выключена."""
+    t = current_tenant()
+    replica = get_replica(t)
+    if replica is None:
         return False
+    started = time.time()
+    sheets = list(REPLICA_SHEETS)
+    results = sheets_batch_read([f"{sheet}!A:{REPLICA_SHEETS[sheet]}" for sheet in sheets])
+    for sheet, rows in zip(sheets, results):
+        replica.load(sheet, rows, started)
+    replica.set_synced(started)
+    replica.set_synced(started, "reconciled_at")
+    return True
 
-    sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"products!C{row_index}",
-        valueInputOption="RAW",
-        body={"values": [[price]]},
-    ).execute()
+
+def sync_from_sheets():
+    """
+    Лидер, раз в CATALOG_SYNC_SECONDS. Один batchGet: products!A2:G (копия
+    перезаливается, только если refresh_catalog увидел изменение) и строки
+    orders / users после последней известной — свои записи копия получает
+    сразу (replica_written). Полная сверка — раз в REPLICA_RECONCILE_SECONDS.
+    """
+    t = current_tenant()
+    replica = get_replica(t)
+    if replica is None:
+        refresh_catalog()
+        return
+
+    started = time.time()
+    if started - replica.synced_at("reconciled_at") > REPLICA_RECONCILE_SECONDS:
+        sync_replica()
+        refresh_catalog()  # уже из копии
+        return
+
+    tails = {sheet: replica.last_row(sheet) + 1 for sheet in ("orders", "users")}
+    results = sheets_batch_read(
+        ["products!A2:G"] + [f"{sheet}!A{row}:{REPLICA_SHEETS[sheet]}" for sheet, row in tails.items()]
+    )
+
+    rows_hash = t.catalog_rows_hash
+    refresh_catalog(rows=results[0])
+    if t.catalog_rows_hash != rows_hash:
+        replica.load("products", results[0], started, first_row=2)
+    for (sheet, row), rows in zip(tails.items(), results[1:]):
+        if rows:
+            replica.load(sheet, rows, started, first_row=row)
+    replica.set_synced(started)
+
+
+# -------------------------
+# helpers: storage
+# -------------------------
+
+def save_user_contacts(user_id: int, real_name: str, phone_number: str):
+    target_row = None
+
+    replica = replica_ready(current_tenant())
+    if replica is not None:
+        found = replica.find("users", str(user_id))
+        target_row = found[0] if found else None
+    else:
+        rows = sheets_read("users!A2:F")
+        for idx, row in enumerate(rows, start=2):
+            if row and row[0] == str(user_id):
+                target_row = idx
+                break
+
+    if not target_row:
+        return False
+
+    sheets_batch_update([
+        {"range": f"users!E{target_row}", "values": [[real_name]]},
+        {"range": f"users!F{target_row}", "values": [[phone_number]]}
+    ])
 
     return True
 
+
+def pop_waiting_desc(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    return context.user_data.pop("waiting_desc_for", None)
+
+def _get_cart(context: ContextTypes.DEFAULT_TYPE) -> "Cart":
+    cart = context.user_data.get("cart")
+    if isinstance(cart, Cart):
+        return cart
+
+    # старый формат {pid: qty} — переводим один раз
+    new_cart = Cart()
+    if isinstance(cart, dict):
+        for pid, qty in cart.items():
+            p = get_product_by_id(pid)
+            if p and qty > 0:
+                new_cart.inc(p, qty)
+    context.user_data["cart"] = new_cart
+    return new_cart
+
 def pop_waiting_price(context: ContextTypes.DEFAULT_TYPE) -> str | None:
     return context.user_data.pop("waiting_price_for", None)
 
@@ -199,15 +1006,9 @@ def safe_open_photo(path: str):
         return None
 
 def read_products_from_sheets() -> list[dict]:
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
+    return parse_product_rows(sheets_read("products!A2:G"))
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="products!A2:G",
-    ).execute()
-
-    rows = result.get("values", [])
+def parse_product_rows(rows: list[list[str]]) -> list[dict]:
     products: list[dict] = []
 
     for row in rows:
@@ -226,153 +1027,2070 @@ def read_products_from_sheets() -> list[dict]:
 
     return products
 
-import uuid
-from datetime import datetime
-
-def load_categories() -> list[str]:
-    rows = read_products_from_sheets()
-    return sorted({r["category"] for r in rows if r["available"]})
-
 # -------------------------
-# helpers: cart text
+# catalog cache
 # -------------------------
+# Хендлеры читают каталог из памяти. Снимок неизменяемый и подменяется
+# целиком, так что читатели никогда не видят "половину" обновления.
 
-from uuid import uuid4
+# callback_data у Telegram — до 64 байт. Категории в кнопках — короткий
+# стабильный id (хэш названия: один и тот же во всех воркерах и после
+# перезапуска), длинные product_id — тоже; обратно — через индексы снимка.
+CALLBACK_ID_MAX = 20
 
-def append_product_to_sheets(name: str, price: int, category: str, description: str) -> str | None:
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    product_id = f"P{uuid4().hex[:10]}"
+def short_id(value: str) -> str:
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:8]
 
-    row = [
-        product_id,          # A
-        name,                # B
-        price,               # C
-        "TRUE",              # D available
-        category,            # E
-        "",                  # F photo_file_id
-        description or "",   # G
-    ]
 
-    try:
-        sheet.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range="products!A:G",
-            valueInputOption="RAW",
-            body={"values": [row]},
-        ).execute()
-        return product_id
-    except Exception:
-        return None
+def category_ref(category: str) -> str:
+    return short_id(category)
 
-def save_order_to_sheets(
-    user,
-    cart: dict,
-    kind: str,
-    comment: str,
-    address: str | None = None,
-) -> str | None:
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    items = []
-    total = 0
+def product_ref(pid: str) -> str:
+    # обычные id из таблицы (P0001, Pa1b2c3d4e5) идут как есть
+    if len(pid.encode("utf-8")) <= CALLBACK_ID_MAX and ":" not in pid:
+        return pid
+    return "~" + short_id(pid)
 
-    for pid, qty in cart.items():
-        p = get_product_by_id(pid)
-        if not p:
-            continue
-        items.append(f"{p['name']} x{qty}")
-        total += p["price"] * qty
 
-    order_id = str(uuid.uuid4())
-    created_at = datetime.utcnow().isoformat()
+class CatalogSnapshot:
+    __slots__ = ("products", "by_id", "version", "fetched_at", "source", "categories", "refs")
 
-    row = [[
-        order_id,             # A order_id
-        created_at,           # B created_at
-        str(user.id),         # C user_id
-        user.username or "",  # D username
-        "; ".join(items),     # E items
-        total,                # F total_price
-        kind,                 # G type
-        comment or "",        # H comment
-        "",                   # I payment_proof (позже)
-        "waiting_payment",    # J status
-        "",                   # K handled_at
-        "",                   # L handled_by
-        "",                   # M reaction_seconds
-        address or "",        # N address (NEW)
-    ]]
+    def __init__(self, products: list[dict], source: str, fetched_at: float | None = None):
+        self.products = products
+        self.by_id = {p["product_id"]: p for p in products}
+        self.version = hashlib.sha1(
+            json.dumps(products, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:12]
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.source = source
+        # id кнопки -> категория / product_id (только для длинных id)
+        self.categories = {category_ref(p["category"]): p["category"] for p in products if p.get("category")}
+        self.refs = {
+            ref: p["product_id"] for p in products
+            if (ref := product_ref(p["product_id"])) != p["product_id"]
+        }
 
+
+def load_catalog_snapshot() -> bool:
+    t = current_tenant()
     try:
-        resp = sheet.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range="orders!A:N",
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": row},
-        ).execute()
+        with open(t.catalog_snapshot_path, "r", encoding="utf-8") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            data = json.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        log.warning(f"⚠️ catalog snapshot unreadable: {e}")
+        return False
 
-        log.info(
-            f"✅ ORDER APPENDED: order_id={order_id} "
-            f"resp={resp.get('updates', {}).get('updatedRange')}"
-        )
-        return order_id
+    with t.product_writes_lock:
+        t.catalog = CatalogSnapshot(overlay_product_writes(t, data.get("products", [])), source="disk")
+    t.catalog_file_mtime = mtime
+    log.info(f"📦 [{t.name}] catalog snapshot loaded: {len(t.catalog.products)} products, v={t.catalog.version}")
+    return True
 
-    except Exception:
-        log.exception(f"❌ ORDER APPEND FAILED: buyer={user.id}")
-        return None
-    
 
-def kb_staff_order(order_id: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Принять", callback_data=f"staff:approve:{order_id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"staff:reject:{order_id}"),
-        ]
-    ])
+def save_catalog_snapshot(snapshot: CatalogSnapshot):
+    t = current_tenant()
+    path = t.catalog_snapshot_path
+    # pid в имени: файл общий для всех воркеров магазина
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": snapshot.version, "fetched_at": snapshot.fetched_at, "products": snapshot.products},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp, path)
+        t.catalog_file_mtime = os.stat(path).st_mtime
+    except Exception as e:
+        log.warning(f"⚠️ catalog snapshot not saved: {e}")
 
 
+def follow_catalog_snapshot() -> bool:
+    """
+    Воркер-последователь: перечитывает снимок с диска, если его обновил
+    другой процесс (лидер по расписанию или воркер после правки сотрудника).
+    """
+    t = current_tenant()
+    try:
+        mtime = os.stat(t.catalog_snapshot_path).st_mtime
+    except FileNotFoundError:
+        return False
+    if mtime <= t.catalog_file_mtime:
+        return False
+    return load_catalog_snapshot()
 
 
-def set_waiting_photo(context: ContextTypes.DEFAULT_TYPE, product_id: str):
-    context.user_data["waiting_photo_for"] = product_id
+def refresh_catalog(force: bool = False, rows: list[list[str]] | None = None) -> CatalogSnapshot:
+    """
+    Читает products и пересобирает снимок, только если содержимое листа
+    изменилось (хэш сырых строк). Новый снимок подменяется одной операцией.
+    rows — строки products!A2:G, уже прочитанные в общем batchGet.
+    """
+    t = current_tenant()
+    if rows is None:
+        rows = sheets_read("products!A2:G")
+    rows_hash = hashlib.sha1(
+        json.dumps(rows, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+    t.catalog_dirty = False
+    if not force and rows_hash == t.catalog_rows_hash and t.catalog.source == "sheets":
+        t.catalog.fetched_at = time.time()
+        return t.catalog
+
+    products = parse_product_rows(rows)
+    # еще не записанные правки сотрудников — поверх листа; под локом правок,
+    # иначе правка, принятая во время чтения, пропала бы при подмене снимка
+    with t.product_writes_lock:
+        previous = t.catalog
+        snapshot = CatalogSnapshot(overlay_product_writes(t, products), source="sheets")
+        t.catalog = snapshot
+        t.catalog_rows_hash = rows_hash
+    if snapshot.version != previous.version or previous.source != "sheets":
+        save_catalog_snapshot(snapshot)
+        if previous.source == "sheets":
+            log.info(f"📦 [{t.name}] catalog changed: v={previous.version} -> v={snapshot.version}")
+    return snapshot
+
+
+def get_catalog() -> CatalogSnapshot:
+    t = current_tenant()
+    stale = (
+        t.catalog_dirty
+        or t.catalog.source == "empty"
+        or (not t.catalog_sync_active and time.time() - t.catalog.fetched_at > CATALOG_TTL_SECONDS)
+    )
+    if stale:
+        try:
+            refresh_catalog()
+        except Exception:
+            # Sheets недоступен — продолжаем показывать последний каталог
+            log.exception("❌ catalog refresh failed, serving cached snapshot")
+            t.catalog.fetched_at = time.time()
+    return t.catalog
 
-def pop_waiting_photo(context: ContextTypes.DEFAULT_TYPE) -> str | None:
-    return context.user_data.pop("waiting_photo_for", None)
 
-def cart_total(cart: Dict[str, int]) -> int:
-    total = 0
-    for pid, qty in cart.items():
-        p = get_product_by_id(pid)
-        if p:
-            total += p["price"] * qty
-    return total
+def get_products() -> list[dict]:
+    return get_catalog().products
 
-def cart_text(cart: Dict[str, int]) -> str:
-    if not cart:
-        return "Корзина пустая."
 
-    lines: List[str] = []
-    for pid, qty in cart.items():
-        p = get_product_by_id(pid)
-        if not p:
-            continue
-        lines.append(
-            f"• {p['name']} × {qty} = {_fmt_money(p['price'] * qty)}"
-        )
+def resolve_category(ref: str) -> str | None:
+    catalog = get_catalog()
+    category = catalog.categories.get(ref)
+    if category is None and ref in catalog.categories.values():
+        category = ref  # кнопки старого формата: cat:<название>
+    return category
 
-    lines.append("")
-    lines.append(f"Итого: {_fmt_money(cart_total(cart))}")
-    return "\n".join(lines)
 
+def resolve_product(ref: str) -> str:
+    return get_catalog().refs.get(ref, ref)
 
-# -------------------------
-# "ONE WINDOW" UI: clear & track bot messages
-# -------------------------
-async def clear_ui(
+
+def invalidate_catalog():
+    # правка сотрудника: следующий читатель перечитает лист
+    current_tenant().catalog_dirty = True
+
+
+async def catalog_sync_job(context: ContextTypes.DEFAULT_TYPE):
+    # одна задача JobQueue на все магазины процесса (job.data — список Tenant);
+    # в Sheets ходит только лидер, остальные воркеры читают его снимок с диска
+    sync_fn = sync_from_sheets if is_leader() else follow_catalog_snapshot
+
+    async def sync(t: Tenant):
+        with use_tenant(t):
+            try:
+                await asyncio.to_thread(sync_fn)
+            except Exception as e:
+                log.warning(f"⚠️ [{t.name}] catalog sync failed: {e!r}")
+
+    await asyncio.gather(*(sync(t) for t in context.job.data))
+
+
+# -------------------------
+# product writes (coalescing)
+# -------------------------
+# Правка товара (цена, видимость, фото, описание) сразу видна в каталоге
+# в памяти, а в Sheets уходит пачкой: все правки за PRODUCT_WRITE_DELAY_SECONDS
+# -> одно чтение колонки id + один values.batchUpdate.
+# Повторная правка той же ячейки до записи просто заменяет значение.
+
+PRODUCT_WRITE_COLUMNS = {
+    "price": "C",
+    "available": "D",
+    "category": "E",
+    "photo_file_id": "F",
+    "description": "G",
+}
+
+
+def _product_cell(field: str, value):
+    if field == "available":
+        return "TRUE" if value else "FALSE"
+    return value
+
+
+def overlay_product_writes(t: "Tenant", products: list[dict]) -> list[dict]:
+    if not t.product_writes:
+        return products
+
+    with t.product_writes_lock:
+        pending = dict(t.product_writes)
+
+    patched: dict[str, dict] = {}
+    for (pid, field), value in pending.items():
+        patched.setdefault(pid, {})[field] = value
+
+    return [
+        {**p, **patched[p["product_id"]]} if p["product_id"] in patched else p
+        for p in products
+    ]
+
+
+def queue_product_writes(changes: list[tuple[str, str, object]]) -> int:
+    """
+    changes: [(product_id, поле, значение), ...]
+    Неизвестные товары пропускаются. Возвращает число принятых правок.
+    """
+    t = current_tenant()
+    catalog = get_catalog()
+    changes = [c for c in changes if c[0] in catalog.by_id]
+    if not changes:
+        return 0
+
+    patched: dict[str, dict] = {}
+    for pid, field, value in changes:
+        patched.setdefault(pid, {})[field] = value
+
+    with t.product_writes_lock:
+        for pid, field, value in changes:
+            t.product_writes[(pid, field)] = value
+        # read-your-writes: новый снимок с правками, без похода в Sheets
+        snapshot = CatalogSnapshot(
+            [
+                {**p, **patched[p["product_id"]]} if p["product_id"] in patched else p
+                for p in t.catalog.products
+            ],
+            source=t.catalog.source,
+            fetched_at=t.catalog.fetched_at,
+        )
+        t.catalog = snapshot
+        _schedule_product_flush(t, PRODUCT_WRITE_DELAY_SECONDS)
+
+    # остальные воркеры магазина следят за снимком на диске (follow_catalog_snapshot)
+    save_catalog_snapshot(snapshot)
+    return len(changes)
+
+
+def queue_product_write(product_id: str, field: str, value) -> bool:
+    return queue_product_writes([(product_id, field, value)]) == 1
+
+
+def _schedule_product_flush(t: "Tenant", delay: float):
+    # вызывается под t.product_writes_lock
+    if t.product_flush_timer is not None:
+        return
+    timer = threading.Timer(delay, flush_product_writes, args=(t,))
+    timer.daemon = True
+    t.product_flush_timer = timer
+    timer.start()
+
+
+def flush_product_writes(t: "Tenant | None" = None) -> int:
+    """Пишет накопленные правки. Возвращает число записанных ячеек."""
+    t = t or current_tenant()
+    with t.product_writes_lock:
+        if t.product_flush_timer is not None:
+            t.product_flush_timer.cancel()
+            t.product_flush_timer = None
+        pending = dict(t.product_writes)
+    if not pending:
+        return 0
+
+    with use_tenant(t):
+        try:
+            ids = sheets_read("products!A2:A")
+            row_of = {row[0]: idx for idx, row in enumerate(ids, start=2) if row}
+            data = [
+                {
+                    "range": f"products!{PRODUCT_WRITE_COLUMNS[field]}{row_of[pid]}",
+                    "values": [[_product_cell(field, value)]],
+                }
+                for (pid, field), value in pending.items()
+                if pid in row_of
+            ]
+            if data:
+                sheets_batch_update(data)
+        except Exception as e:
+            log.warning(f"⚠️ [{t.name}] product writes not saved, retrying: {e!r}")
+            with t.product_writes_lock:
+                _schedule_product_flush(t, PRODUCT_WRITE_DELAY_SECONDS * 4)
+            return 0
+
+    lost = {pid for (pid, _field) in pending if pid not in row_of}
+    if lost:
+        log.warning(f"⚠️ [{t.name}] products gone from sheet, edits dropped: {sorted(lost)}")
+
+    with t.product_writes_lock:
+        for key, value in pending.items():
+            # значение могли поменять еще раз, пока шла запись
+            if key in t.product_writes and t.product_writes[key] == value:
+                del t.product_writes[key]
+        if t.product_writes:
+            _schedule_product_flush(t, PRODUCT_WRITE_DELAY_SECONDS)
+
+    return len(data)
+
+
+# -------------------------
+# search
+# -------------------------
+# Инвертированный индекс по названию, категории и описанию. Один индекс на
+# магазин; при смене снимка каталога он обновляется по разнице: товары,
+# у которых поменялись искомые поля или видимость, переиндексируются,
+# остальные не трогаются (добавленный через append_product_to_sheets товар —
+# это одна вставка, а не перестройка). Запрос — AND по словам, каждое
+# слово ищется как префикс: "роз" находит "розы", "ros" — "roses".
+#
+# Нормализация: NFKD + casefold, диакритика убирается (ё -> е, é -> e);
+# корейские слоги раскладываются на чамо, поэтому недонабранный слог
+# ("자" на пути к "장미") тоже совпадает как префикс.
+#
+# Слово без совпадений раскрывается синонимами ("peony" -> "пион", "작약"),
+# а если и так пусто — ищутся похожие слова по триграммам ("архидея" ->
+# "орхидея"). Размер запроса и число нечетких кандидатов ограничены,
+# поэтому время ответа не зависит от того, что набрал покупатель.
+
+SEARCH_FIELDS = (("name", 3), ("category", 2), ("description", 1))
+SEARCH_LIMIT = 50
+SEARCH_MAX_QUERY_CHARS = 100
+SEARCH_MAX_TOKENS = 6
+# нечеткий поиск: порог сходства (коэффициент Дайса по триграммам)
+# и сколько лучших похожих слов брать на одно слово запроса
+SEARCH_FUZZY_MIN_SIMILARITY = 0.45
+SEARCH_FUZZY_TERMS = 4
+_WORD_RE = re.compile(r"\w+")
+
+# группы взаимозаменяемых слов; SEARCH_SYNONYMS_JSON — свой список групп
+# (JSON или путь к .json файлу), например [["пион", "peony", "작약"], ...]
+DEFAULT_SEARCH_SYNONYMS = [
+    ["роза", "rose", "장미"],
+    ["пион", "peony", "작약"],
+    ["тюльпан", "tulip", "튤립"],
+    ["орхидея", "orchid", "난초"],
+    ["лилия", "lily", "백합"],
+    ["хризантема", "chrysanthemum", "국화"],
+    ["гортензия", "hydrangea", "수국"],
+    ["подсолнух", "sunflower", "해바라기"],
+    ["гвоздика", "carnation", "카네이션"],
+    ["ромашка", "daisy", "chamomile", "데이지"],
+    ["эустома", "лизиантус", "eustoma", "lisianthus", "리시안셔스"],
+    ["букет", "bouquet", "꽃다발"],
+    ["корзина", "basket", "꽃바구니", "바구니"],
+    ["коробка", "box", "박스"],
+    ["горшок", "pot", "화분"],
+    ["свадьба", "свадебный", "wedding", "웨딩"],
+]
+
+
+def normalize_search_text(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def search_tokens(text: str) -> list[str]:
+    return _WORD_RE.findall(normalize_search_text(text or ""))
+
+
+def trigrams(token: str) -> set[str]:
+    # отступ только в начале: начало слова важнее, а недописанный хвост
+    # не штрафуется лишними триграммами
+    padded = f"  {token}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _similarity(a: set[str], b: set[str]) -> float:
+    return 2 * len(a & b) / (len(a) + len(b)) if a and b else 0.0
+
+
+def load_search_synonyms() -> list[list[str]]:
+    raw = os.getenv("SEARCH_SYNONYMS_JSON", "").strip()
+    if not raw:
+        return DEFAULT_SEARCH_SYNONYMS
+
+    if not raw.startswith("["):
+        with open(raw, "r", encoding="utf-8") as f:
+            raw = f.read()
+
+    groups = json.loads(raw)
+    if not isinstance(groups, list) or not all(isinstance(g, list) for g in groups):
+        raise RuntimeError("SEARCH_SYNONYMS_JSON must be a list of lists")
+    return groups
+
+
+class SynonymTable:
+    """Нормализованное слово -> остальные слова его групп."""
+
+    __slots__ = ("groups", "grams")
+
+    def __init__(self, groups: list[list[str]]):
+        self.groups: dict[str, set[str]] = {}
+        for group in groups:
+            words = {w for text in group for w in search_tokens(text)}
+            for w in words:
+                self.groups.setdefault(w, set()).update(words - {w})
+        self.grams = {w: trigrams(w) for w in self.groups}
+
+    @staticmethod
+    def stem(word: str) -> str:
+        # синоним ищется без последней буквы: "роза" находит "розы", "rose" — "roses"
+        return word[:max(3, len(word) - 1)]
+
+    def expand(self, token: str) -> set[str]:
+        # "пионы" -> группа "пион"; "пио" -> тоже (префикс синонима)
+        out: set[str] = set()
+        for word, others in self.groups.items():
+            if token.startswith(word) or (len(token) >= 3 and word.startswith(token)):
+                out.add(word)
+                out |= others
+        return out
+
+    def similar(self, token: str, grams: set[str]) -> list[tuple[str, float]]:
+        # словарь синонимов маленький — сравниваем со всеми
+        return [
+            (word, sim) for word, g in self.grams.items()
+            if (sim := _similarity(grams, g)) >= SEARCH_FUZZY_MIN_SIMILARITY
+        ]
+
+
+SEARCH_SYNONYMS = SynonymTable(load_search_synonyms())
+
+
+def _search_key(p: dict) -> tuple:
+    return (p["available"],) + tuple(p.get(field) or "" for field, _w in SEARCH_FIELDS)
+
+
+class SearchIndex:
+    __slots__ = ("products", "keys", "postings", "vocab", "grams", "version", "lock")
+
+    def __init__(self):
+        # product_id -> товар (только видимые покупателю)
+        self.products: dict[str, dict] = {}
+        # product_id -> искомые поля на момент индексации
+        self.keys: dict[str, tuple] = {}
+        # слово -> {product_id: вес}
+        self.postings: dict[str, dict[str, int]] = {}
+        self.vocab: list[str] = []
+        # триграмма -> слова словаря
+        self.grams: dict[str, set[str]] = {}
+        self.version: str | None = None
+        # синхронизация и поиск идут из разных потоков (to_thread / event loop)
+        self.lock = threading.Lock()
+
+    def _add_token(self, token: str):
+        insort(self.vocab, token)
+        for g in trigrams(token):
+            self.grams.setdefault(g, set()).add(token)
+
+    def _drop_token(self, token: str):
+        i = bisect_left(self.vocab, token)
+        del self.vocab[i]
+        for g in trigrams(token):
+            words = self.grams[g]
+            words.discard(token)
+            if not words:
+                del self.grams[g]
+
+    def add(self, p: dict):
+        pid = p["product_id"]
+        self.keys[pid] = _search_key(p)
+        if not p["available"]:
+            return
+        self.products[pid] = p
+        for field, weight in SEARCH_FIELDS:
+            for token in search_tokens(p.get(field) or ""):
+                entry = self.postings.get(token)
+                if entry is None:
+                    entry = self.postings[token] = {}
+                    self._add_token(token)
+                entry[pid] = max(entry.get(pid, 0), weight)
+
+    def remove(self, pid: str):
+        self.keys.pop(pid, None)
+        p = self.products.pop(pid, None)
+        if p is None:
+            return
+        for field, _weight in SEARCH_FIELDS:
+            for token in search_tokens(p.get(field) or ""):
+                entry = self.postings.get(token)
+                if entry is None or entry.pop(pid, None) is None or entry:
+                    continue
+                del self.postings[token]
+                self._drop_token(token)
+
+    def sync(self, products: list[dict], version: str) -> int:
+        """Приводит индекс к снимку каталога; возвращает число переиндексированных товаров."""
+        seen = set()
+        changed = 0
+        for p in products:
+            pid = p["product_id"]
+            seen.add(pid)
+            key = self.keys.get(pid)
+            if key == _search_key(p):
+                # поля те же, но объект из нового снимка (цена, фото)
+                if pid in self.products:
+                    self.products[pid] = p
+                continue
+            if key is not None:
+                self.remove(pid)
+            self.add(p)
+            changed += 1
+        for pid in [pid for pid in self.keys if pid not in seen]:
+            self.remove(pid)
+            changed += 1
+        self.version = version
+        return changed
+
+    def _prefix_matches(self, prefix: str, scale: float = 1.0, near: str | None = None) -> dict[str, float]:
+        lo = bisect_left(self.vocab, prefix)
+        hi = bisect_right(self.vocab, prefix + "\U0010ffff")
+        near_grams = trigrams(near or prefix)
+        scores: dict[str, float] = {}
+        for token in self.vocab[lo:hi]:
+            # чем ближе слово к искомому, тем выше: точное совпадение — +1,
+            # "розы" для "роза" — больше, чем "розовые"
+            bonus = 1 if token == (near or prefix) else _similarity(near_grams, trigrams(token))
+            for pid, weight in self.postings[token].items():
+                scores[pid] = max(scores.get(pid, 0), (weight * 2 + bonus) * scale)
+        return scores
+
+    def _similar_terms(self, token: str, grams: set[str]) -> list[tuple[str, float]]:
+        counts: dict[str, int] = {}
+        for g in grams:
+            for word in self.grams.get(g, ()):
+                counts[word] = counts.get(word, 0) + 1
+        out = []
+        for word, shared in counts.items():
+            # верхняя оценка сходства (у слова не меньше shared триграмм)
+            if 2 * shared / (len(grams) + shared) < SEARCH_FUZZY_MIN_SIMILARITY:
+                continue
+            sim = _similarity(grams, trigrams(word))
+            if sim >= SEARCH_FUZZY_MIN_SIMILARITY:
+                out.append((word, sim))
+        return out
+
+    def _token_matches(self, token: str) -> dict[str, float]:
+        scores = self._prefix_matches(token)
+        for word in SEARCH_SYNONYMS.expand(token):
+            # само слово запроса без окончания ("роза" -> "розы") выше
+            # других слов группы ("rose", "장미")
+            own = token.startswith(word) or word.startswith(token)
+            matches = self._prefix_matches(
+                SEARCH_SYNONYMS.stem(word), scale=0.9 if own else 0.8, near=token if own else word
+            )
+            for pid, s in matches.items():
+                scores[pid] = max(scores.get(pid, 0), s)
+        if scores:
+            return scores
+
+        # опечатка: похожие слова каталога и словаря синонимов
+        grams = trigrams(token)
+        similar = heapq.nlargest(
+            SEARCH_FUZZY_TERMS,
+            self._similar_terms(token, grams) + SEARCH_SYNONYMS.similar(token, grams),
+            key=lambda ws: ws[1],
+        )
+        for word, sim in similar:
+            prefixes = {word} | {SEARCH_SYNONYMS.stem(w) for w in SEARCH_SYNONYMS.groups.get(word, ())}
+            if word in SEARCH_SYNONYMS.groups:
+                prefixes.add(SEARCH_SYNONYMS.stem(word))
+            for w in prefixes:
+                for pid, s in self._prefix_matches(w, scale=0.8 * sim).items():
+                    scores[pid] = max(scores.get(pid, 0), s)
+        return scores
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list[dict]:
+        tokens = search_tokens(query[:SEARCH_MAX_QUERY_CHARS])[:SEARCH_MAX_TOKENS]
+        if not tokens:
+            return []
+
+        total: dict[str, float] | None = None
+        for token in tokens:
+            matches = self._token_matches(token)
+            if total is None:
+                total = matches
+            else:
+                total = {pid: total[pid] + s for pid, s in matches.items() if pid in total}
+            if not total:
+                return []
+
+        ranked = heapq.nsmallest(limit, total.items(), key=lambda kv: (-kv[1], self.products[kv[0]]["name"]))
+        return [self.products[pid] for pid, _score in ranked]
+
+
+def search_products(query: str, limit: int = SEARCH_LIMIT) -> list[dict]:
+    catalog = get_catalog()
+    index = current_tenant().search_index
+    with index.lock:
+        if index.version != catalog.version:
+            index.sync(catalog.products, catalog.version)
+        return index.search(query, limit)
+
+
+def set_product_price(product_id: str, price: int) -> bool:
+    return queue_product_write(product_id, "price", int(price))
+
+
+def set_product_available(product_id: str, available: bool) -> bool:
+    return queue_product_write(product_id, "available", bool(available))
+
+
+def set_product_photo(product_id: str, file_id: str) -> bool:
+    return queue_product_write(product_id, "photo_file_id", file_id)
+
+
+def set_product_description(product_id: str, description: str) -> bool:
+    return queue_product_write(product_id, "description", description)
+
+
+# -------------------------
+# cart
+# -------------------------
+# Строка корзины запоминает имя и цену на момент добавления, итог считается
+# инкрементально — экраны корзины не обращаются ни к Sheets, ни к каталогу.
+# Сверка с каталогом — только при оформлении (Cart.revalidate).
+
+class CartLine:
+    __slots__ = ("pid", "name", "price", "qty", "version")
+
+    def __init__(self, pid: str, name: str, price: int, qty: int, version: str):
+        self.pid = pid
+        self.name = name
+        self.price = price
+        self.qty = qty
+        self.version = version
+
+
+class Cart:
+    __slots__ = ("lines", "total")
+
+    def __init__(self):
+        self.lines: Dict[str, CartLine] = {}
+        self.total = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.lines)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def qty(self, pid: str) -> int:
+        line = self.lines.get(pid)
+        return line.qty if line else 0
+
+    def inc(self, product: dict, n: int = 1):
+        pid = product["product_id"]
+        line = self.lines.get(pid)
+        if line is None:
+            line = CartLine(pid, product["name"], product["price"], 0, current_tenant().catalog.version)
+            self.lines[pid] = line
+        line.qty += n
+        self.total += line.price * n
+
+    def dec(self, pid: str):
+        line = self.lines.get(pid)
+        if line is None:
+            return
+        line.qty -= 1
+        self.total -= line.price
+        if line.qty <= 0:
+            del self.lines[pid]
+
+    def clear(self):
+        self.lines.clear()
+        self.total = 0
+
+    def revalidate(self, catalog: CatalogSnapshot) -> list[str]:
+        """
+        Сверяет строки с каталогом; проверяются только строки,
+        добавленные при другой версии каталога. Возвращает список изменений.
+        """
+        changes: list[str] = []
+        for pid, line in list(self.lines.items()):
+            if line.version == catalog.version:
+                continue
+
+            p = catalog.by_id.get(pid)
+            if not p or not p["available"]:
+                changes.append(f"• {line.name} — больше нет в наличии")
+                self.total -= line.price * line.qty
+                del self.lines[pid]
+                continue
+
+            if p["price"] != line.price:
+                changes.append(
+                    f"• {p['name']}: {_fmt_money(line.price)} → {_fmt_money(p['price'])}"
+                )
+                self.total += (p["price"] - line.price) * line.qty
+                line.price = p["price"]
+
+            line.name = p["name"]
+            line.version = catalog.version
+        return changes
+
+    # компактная форма для сохранения: [[pid, name, price, qty, version], ...]
+    def to_compact(self) -> list:
+        return [[l.pid, l.name, l.price, l.qty, l.version] for l in self.lines.values()]
+
+    @classmethod
+    def from_compact(cls, data: list) -> "Cart":
+        cart = cls()
+        for pid, name, price, qty, version in data:
+            cart.lines[pid] = CartLine(pid, name, price, qty, version)
+            cart.total += price * qty
+        return cart
+
+    def __reduce__(self):
+        return (Cart.from_compact, (self.to_compact(),))
+
+
+import uuid
+from datetime import datetime
+
+def load_categories() -> list[str]:
+    rows = get_products()
+    return sorted({r["category"] for r in rows if r["available"]})
+
+# -------------------------
+# helpers: cart text
+# -------------------------
+
+from uuid import uuid4
+
+def append_product_to_sheets(name: str, price: int, category: str, description: str) -> str | None:
+    product_id = f"P{uuid4().hex[:10]}"
+
+    row = [
+        product_id,          # A
+        name,                # B
+        price,               # C
+        "TRUE",              # D available
+        category,            # E
+        "",                  # F photo_file_id
+        description or "",   # G
+    ]
+
+    try:
+        sheets_append("products!A:G", [row])
+        invalidate_catalog()
+        return product_id
+    except Exception:
+        return None
+
+def save_order_to_sheets(
+    user,
+    cart: Cart,
+    kind: str,
+    comment: str,
+    address: str | None = None,
+) -> str | None:
+    items = [f"{line.name} x{line.qty}" for line in cart]
+    total = cart.total
+
+    order_id = new_order_id()
+    created_at = datetime.utcnow().isoformat()
+
+    row = [[
+        order_id,             # A order_id
+        created_at,           # B created_at
+        str(user.id),         # C user_id
+        user.username or "",  # D username
+        "; ".join(items),     # E items
+        total,                # F total_price
+        kind,                 # G type
+        comment or "",        # H comment
+        "",                   # I payment_proof (позже)
+        "waiting_payment",    # J status
+        "",                   # K handled_at
+        "",                   # L handled_by
+        "",                   # M reaction_seconds
+        address or "",        # N address (NEW)
+        encode_order_items(cart),  # O items_json (для аналитики)
+    ]]
+
+    t = current_tenant()
+    try:
+        # архивация переписывает лист orders под этим локом
+        with t.orders_lock:
+            resp = sheets_append("orders!A:O", row, insert_rows=True)
+            updated_range = resp.get("updates", {}).get("updatedRange")
+            row_index = _row_from_range(updated_range)
+            if row_index:
+                t.orders_index.add(order_id, created_at, row_index)
+
+        log.info(
+            f"✅ ORDER APPENDED: order_id={order_id} "
+            f"resp={updated_range}"
+        )
+        return order_id
+
+    except Exception:
+        log.exception(f"❌ ORDER APPEND FAILED: buyer={user.id}")
+        return None
+
+# -------------------------
+# order items: колонка O (items_json)
+# -------------------------
+# E — читаемый текст для сотрудников, O — компактный JSON
+# [[product_id, name, price, qty], ...] для аналитики без разбора строк.
+
+ORDERS_ITEMS_HEADER = "items_json"
+
+
+class OrderItem(NamedTuple):
+    product_id: str
+    name: str
+    price: int
+    qty: int
+
+
+def encode_order_items(cart: Cart) -> str:
+    return json.dumps(
+        [[line.pid, line.name, line.price, line.qty] for line in cart],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+@lru_cache(maxsize=4096)
+def _decode_items_json(cell: str) -> tuple[OrderItem, ...]:
+    return tuple(OrderItem(*item) for item in json.loads(cell))
+
+
+@lru_cache(maxsize=4096)
+def _decode_items_text(cell: str) -> tuple[OrderItem, ...]:
+    # старые заказы: "Rose x2; Peony x1" — без id и цен
+    items = []
+    for part in cell.split("; "):
+        name, sep, qty = part.rpartition(" x")
+        if sep and qty.isdigit():
+            items.append(OrderItem("", name, 0, int(qty)))
+    return tuple(items)
+
+
+def decode_order_items(row: list) -> tuple[OrderItem, ...]:
+    cell = row[14] if len(row) > 14 else ""
+    if cell:
+        try:
+            return _decode_items_json(cell)
+        except (ValueError, TypeError):
+            log.warning(f"⚠️ bad items_json in order {row[0] if row else '?'}")
+    return _decode_items_text(row[4]) if len(row) > 4 and row[4] else ()
+
+
+def ensure_orders_header(rows: list[list[str]] | None = None):
+    if rows is None:
+        rows = sheets_read("orders!O1")
+    if not rows or not rows[0]:
+        sheets_update("orders!O1", [[ORDERS_ITEMS_HEADER]])
+
+
+# -------------------------
+# order index: order_id -> строка, created_at -> строка
+# -------------------------
+# Заказы дописываются в конец листа в порядке времени, поэтому created_at
+# по строкам не убывает: окно "с даты X" — это хвост листа начиная
+# с первой строки >= X, и читать нужно только его (orders!A{n}:O).
+
+class OrdersLock:
+    """
+    orders_lock: потоки процесса и воркеры магазина (flock на файле рядом
+    со снимком каталога) — архивация лидера сдвигает строки листа orders,
+    пока другие воркеры дописывают заказы и пишут в их строки.
+    """
+
+    __slots__ = ("path", "lock", "fd")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd: int | None = None
+
+    def __enter__(self) -> "OrdersLock":
+        self.lock.acquire()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            # без файла — только лок процесса, как при WORKERS=1
+            log.warning(f"⚠️ orders lock file {self.path} unavailable: {e!r}")
+            return self
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            self.lock.release()
+            raise
+        self.fd = fd
+        return self
+
+    def __exit__(self, *exc):
+        fd, self.fd = self.fd, None
+        try:
+            if fd is not None:
+                os.close(fd)  # снимает flock
+        finally:
+            self.lock.release()
+
+
+class OrderIndex:
+    __slots__ = ("rows", "times", "time_rows", "last_row")
+
+    def __init__(self):
+        self.rows: Dict[str, int] = {}
+        self.times: List[str] = []      # created_at (ISO), по возрастанию
+        self.time_rows: List[int] = []  # номер строки для times[i]
+        self.last_row = 1               # последняя известная строка заказа
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, order_id: str, created_at: str, row_index: int):
+        self.rows[order_id] = row_index
+        self.last_row = max(self.last_row, row_index)
+        if not self.times or created_at >= self.times[-1]:
+            self.times.append(created_at)
+            self.time_rows.append(row_index)
+
+    def first_row_since(self, since: datetime) -> int | None:
+        i = bisect_left(self.times, since.isoformat())
+        return self.time_rows[i] if i < len(self.times) else None
+
+
+def new_order_id() -> str:
+    # сортируется по времени: 20261018-142501123-3fa9c1
+    now = datetime.utcnow()
+    return f"{now:%Y%m%d-%H%M%S}{now.microsecond // 1000:03d}-{uuid4().hex[:6]}"
+
+def _row_from_range(a1: str | None) -> int | None:
+    # "orders!A12:N12" -> 12
+    m = re.search(r"![A-Z]+(\d+)", a1 or "")
+    return int(m.group(1)) if m else None
+
+def index_orders(rows: list[list[str]] | None = None):
+    if rows is None:
+        rows = sheets_read("orders!A:B")
+    index = OrderIndex()
+    for idx, row in enumerate(rows, start=1):
+        if idx > 1 and row:
+            index.add(row[0], row[1] if len(row) > 1 else "", idx)
+    current_tenant().orders_index = index
+
+def find_order(order_id: str) -> tuple[int, list] | None:
+    """
+    Точечное чтение одной строки заказа вместо всего листа.
+    Если строки сдвинули руками в таблице — перестраиваем индекс.
+    """
+    replica = replica_ready(current_tenant())
+    if replica is not None:
+        found = replica.find("orders", order_id)
+        if found:
+            return found
+
+    for attempt in range(2):
+        row_index = current_tenant().orders_index.rows.get(order_id)
+        if row_index is None and attempt == 0:
+            index_orders()
+            row_index = current_tenant().orders_index.rows.get(order_id)
+        if row_index is None:
+            return None
+
+        rows = sheets_read(f"orders!A{row_index}:O{row_index}")
+        if rows and rows[0] and rows[0][0] == order_id:
+            return row_index, rows[0]
+
+        index_orders()
+
+    return None
+
+def read_orders_since(since: datetime) -> list[list]:
+    """Строки заказов с created_at >= since — читается только хвост листа."""
+    t = current_tenant()
+    replica = replica_ready(t)
+    if replica is not None:
+        return replica.since("orders", since.isoformat())
+
+    if not t.orders_index:
+        index_orders()
+
+    # индекс знает только заказы этого воркера и прошлого чтения: читаем от
+    # первой строки окна (или от последней известной) до конца листа
+    for attempt in range(2):
+        index = t.orders_index
+        first_row = index.first_row_since(since)
+        start = first_row if first_row is not None else index.last_row
+        rows = sheets_read(f"orders!A{start}:O")
+
+        if start > 1 and not (rows and rows[0] and index.rows.get(rows[0][0]) == start):
+            # строки сдвинула архивация (или правка руками) — индекс устарел
+            if attempt == 0:
+                index_orders()
+                continue
+            rows = sheets_read("orders!A2:O")
+            start = 2
+
+        # дописываем заказы других воркеров, чтобы следующее окно было точным
+        for offset, row in enumerate(rows):
+            if row and row[0] not in index.rows and start + offset > 1:
+                index.add(row[0], row[1] if len(row) > 1 else "", start + offset)
+        break
+
+    cutoff = since.isoformat()
+    return [
+        row for offset, row in enumerate(rows)
+        if start + offset > 1 and len(row) > 1 and str(row[1]) >= cutoff
+    ]
+
+def update_order_cells(order_id: str, cells: dict[str, object]) -> bool:
+    """
+    {"J": "approved", ...} -> одна batchUpdate по строке заказа.
+    Номер строки берется под orders_lock и только проверенный (копия или
+    колонка A строки из индекса): архивация могла уплотнить лист, а индекс
+    этого воркера — устареть.
+    """
+    t = current_tenant()
+    with t.orders_lock:
+        found = find_order(order_id)
+        if found is None:
+            return False
+        row = found[0]
+
+        sheets_batch_update([
+            {"range": f"orders!{col}{row}", "values": [[value]]}
+            for col, value in cells.items()
+        ])
+    return True
+
+# -------------------------
+# orders archive
+# -------------------------
+# Раз в сутки (лидер, JobQueue) закрытые заказы (approved / rejected) старше
+# ORDERS_ARCHIVE_DAYS переезжают в листы orders_YYYY_MM по месяцу создания,
+# а живой лист orders уплотняется. По каждому затронутому месяцу
+# пересчитывается строка в orders_rollup — итоги не теряются.
+# Порядок: сначала запись в архив (повторный запуск не дублирует — id сверяются),
+# потом уплотнение. Если упадет между шагами, следующий запуск доделает.
+
+ORDERS_ROLLUP_SHEET = "orders_rollup"
+ORDERS_ROLLUP_HEADER = ["month", "orders", "approved", "rejected", "revenue_approved", "revenue_total", "updated_at"]
+ORDERS_WIDTH = 15  # A:O
+ORDERS_CLOSED_STATUSES = ("approved", "rejected")
+
+
+def archive_sheet_name(created_at: str) -> str:
+    # "2026-09-14T..." -> "orders_2026_09"
+    return f"orders_{created_at[:4]}_{created_at[5:7]}"
+
+
+def _is_archivable(row: list, cutoff: str) -> bool:
+    created_at = str(row[1]) if len(row) > 1 else ""
+    status = row[9] if len(row) > 9 else ""
+    # created_at — isoformat, строки сравниваются как время
+    return status in ORDERS_CLOSED_STATUSES and bool(created_at) and created_at < cutoff
+
+
+def _rollup_row(month: str, rows: list[list]) -> list:
+    approved = rejected = revenue_approved = revenue_total = 0
+    for row in rows:
+        try:
+            total = int(row[5])
+        except (IndexError, ValueError, TypeError):
+            total = 0
+        status = row[9] if len(row) > 9 else ""
+        revenue_total += total
+        if status == "approved":
+            approved += 1
+            revenue_approved += total
+        elif status == "rejected":
+            rejected += 1
+    return [month, len(rows), approved, rejected, revenue_approved, revenue_total, datetime.utcnow().isoformat()]
+
+
+def update_orders_rollup(sheets: list[str]):
+    created = sheets_add_sheet(ORDERS_ROLLUP_SHEET)
+    if created:
+        sheets_update(f"{ORDERS_ROLLUP_SHEET}!A1", [ORDERS_ROLLUP_HEADER])
+
+    # текущие итоги и все затронутые месяцы — одним batchGet
+    plan = ReadPlan()
+    existing = None if created else plan.add(f"{ORDERS_ROLLUP_SHEET}!A2:A")
+    months = [(f"{sheet[7:11]}-{sheet[12:14]}", plan.add(f"{sheet}!A2:O")) for sheet in sheets]
+    plan.run()
+    row_of = {r[0]: idx for idx, r in enumerate(plan[existing] if existing is not None else [], start=2) if r}
+
+    updates, appends = [], []
+    for month, handle in months:
+        rollup = _rollup_row(month, plan[handle])
+        if month in row_of:
+            updates.append({"range": f"{ORDERS_ROLLUP_SHEET}!A{row_of[month]}:G{row_of[month]}", "values": [rollup]})
+        else:
+            appends.append(rollup)
+
+    if updates:
+        sheets_batch_update(updates)
+    if appends:
+        sheets_append(f"{ORDERS_ROLLUP_SHEET}!A:G", appends)
+
+
+class ArchiveIncomplete(RuntimeError):
+    """Строки уже скопированы в архивные листы, но живой лист не уплотнен."""
+
+    def __init__(self, copied: dict[str, int]):
+        super().__init__(f"orders copied to archive, live sheet not compacted: {copied}")
+        self.copied = copied
+
+
+def archive_orders(days: int = ORDERS_ARCHIVE_DAYS) -> dict[str, int]:
+    """Возвращает {архивный лист: сколько строк перенесено}."""
+    t = current_tenant()
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+
+    rows = sheets_read("orders!A:O", unformatted=True)
+    if len(rows) < 2:
+        return {}
+
+    header = rows[0]
+    moved: dict[str, list] = {}
+    for row in rows[1:]:
+        if row and _is_archivable(row, cutoff):
+            moved.setdefault(archive_sheet_name(str(row[1])), []).append(row)
+    if not moved:
+        return {}
+
+    copied: dict[str, int] = {}
+    try:
+        # 1) в архив — лист orders не меняется, orders_lock не нужен
+        for sheet, archived in sorted(moved.items()):
+            if sheets_add_sheet(sheet):
+                sheets_update(f"{sheet}!A1", [header])
+                present = set()
+            else:
+                present = {r[0] for r in sheets_read(f"{sheet}!A2:A") if r}
+            fresh = [r for r in archived if r[0] not in present]
+            if fresh:
+                sheets_append(f"{sheet}!A:O", fresh)
+            copied[sheet] = len(archived)
+
+        # 2) итоги по месяцам
+        update_orders_rollup(sorted(moved))
+
+        # 3) уплотняем живой лист: оставшиеся строки вверх, хвост — пустыми.
+        # Под локом только перечитать и переписать: за время шагов 1-2 могли
+        # добавиться заказы и смениться статусы
+        archived_ids = {r[0] for archived in moved.values() for r in archived}
+        with t.orders_lock:
+            body = sheets_read("orders!A:O", unformatted=True)[1:]
+            kept = [r for r in body if r and r[0] not in archived_ids]
+            padded = [list(r) + [""] * (ORDERS_WIDTH - len(r)) for r in kept]
+            blanks = [[""] * ORDERS_WIDTH for _ in range(len(body) - len(kept))]
+            sheets_update(f"orders!A2:O{len(body) + 1}", padded + blanks)
+            index_orders()
+    except Exception as e:
+        if copied:
+            # повторный запуск доделает: id в архиве сверяются, дублей не будет
+            raise ArchiveIncomplete(copied) from e
+        raise
+
+    result = {sheet: len(archived) for sheet, archived in moved.items()}
+    log.info(f"🗄 [{t.name}] orders archived: {result}, live rows: {len(kept)}")
+    return result
+
+
+def read_archived_orders(month: str) -> list[list]:
+    """month: "2026-09". Строки архивного листа (без заголовка)."""
+    return sheets_read(f"{archive_sheet_name(month)}!A2:O")
+
+
+def read_orders_rollup() -> dict[str, dict]:
+    """{"2026-09": {"orders": 120, "approved": ..., ...}} по архивным месяцам."""
+    rows = sheets_read(f"{ORDERS_ROLLUP_SHEET}!A2:G")
+    keys = ORDERS_ROLLUP_HEADER[1:6]
+    out = {}
+    for row in rows:
+        if len(row) >= 6:
+            out[row[0]] = {k: int(v) for k, v in zip(keys, row[1:6])}
+    return out
+
+
+# -------------------------
+# order sketches: перцентили времени реакции и суммы заказа
+# -------------------------
+# Среднее время реакции портит один забытый на ночь заказ, поэтому /dash
+# показывает p50/p90/p99. Распределения хранятся t-digest'ами (сотня-другая
+# центроидов на распределение, сливаются без потери точности хвостов)
+# по дням created_at: реакция — всего и по сотруднику (колонка L),
+# сумма заказа — всего.
+#
+# Дни старше ORDER_SKETCH_SETTLE_DAYS (к этому времени заказы обычно
+# разобраны) раз в сутки дописываются лидером в лист orders_sketches,
+# до архивации — так архивные месяцы тоже остаются в статистике. При первом
+# запуске история собирается из архивных листов. Уже сохраненный день
+# пересчитывается, если его заказ разобрали после прошлого запуска
+# (handled_at, колонка K, новее updated_at строк листа). /dash сливает дни окна из
+# листа, а свежие дни досчитывает по строкам заказов, которые и так читает.
+
+ORDER_SKETCH_SHEET = "orders_sketches"
+ORDER_SKETCH_HEADER = ["day", "metric", "staff", "count", "digest", "updated_at"]
+ORDER_SKETCH_SETTLE_DAYS = 2
+TDIGEST_COMPRESSION = 100
+
+
+class TDigest:
+    """Merging t-digest: сжатые центроиды [среднее, вес] + буфер новых значений."""
+
+    __slots__ = ("compression", "centroids", "count", "min", "max", "_buffer")
+
+    def __init__(self, compression: int = TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.centroids: list[list[float]] = []
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer: list[list[float]] = []
+
+    def add(self, value: float, weight: float = 1.0):
+        self._buffer.append([float(value), float(weight)])
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) > self.compression * 5:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        other._compress()
+        if not other.count:
+            return
+        self._buffer.extend([m, w] for m, w in other.centroids)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        items = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = self.count
+
+        merged: list[list[float]] = []
+        before = 0.0  # вес слева от последнего центроида
+        for mean, weight in items:
+            if merged:
+                last = merged[-1]
+                # центроиды у хвостов (q около 0 и 1) остаются мелкими
+                q = (before + (last[1] + weight) / 2) / total
+                if last[1] + weight <= max(1.0, 4 * total * q * (1 - q) / self.compression):
+                    last[1] += weight
+                    last[0] += (mean - last[0]) * weight / last[1]
+                    continue
+                before += last[1]
+            merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q: float) -> float | None:
+        self._compress()
+        cs = self.centroids
+        if not cs:
+            return None
+
+        target = q * self.count
+        cum = 0.0
+        prev_mean, prev_center = self.min, 0.0
+        for mean, weight in cs:
+            center = cum + weight / 2
+            if target < center:
+                span = center - prev_center
+                return prev_mean + (mean - prev_mean) * ((target - prev_center) / span if span else 0)
+            prev_mean, prev_center = mean, center
+            cum += weight
+        span = self.count - prev_center
+        return prev_mean + (self.max - prev_mean) * ((target - prev_center) / span if span else 0)
+
+    def to_json(self) -> str:
+        self._compress()
+        return json.dumps(
+            {"min": self.min, "max": self.max, "c": [[round(m, 2), w] for m, w in self.centroids]},
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, raw: str) -> "TDigest":
+        data = json.loads(raw)
+        d = cls()
+        d.centroids = [[float(m), float(w)] for m, w in data["c"]]
+        d.count = sum(w for _m, w in d.centroids)
+        d.min = float(data["min"])
+        d.max = float(data["max"])
+        return d
+
+
+def sketch_order_rows(rows: list[list], after: str = "", before: str = "9999") -> dict[tuple, TDigest]:
+    """
+    Строки заказов -> {(день, метрика, сотрудник): TDigest} для дней
+    after < день <= before. Сотрудник "" — по всем.
+    """
+    out: dict[tuple, TDigest] = {}
+
+    def feed(key, value):
+        d = out.get(key)
+        if d is None:
+            d = out[key] = TDigest()
+        d.add(value)
+
+    for row in rows:
+        day = str(row[1])[:10] if len(row) > 1 else ""
+        if not day or day <= after or day > before:
+            continue
+        status = row[9] if len(row) > 9 else ""
+        try:
+            if status != "rejected":
+                feed((day, "value", ""), int(row[5]))
+            if len(row) > 12 and str(row[12]) != "":
+                reaction = int(row[12])
+                staff = str(row[11]) if len(row) > 11 else ""
+                feed((day, "reaction", ""), reaction)
+                if staff:
+                    feed((day, "reaction", staff), reaction)
+        except (IndexError, ValueError, TypeError):
+            continue
+    # сжатые заранее: дальше дайджесты только читаются и сливаются
+    for d in out.values():
+        d._compress()
+    return out
+
+
+def _order_sketch_rows() -> list[list]:
+    """Лист orders_sketches с заголовком; листа еще нет — пусто."""
+    # только чтение: лист создает лидер (update_order_sketches)
+    try:
+        return sheets_read(f"{ORDER_SKETCH_SHEET}!A1:F")
+    except Exception as e:
+        # Sheets так отвечает на диапазон несуществующего листа
+        if "Unable to parse range" not in str(e):
+            raise
+        return []
+
+
+def _parse_order_sketches(rows: list[list]) -> dict[tuple, TDigest]:
+    t = current_tenant()
+    sketches = {}
+    for row in rows:
+        # count 0 — ключ, у которого после пересчета дня не осталось заказов
+        if len(row) < 5 or str(row[3]) == "0":
+            continue
+        try:
+            sketches[(row[0], row[1], row[2])] = TDigest.from_json(row[4])
+        except (ValueError, KeyError, TypeError):
+            log.warning(f"⚠️ [{t.name}] bad sketch row: {row[:3]}")
+    return sketches
+
+
+def load_order_sketches(force: bool = False) -> dict[tuple, TDigest]:
+    """Сохраненные дни из листа orders_sketches; кэш на процесс обновляется раз в сутки."""
+    t = current_tenant()
+    today = datetime.utcnow().date().isoformat()
+    if not force and t.order_sketches_day == today:
+        return t.order_sketches
+
+    sketches = _parse_order_sketches(_order_sketch_rows()[1:])
+    t.order_sketches = sketches
+    t.order_sketches_day = today
+    return sketches
+
+
+def _archived_order_rows(days: set[str]) -> list[list]:
+    """Строки архивных листов за месяцы этих дней (какие из них уже есть)."""
+    try:
+        months = set(read_orders_rollup())
+    except Exception:
+        return []  # архива еще не было
+    plan = ReadPlan()
+    for month in sorted({day[:7] for day in days} & months):
+        plan.add(f"{archive_sheet_name(month)}!A2:O")
+    return [row for part in plan.run().results for row in part]
+
+
+def update_order_sketches() -> int:
+    """
+    Дописывает в orders_sketches устоявшиеся дни и пересчитывает сохраненные,
+    заказы которых разобрали после прошлого запуска. Возвращает число
+    записанных строк.
+    """
+    t = current_tenant()
+    sheet = _order_sketch_rows()
+    if not sheet:
+        # листа нет (или он пуст) — создаем с заголовком
+        sheets_add_sheet(ORDER_SKETCH_SHEET)
+        sheets_update(f"{ORDER_SKETCH_SHEET}!A1", [ORDER_SKETCH_HEADER])
+    sheet_rows = sheet[1:]
+    persisted = _parse_order_sketches(sheet_rows)
+    row_of = {(r[0], r[1], r[2]): idx for idx, r in enumerate(sheet_rows, start=2) if len(r) >= 3}
+    last_day = max((key[0] for key in persisted), default="")
+    last_run = max((str(r[5]) for r in sheet_rows if len(r) > 5), default="")
+    now = datetime.utcnow()
+    settled = (now.date() - timedelta(days=ORDER_SKETCH_SETTLE_DAYS)).isoformat()
+
+    changed: set[str] = set()
+    if last_day:
+        # живой лист целиком (раз в сутки, у лидера): новые дни и заказы
+        # уже сохраненных дней, разобранные после прошлого запуска
+        rows = sheets_read("orders!A2:O")
+        if last_run:
+            changed = {
+                str(r[1])[:10] for r in rows
+                if len(r) > 10 and str(r[10]) >= last_run and str(r[1])[:10] <= last_day
+            }
+        # закрытые заказы старых дней уже в архиве — пересчет дня берет и их
+        archive_cutoff = (now.date() - timedelta(days=ORDERS_ARCHIVE_DAYS)).isoformat()
+        old_days = {day for day in changed if day < archive_cutoff}
+        if old_days:
+            by_id = {r[0]: r for r in _archived_order_rows(old_days) if r}
+            by_id.update((r[0], r) for r in rows if r)
+            rows = list(by_id.values())
+    else:
+        # первый запуск: архивные месяцы + весь живой лист
+        rows = []
+        try:
+            months = sorted(read_orders_rollup())
+        except Exception:
+            months = []  # архива еще не было
+        plan = ReadPlan()
+        for month in months:
+            plan.add(f"{archive_sheet_name(month)}!A2:O")
+        plan.add("orders!A2:O")
+        for part in plan.run().results:
+            rows.extend(part)
+
+    fresh = sketch_order_rows(rows, after=last_day, before=settled)
+    redone = sketch_order_rows([r for r in rows if len(r) > 1 and str(r[1])[:10] in changed])
+    # ключ дня, у которого заказов не осталось (например, другой сотрудник) — обнуляем
+    for key in persisted:
+        if key[0] in changed and key not in redone:
+            redone[key] = TDigest()
+    fresh.update(redone)
+    if not fresh:
+        return 0
+
+    stamp = now.isoformat()
+    updates, appends = [], []
+    for (day, metric, staff), d in sorted(fresh.items()):
+        values = [day, metric, staff, int(d.count), d.to_json(), stamp]
+        row = row_of.get((day, metric, staff))
+        if row:
+            updates.append({"range": f"{ORDER_SKETCH_SHEET}!A{row}:F{row}", "values": [values]})
+        else:
+            appends.append(values)
+    if updates:
+        sheets_batch_update(updates)
+    if appends:
+        sheets_append(f"{ORDER_SKETCH_SHEET}!A:F", appends)
+
+    t.order_sketches_day = None  # следующий load_order_sketches перечитает лист
+    log.info(
+        f"📈 [{t.name}] order sketches: +{len(appends)} rows, {len(updates)} recomputed"
+        + (f", days {min(changed)}..{max(changed)} changed" if changed else "")
+    )
+    return len(fresh)
+
+
+def merge_order_sketches(sketches: dict[tuple, TDigest], since: str, metric: str, until: str = "9999") -> dict[str, TDigest]:
+    """{сотрудник: TDigest} за дни since..until ("" — по всем сотрудникам)."""
+    out: dict[str, TDigest] = {}
+    for (day, m, staff), d in sketches.items():
+        if m == metric and since <= day <= until:
+            out.setdefault(staff, TDigest()).merge(d)
+    return out
+
+
+# -------------------------
+# owner reports
+# -------------------------
+# /dash и плановые отчеты владельцу считаются из итогов по дням created_at.
+# Устоявшиеся дни (старше ORDER_SKETCH_SETTLE_DAYS) хранятся в памяти
+# магазина и пересобираются раз в сутки одним чтением окна (статус или
+# реакцию старого заказа могли поменять); свежие дни ("живая дельта",
+# где статусы еще меняются) каждый раз пересчитываются по хвосту листа.
+# Всё, что ходит в Sheets, — через asyncio.to_thread, вне event loop.
+
+DASH_KEEP_DAYS = 35  # месяц + неделя с запасом
+# ежедневный отчет в 09:00 KST, по понедельникам — еще и недельный
+REPORT_HOUR_UTC = int(os.getenv("REPORT_HOUR_UTC", "0"))
+REPORT_WEEKDAY = int(os.getenv("REPORT_WEEKDAY", "0"))
+
+
+class DayStats:
+    __slots__ = ("orders", "revenue", "pending", "approved", "rejected", "product_revenue", "product_names")
+
+    def __init__(self):
+        self.orders = 0
+        self.revenue = 0
+        self.pending = 0
+        self.approved = 0
+        self.rejected = 0
+        self.product_revenue: dict[str, int] = {}
+        self.product_names: dict[str, str] = {}
+
+    def add_row(self, row: list):
+        total = int(row[5])
+        status = row[9]
+
+        self.orders += 1
+        self.revenue += total
+        if status == "pending":
+            self.pending += 1
+        elif status == "approved":
+            self.approved += 1
+        elif status == "rejected":
+            self.rejected += 1
+
+        if status != "rejected":
+            for item in decode_order_items(row):
+                if item.price:
+                    key = item.product_id or item.name
+                    self.product_names[key] = item.name
+                    self.product_revenue[key] = self.product_revenue.get(key, 0) + item.price * item.qty
+
+    def merge(self, other: "DayStats"):
+        self.orders += other.orders
+        self.revenue += other.revenue
+        self.pending += other.pending
+        self.approved += other.approved
+        self.rejected += other.rejected
+        self.product_names.update(other.product_names)
+        for key, amount in other.product_revenue.items():
+            self.product_revenue[key] = self.product_revenue.get(key, 0) + amount
+
+
+def day_stats_from_rows(rows: list[list], after: str = "", before: str = "9999") -> dict[str, DayStats]:
+    """Строки заказов -> {день: DayStats} для дней after < день <= before."""
+    out: dict[str, DayStats] = {}
+    for row in rows:
+        day = str(row[1])[:10] if len(row) > 1 else ""
+        if not day or day <= after or day > before:
+            continue
+        stats = out.get(day) or DayStats()
+        try:
+            stats.add_row(row)
+        except (IndexError, ValueError, TypeError):
+            continue
+        out[day] = stats
+    return out
+
+
+class PeriodStats(NamedTuple):
+    stats: DayStats
+    reaction: dict[str, TDigest]  # сотрудник ("" — все) -> время реакции
+    value: TDigest | None
+
+
+def period_stats(days: dict[str, DayStats], sketches: dict[tuple, TDigest], since: str, until: str = "9999") -> PeriodStats:
+    stats = DayStats()
+    for day, s in days.items():
+        if since <= day <= until:
+            stats.merge(s)
+    return PeriodStats(
+        stats,
+        merge_order_sketches(sketches, since, "reaction", until),
+        merge_order_sketches(sketches, since, "value", until).get(""),
+    )
+
+
+def refresh_dash_state() -> str:
+    """
+    Раз в сутки пересобирает устоявшиеся дни окна — статусы и реакция по
+    старым заказам могли измениться; возвращает последний устоявшийся день.
+    """
+    t = current_tenant()
+    today = datetime.utcnow().date()
+    settled = (today - timedelta(days=ORDER_SKETCH_SETTLE_DAYS)).isoformat()
+    first = (today - timedelta(days=DASH_KEEP_DAYS)).isoformat()
+
+    with t.dash_lock:
+        if t.dash_settled >= settled:
+            return t.dash_settled
+
+        after = (today - timedelta(days=DASH_KEEP_DAYS + 1)).isoformat()
+        rows = read_orders_since(datetime.fromisoformat(first))
+        t.dash_days = day_stats_from_rows(rows, after=after, before=settled)
+
+        # реакция и суммы: дни из orders_sketches (лидер пересчитывает дни
+        # с заново разобранными заказами), дни после них — по строкам
+        sketches = {k: d for k, d in load_order_sketches().items() if k[0] >= first}
+        sketched = max((k[0] for k in sketches), default="")
+        sketches.update(sketch_order_rows(rows, after=max(after, sketched), before=settled))
+        t.dash_sketches = sketches
+        t.dash_settled = settled
+    return settled
+
+
+def dash_data() -> tuple[dict[str, DayStats], dict[tuple, TDigest]]:
+    """Замороженные дни + живая дельта (дни после последнего устоявшегося)."""
+    t = current_tenant()
+    settled = refresh_dash_state()
+    delta = read_orders_since(datetime.fromisoformat(settled) + timedelta(days=1))
+
+    with t.dash_lock:
+        days = dict(t.dash_days)
+        sketches = dict(t.dash_sketches)
+    days.update(day_stats_from_rows(delta, after=settled))
+    sketches.update(sketch_order_rows(delta, after=settled))
+    return days, sketches
+
+
+async def orders_archive_job(context: ContextTypes.DEFAULT_TYPE):
+    if not is_leader():
+        return
+
+    for t in context.job.data:
+        with use_tenant(t):
+            # сначала статистика по дням, потом строки уезжают в архив
+            try:
+                await asyncio.to_thread(update_order_sketches)
+            except Exception as e:
+                log.warning(f"⚠️ [{t.name}] order sketches failed: {e!r}")
+            try:
+                await asyncio.to_thread(archive_orders)
+            except Exception as e:
+                log.warning(f"⚠️ [{t.name}] orders archive failed: {e!r}")
+
+# -------------------------
+# tenants
+# -------------------------
+# Магазин = настройки + собственные кэши (каталог, индекс заказов,
+# реестр пользователей, статистика API). Общие на процесс: клиент Sheets
+# (по одному на поток), пул соединений к Bot API и JobQueue первого бота.
+
+class Tenant:
+    def __init__(
+        self,
+        name: str,
+        bot_token: str,
+        spreadsheet_id: str,
+        owner_chat_id: int,
+        admin_chat_id: int,
+        staff_chat_ids=(),
+        shop_name: str = SHOP_NAME,
+        shop_phone: str = SHOP_PHONE,
+        shop_note: str = SHOP_NOTE,
+        title: str = "FlowerShopKR",
+        catalog_snapshot_path: str = CATALOG_SNAPSHOT_PATH,
+        replica_path: str = REPLICA_PATH,
+    ):
+        self.name = name
+        self.bot_token = bot_token
+        self.spreadsheet_id = spreadsheet_id
+        self.owner_chat_id = int(owner_chat_id)
+        self.admin_chat_id = int(admin_chat_id)
+        self.staff_chat_ids = {int(x) for x in staff_chat_ids}
+        self.shop_name = shop_name
+        self.shop_phone = shop_phone
+        self.shop_note = shop_note
+        self.title = title
+        self.catalog_snapshot_path = catalog_snapshot_path
+        # локальная копия таблицы, открывается при первом обращении (см. replica)
+        self.replica_path = replica_path
+        self.replica: Replica | None = None
+        self.replica_open_lock = threading.Lock()
+
+        self.catalog = CatalogSnapshot([], source="empty", fetched_at=0.0)
+        self.catalog_rows_hash: str | None = None
+        self.catalog_dirty = False
+        # True, когда каталог обновляет фоновая задача; тогда хендлеры
+        # никогда не ходят в Sheets за каталогом сами (кроме правок сотрудников)
+        self.catalog_sync_active = False
+        self.catalog_file_mtime = 0.0
+        # (product_id, поле) -> значение, еще не записанное в Sheets
+        self.product_writes: dict[tuple[str, str], object] = {}
+        # RLock: снимок каталога подменяется под ним (overlay_product_writes)
+        self.product_writes_lock = threading.RLock()
+        self.product_flush_timer: threading.Timer | None = None
+        self.orders_index = OrderIndex()
+        # архивация сдвигает строки листа orders — запись в строку заказа под этим
+        # локом; общий для воркеров магазина (файл рядом со снимком каталога)
+        self.orders_lock = OrdersLock(f"{catalog_snapshot_path}.orders.lock")
+        self.known_users: set[str] | None = None
+        self.users_lock = threading.Lock()
+        self.api_stats: Dict[str, List[int]] = {}
+        # совмещение одинаковых чтений Sheets (см. helpers: sheets api)
+        self.read_flights: dict[tuple, ReadFlight] = {}
+        self.read_flights_lock = threading.Lock()
+        self.sheets_write_gen = 0
+        self.reads_shared = 0
+        self.warm_up_task: asyncio.Task | None = None
+        # дни из листа orders_sketches, перечитываются раз в сутки
+        self.order_sketches: dict[tuple, TDigest] = {}
+        self.order_sketches_day: str | None = None
+        # /dash и отчеты: замороженные дни (см. owner reports)
+        self.dash_days: dict[str, DayStats] = {}
+        self.dash_sketches: dict[tuple, TDigest] = {}
+        self.dash_settled = ""
+        self.dash_lock = threading.Lock()
+        # бот магазина — для сообщений из фоновых задач
+        self.bot: Bot | None = None
+        self.app: Application | None = None
+        # (срок, user_id) оформлений заказа — куча для checkout_sweep_job
+        self.checkout_deadlines: list[tuple[float, int]] = []
+        # user_id -> когда был последний апдейт (порядок LRU) и вытесненные на диск
+        self.sessions: OrderedDict[int, float] = OrderedDict()
+        self.spilled_sessions: set[int] | None = None
+        # ключ оформления -> отправленный заказ (см. submitted checkouts)
+        self.submitted_checkouts: OrderedDict[str, dict] | None = None
+        # догоняет снимок каталога при первом поиске после его смены
+        self.search_index = SearchIndex()
+
+    def __repr__(self) -> str:
+        return f"Tenant({self.name!r})"
+
+
+def _tenant_path(path: str, name: str, default_ext: str) -> str:
+    if len(TENANT_CONFIGS) == 1 or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext or default_ext}"
+
+
+TENANTS = [
+    Tenant(**{
+        "catalog_snapshot_path": _tenant_path(CATALOG_SNAPSHOT_PATH, cfg["name"], ".json"),
+        "replica_path": _tenant_path(REPLICA_PATH, cfg["name"], ".sqlite3"),
+        **cfg,
+    })
+    for cfg in TENANT_CONFIGS
+]
+
+_current_tenant: ContextVar[Optional[Tenant]] = ContextVar("tenant", default=None)
+
+
+def current_tenant() -> Tenant:
+    # вне апдейта (скрипты, бенчмарки) — первый магазин
+    return _current_tenant.get() or TENANTS[0]
+
+
+@contextmanager
+def use_tenant(t: Tenant):
+    token = _current_tenant.set(t)
+    try:
+        yield t
+    finally:
+        _current_tenant.reset(token)
+
+# -------------------------
+# sessions: вытеснение user_data
+# -------------------------
+# user_data (корзина, навигация, id сообщений, черновики сотрудников)
+# живет в памяти, пока пользователь активен. Сессия, простоявшая
+# SESSION_IDLE_SECONDS, или самая давняя сверх SESSION_MAX_RESIDENT
+# сбрасывается на диск (pickle, по файлу на пользователя) и удаляется из
+# памяти; при следующем апдейте пользователя она поднимается до хендлеров,
+# так что для них ничего не меняется. При остановке на диск уходят все
+# сессии — корзины переживают перезапуск.
+#
+# Порядок "кто давно не заходил" — t.sessions (OrderedDict, голова —
+# самая старая), поэтому и отметка на апдейт, и поиск кандидата — O(1).
+
+SESSION_SWEEP_SECONDS = 300
+
+
+def _session_dir(t: "Tenant") -> str:
+    return os.path.join(SESSION_DIR, t.name)
+
+
+def _session_path(t: "Tenant", user_id: int) -> str:
+    return os.path.join(_session_dir(t), f"{user_id}.pickle")
+
+
+def spilled_sessions(t: "Tenant") -> set[int]:
+    # список файлов читается один раз, дальше ведется в памяти
+    if t.spilled_sessions is None:
+        try:
+            names = os.listdir(_session_dir(t))
+        except FileNotFoundError:
+            names = []
+        t.spilled_sessions = {
+            int(n[:-7]) for n in names
+            if n.endswith(".pickle") and n[:-7].lstrip("-").isdigit()
+        }
+    return t.spilled_sessions
+
+
+def restore_session(t: "Tenant", user_id: int):
+    spilled_sessions(t).discard(user_id)
+    path = _session_path(t, user_id)
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.warning(f"⚠️ [{t.name}] session {user_id} not restored: {e!r}")
+        return
+    # Application.user_data — read-only обертка над defaultdict:
+    # обращение по ключу создает словарь пользователя
+    t.app.user_data[user_id].update(data)
+
+
+def evict_session(t: "Tenant", user_id: int) -> bool:
+    t.sessions.pop(user_id, None)
+    data = t.app.user_data.get(user_id)
+    if data:
+        path = _session_path(t, user_id)
+        tmp = f"{path}.tmp"
+        try:
+            os.makedirs(_session_dir(t), exist_ok=True)
+            with open(tmp, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception as e:
+            # не сохранилось — остается в памяти, попробуем в следующий раз
+            log.warning(f"⚠️ [{t.name}] session {user_id} not spilled: {e!r}")
+            t.sessions[user_id] = time.time()
+            return False
+        spilled_sessions(t).add(user_id)
+    if user_id in t.app.user_data:
+        t.app.drop_user_data(user_id)
+    return True
+
+
+def touch_session(t: "Tenant", user_id: int):
+    """Перед обработкой апдейта: сессия — самая свежая; с диска, если была вытеснена."""
+    if t.app is None:
+        return
+    sessions = t.sessions
+    if user_id in sessions:
+        sessions.move_to_end(user_id)
+    elif user_id in spilled_sessions(t):
+        restore_session(t, user_id)
+    sessions[user_id] = time.time()
+
+    while len(sessions) > SESSION_MAX_RESIDENT:
+        if not evict_session(t, next(iter(sessions))):
+            break
+
+
+def evict_idle_sessions(t: "Tenant", idle_seconds: float = SESSION_IDLE_SECONDS) -> int:
+    if t.app is None:
+        return 0
+    cutoff = time.time() - idle_seconds
+    evicted = 0
+    while t.sessions:
+        user_id, seen = next(iter(t.sessions.items()))
+        if seen > cutoff or not evict_session(t, user_id):
+            break
+        evicted += 1
+    return evicted
+
+
+async def session_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    # каждый воркер вытесняет свои сессии: user_data у каждого процесса свое
+    for t in context.job.data:
+        evicted = evict_idle_sessions(t)
+        if evicted:
+            log.info(f"💤 [{t.name}] sessions evicted: {evicted}, resident: {len(t.sessions)}")
+
+
+def process_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def session_report(t: "Tenant") -> dict:
+    sizes = [
+        len(pickle.dumps(t.app.user_data[uid], protocol=pickle.HIGHEST_PROTOCOL))
+        for uid in t.sessions if uid in t.app.user_data
+    ] if t.app else []
+    oldest = next(iter(t.sessions.values()), None)
+    return {
+        "resident": len(t.sessions),
+        "resident_bytes": sum(sizes),
+        "largest_bytes": max(sizes, default=0),
+        "oldest_idle_seconds": int(time.time() - oldest) if oldest else 0,
+        "spilled": len(spilled_sessions(t)),
+        "rss_bytes": process_rss_bytes(),
+    }
+
+
+# -------------------------
+# profiler: /profile
+# -------------------------
+# Семплирующий профайлер живого процесса, без внешних инструментов:
+# поток раз в PROFILE_INTERVAL_SECONDS снимает стеки всех потоков
+# (sys._current_frames) — event loop и пул asyncio.to_thread — и считает
+# свернутые стеки "поток;файл:функция;..." (формат flamegraph.pl / speedscope).
+# Кадры ожидания (цикл стоит в select, поток пула ждет задачу) не пишутся,
+# только считаются. Пока профиль не идет, потока нет и стоимость нулевая.
+# Профиль — на весь процесс (все магазины), поэтому один на процесс.
+
+PROFILE_INTERVAL_SECONDS = 0.005
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 12
+# (файл, функция) верхнего кадра, когда поток ничего не делает
+PROFILE_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+}
+
+_profiler: "SamplingProfiler | None" = None
+
+
+@lru_cache(maxsize=8192)
+def _frame_label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{os.path.basename(code.co_filename)}:{name}"
+
+
+@lru_cache(maxsize=256)
+def _thread_label(name: str) -> str:
+    # asyncio_0, asyncio_1, ... — один пул
+    return re.sub(r"[_-]\d+$", "", name).replace(";", ":") or "thread"
+
+
+class SamplingProfiler:
+    __slots__ = ("interval", "stacks", "busy", "idle", "ticks", "started", "stopped", "thread", "done")
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks: dict[str, int] = {}
+        self.busy = 0
+        self.idle = 0
+        self.ticks = 0
+        self.started = 0.0
+        self.stopped = 0.0
+        self.thread: threading.Thread | None = None
+        self.done = threading.Event()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.stopped = time.perf_counter()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.done.wait(self.interval):
+            names = {th.ident: th.name for th in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._sample(names.get(ident, "thread"), frame)
+            self.ticks += 1
+
+    def _sample(self, thread: str, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in PROFILE_IDLE_FRAMES:
+            self.idle += 1
+            return
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        labels.append(_thread_label(thread))
+        key = ";".join(reversed(labels))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.busy += 1
+
+    def folded(self) -> bytes:
+        lines = [f"{stack} {n}" for stack, n in sorted(self.stacks.items(), key=lambda kv: -kv[1])]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def top(self, n: int = PROFILE_TOP) -> tuple[list[tuple[str, int]], list[tuple[str, int]]]:
+        """(собственное время, включая вызовы) — по числу занятых семплов."""
+        own: dict[str, int] = {}
+        total: dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for label in set(frames):
+                total[label] = total.get(label, 0) + count
+        by_count = lambda d: sorted(d.items(), key=lambda kv: -kv[1])[:n]
+        return by_count(own), by_count(total)
+
+
+def profile_report_text(profiler: SamplingProfiler) -> str:
+    seconds = profiler.stopped - profiler.started
+    busy = profiler.busy or 1
+    own, total = profiler.top()
+
+    def rows(items):
+        return "\n".join(
+            f"• {100 * n / busy:.1f}% <code>{html.escape(label)}</code>" for label, n in items
+        ) or "—"
+
+    return (
+        f"🔥 <b>Профиль за {seconds:.0f} с</b> (воркер {WORKER_INDEX})\n"
+        f"Семплов: {profiler.busy} в работе, {profiler.idle} в ожидании "
+        f"({profiler.ticks} снимков по {profiler.interval * 1000:.0f} мс)\n\n"
+        f"<b>Собственное время</b>\n{rows(own)}\n\n"
+        f"<b>Включая вызовы</b>\n{rows(total)}"
+    )
+
+
+def kb_staff_order(order_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Принять", callback_data=f"staff:approve:{order_id}"),
+            InlineKeyboardButton("❌ Отклонить", callback_data=f"staff:reject:{order_id}"),
+        ]
+    ])
+
+
+
+
+def set_waiting_photo(context: ContextTypes.DEFAULT_TYPE, product_id: str):
+    context.user_data["waiting_photo_for"] = product_id
+
+def pop_waiting_photo(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    return context.user_data.pop("waiting_photo_for", None)
+
+def cart_total(cart: Cart) -> int:
+    return cart.total
+
+def cart_text(cart: Cart) -> str:
+    if not cart:
+        return "Корзина пустая."
+
+    lines: List[str] = []
+    for line in cart:
+        lines.append(
+            f"• {line.name} × {line.qty} = {_fmt_money(line.price * line.qty)}"
+        )
+
+    lines.append("")
+    lines.append(f"Итого: {_fmt_money(cart_total(cart))}")
+    return "\n".join(lines)
+
+
+# -------------------------
+# "ONE WINDOW" UI: clear & track bot messages
+# -------------------------
+async def clear_ui(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
 ):
@@ -407,15 +3125,16 @@ def kb_home() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("ℹ️ Как заказать", callback_data="home:help")],
     ])
 
-def kb_checkout_send() -> InlineKeyboardMarkup:
+def kb_checkout_send(key: str) -> InlineKeyboardMarkup:
+    # ключ оформления в кнопке: повторное нажатие узнается даже без user_data
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📤 Отправить заказ", callback_data="checkout:final_send")],
+        [InlineKeyboardButton("📤 Отправить заказ", callback_data=f"checkout:final_send:{key}")],
         [InlineKeyboardButton("❌ Отмена", callback_data="checkout:cancel")],
     ])
 
 
 def kb_products(category: str) -> InlineKeyboardMarkup:
-    products = read_products_from_sheets()
+    products = get_products()
 
     rows = []
     for p in products:
@@ -427,7 +3146,7 @@ def kb_products(category: str) -> InlineKeyboardMarkup:
         rows.append([
             InlineKeyboardButton(
                 f"{p['name']} — {_fmt_money(p['price'])}",
-                callback_data=f"prod:{p['product_id']}",
+                callback_data=f"prod:{product_ref(p['product_id'])}",
             )
         ])
 
@@ -442,8 +3161,8 @@ def kb_products(category: str) -> InlineKeyboardMarkup:
 def kb_product(pid: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("➖", callback_data=f"cart:dec:{pid}"),
-            InlineKeyboardButton("➕ Добавить", callback_data=f"cart:inc:{pid}"),
+            InlineKeyboardButton("➖", callback_data=f"cart:dec:{product_ref(pid)}"),
+            InlineKeyboardButton("➕ Добавить", callback_data=f"cart:inc:{product_ref(pid)}"),
         ],
         [
             InlineKeyboardButton("🧺 Корзина", callback_data="nav:cart"),
@@ -504,7 +3223,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -------------------------
 def home_text() -> str:
     return (
-        "🌸✨ <b>FlowerShopKR</b> ✨🌸\n\n"
+        f"🌸✨ <b>{current_tenant().title}</b> ✨🌸\n\n"
         "Премиальные букеты и авторские композиции\n"
         "для особых моментов 💐\n\n"
         "🚚 Доставка и самовывоз\n"
@@ -529,7 +3248,7 @@ async def render_categories(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     nav = _get_nav(context)
     nav["screen"] = "categories"
 
-    products = read_products_from_sheets()
+    products = get_products()
     categories = get_categories_from_products(products)
 
     await clear_ui(context, chat_id)
@@ -543,7 +3262,7 @@ async def render_categories(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         return
 
     rows = [
-        [InlineKeyboardButton(cat, callback_data=f"cat:{cat}")]
+        [InlineKeyboardButton(cat, callback_data=f"cat:{category_ref(cat)}")]
         for cat in categories
     ]
     rows.append([InlineKeyboardButton("🏠 Домой", callback_data="nav:home")])
@@ -586,7 +3305,7 @@ async def send_category_preview(
     одно фото (если 1), иначе ничего.
     """
     items = [
-        p for p in read_products_from_sheets()
+        p for p in get_products()
         if p["category"] == category and p["available"]
     ]
 
@@ -633,7 +3352,7 @@ async def render_product_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
     nav["last_pid"] = pid
 
     cart = _get_cart(context)
-    qty = cart.get(pid, 0)
+    qty = cart.qty(pid)
 
     desc = p.get("description")
     desc_block = f"\n\n{desc}" if desc else ""
@@ -665,7 +3384,11 @@ async def render_product_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         
     track_msg(context, msg.message_id)
 
-async def render_cart(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+async def render_cart(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    notice: str | None = None,
+):
     nav = _get_nav(context)
     nav["screen"] = "cart"
     cart = _get_cart(context)
@@ -673,6 +3396,8 @@ async def render_cart(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     await clear_ui(context, chat_id)
 
     text = "🧺 <b>Корзина</b>\n\n" + cart_text(cart)
+    if notice:
+        text = f"{notice}\n\n{text}"
     m = await context.bot.send_message(
         chat_id=chat_id,
         text=text,
@@ -681,538 +3406,1048 @@ async def render_cart(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     )
     track_msg(context, m.message_id)
 
-async def render_help(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    nav = _get_nav(context)
-    nav["screen"] = "help"
+async def render_help(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    nav = _get_nav(context)
+    nav["screen"] = "help"
+
+    await clear_ui(context, chat_id)
+
+    text = (
+        "ℹ️ <b>Как заказать</b>\n\n"
+        "1) Откройте каталог\n"
+        "2) Выберите букет/композицию и добавьте в корзину\n"
+        "3) Оформите заказ (самовывоз/доставка)\n\n"
+        "После отправки заказа мы свяжемся для подтверждения.\n\n"
+        f"Контакт: {current_tenant().shop_phone}"
+    )
+    m = await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb_home(),
+    )
+    track_msg(context, m.message_id)
+
+async def render_product_list(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    category: str,
+):
+    nav = _get_nav(context)
+    nav["screen"] = "product_list"
+    nav["last_category"] = category
+
+    await clear_ui(context, chat_id)
+
+    msg = await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"📦 <b>{category}</b>\nВыберите позицию:",
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb_products(category),
+    )
+    track_msg(context, msg.message_id)
+
+# -------------------------
+# /start
+# -------------------------
+async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    # регистрация не должна задерживать первый экран (особенно сразу после деплоя)
+    context.application.create_task(asyncio.to_thread(register_user_if_new, user))
+
+    chat_id = update.effective_chat.id
+
+    # t.me/<bot>?start=p_<product_id> — ссылка из inline-поиска
+    payload = context.args[0] if context.args else ""
+    if payload.startswith("p_") and get_product_by_id(payload[2:]):
+        await render_product_card(context, chat_id, payload[2:])
+        return
+
+    await render_home(context, chat_id)
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    query = " ".join(context.args or [])
+
+    await clear_ui(context, chat_id)
+
+    if not query:
+        m = await context.bot.send_message(
+            chat_id=chat_id,
+            text="🔎 Напишите, что ищете: <code>/search розы</code>",
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb_home(),
+        )
+        track_msg(context, m.message_id)
+        return
+
+    found = search_products(query, limit=20)
+    rows = [
+        [InlineKeyboardButton(f"{p['name']} — {_fmt_money(p['price'])}", callback_data=f"prod:{product_ref(p['product_id'])}")]
+        for p in found
+    ]
+    rows.append([InlineKeyboardButton("🏠 Домой", callback_data="nav:home")])
+
+    m = await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f"🔎 <b>{html.escape(query)}</b>: найдено {len(found)}"
+            if found else f"🔎 По запросу <b>{html.escape(query)}</b> ничего не нашлось."
+        ),
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(rows),
+    )
+    track_msg(context, m.message_id)
+
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    if not iq:
+        return
+
+    query = iq.query.strip()
+    offset = int(iq.offset) if iq.offset.isdigit() else 0
+    # пустой запрос — показываем начало витрины
+    found = search_products(query) if query else [p for p in get_products() if p["available"]][:SEARCH_LIMIT]
+    page = found[offset:offset + 20]
+
+    results = []
+    for p in page:
+        title = f"{p['name']} — {_fmt_money(p['price'])}"
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("🛒 Открыть в боте", url=f"https://t.me/{context.bot.username}?start=p_{p['product_id']}")
+        ]])
+        if p.get("photo_file_id"):
+            results.append(InlineQueryResultCachedPhoto(
+                id=p["product_id"],
+                photo_file_id=p["photo_file_id"],
+                title=title,
+                description=p["category"],
+                caption=f"🌸 {title}",
+                reply_markup=markup,
+            ))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=p["product_id"],
+                title=title,
+                description=p["category"],
+                input_message_content=InputTextMessageContent(f"🌸 {title}"),
+                reply_markup=markup,
+            ))
+
+    next_offset = str(offset + len(page)) if offset + len(page) < len(found) else ""
+    await iq.answer(results, cache_time=30, next_offset=next_offset)
+
+async def apistats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id != current_tenant().owner_chat_id:
+        return
+
+    api_stats = current_tenant().api_stats
+    if not api_stats:
+        await context.bot.send_message(chat_id=chat_id, text="📈 Вызовов API пока нет.")
+        return
+
+    lines = ["📈 <b>API на один апдейт</b> (среднее: Sheets чтение/запись, Bot API)\n"]
+    for label, (n, reads, writes, bot) in sorted(api_stats.items(), key=lambda kv: -kv[1][1]):
+        lines.append(
+            f"• <code>{label}</code> ×{n}: "
+            f"{reads / n:.1f} / {writes / n:.1f}, bot {bot / n:.1f}"
+        )
+    shared = current_tenant().reads_shared
+    if shared:
+        lines.append(f"\nСовмещено одинаковых чтений Sheets: {shared}")
+    replica = replica_ready(current_tenant())
+    if replica is not None:
+        rows = ", ".join(f"{sheet} {n}" for sheet, n in sorted(replica.stats().items()))
+        age = time.time() - replica.synced_at()
+        lines.append(f"Локальная копия: {rows}; сверена {_fmt_duration(age)} назад")
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="\n".join(lines),
+        parse_mode=ParseMode.HTML,
+    )
+
+async def sessions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id != current_tenant().owner_chat_id:
+        return
+
+    r = session_report(current_tenant())
+    mb = 1024 * 1024
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "🧠 <b>Сессии</b> (этот процесс)\n\n"
+            f"• В памяти: <b>{r['resident']}</b> (лимит {SESSION_MAX_RESIDENT}), "
+            f"{r['resident_bytes'] / 1024:.0f} КБ, крупнейшая {r['largest_bytes'] / 1024:.1f} КБ\n"
+            f"• Самая давняя: {_fmt_duration(r['oldest_idle_seconds'])} без активности "
+            f"(вытеснение через {_fmt_duration(SESSION_IDLE_SECONDS)})\n"
+            f"• На диске: <b>{r['spilled']}</b>\n"
+            f"• RSS процесса: {r['rss_bytes'] / mb:.0f} МБ"
+        ),
+        parse_mode=ParseMode.HTML,
+    )
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _profiler
+    chat_id = update.effective_chat.id
+
+    if chat_id != current_tenant().owner_chat_id:
+        return
+
+    args = context.args or []
+    seconds = int(args[0]) if args and args[0].isdigit() else PROFILE_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if _profiler is not None:
+        await context.bot.send_message(chat_id=chat_id, text="⏱ Профиль уже снимается, дождитесь результата.")
+        return
+
+    _profiler = profiler = SamplingProfiler()
+    profiler.start()
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"⏱ Снимаю профиль {seconds} с (воркер {WORKER_INDEX})…",
+    )
+
+    async def finish():
+        global _profiler
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+            _profiler = None
+
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=profile_report_text(profiler),
+            parse_mode=ParseMode.HTML,
+        )
+        if profiler.stacks:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=profiler.folded(),
+                filename=f"profile-w{WORKER_INDEX}-{datetime.utcnow():%Y%m%d-%H%M%S}.folded",
+                caption="🔥 Свернутые стеки: flamegraph.pl или speedscope.app",
+            )
+
+    # не держим хендлер: апдейты магазина идут по одному, профиль их не должен ждать
+    context.application.create_task(finish())
+
+async def archive_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id != current_tenant().owner_chat_id:
+        return
+
+    # не держим хендлер: апдейты магазина идут по одному, архивация — десятки вызовов Sheets
+    context.application.create_task(_archive_and_report(context, chat_id))
+
+async def _archive_and_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    try:
+        moved = await asyncio.to_thread(archive_orders)
+    except ArchiveIncomplete as e:
+        log.exception("❌ orders archive interrupted")
+        sheets = ", ".join(f"{sheet}: {n}" for sheet, n in sorted(e.copied.items()))
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=(
+                f"⚠️ Архивация прервана: заказы скопированы в архив ({sheets}), "
+                "но еще не удалены из листа orders. Повторите /archive — "
+                "дублей в архиве не будет."
+            ),
+        )
+        return
+    except Exception:
+        log.exception("❌ orders archive failed")
+        await context.bot.send_message(chat_id=chat_id, text="❌ Архивация не удалась, лист orders не изменен.")
+        return
+
+    if not moved:
+        text = f"🗄 Нечего архивировать: закрытых заказов старше {ORDERS_ARCHIVE_DAYS} дн. нет."
+    else:
+        text = "🗄 <b>Заказы перенесены в архив</b>\n" + "\n".join(
+            f"• {sheet}: {n}" for sheet, n in sorted(moved.items())
+        )
+    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+
+def _fmt_duration(seconds: float) -> str:
+    if seconds < 60:
+        return "<1 мин"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+def _fmt_percentiles(digest: TDigest | None, fmt) -> str:
+    if digest is None or not digest.count:
+        return "нет данных"
+    values = " / ".join(fmt(digest.quantile(q)) for q in (0.5, 0.9, 0.99))
+    return f"<b>{values}</b> (n={int(digest.count)})"
+
+
+def _top_products_text(stats: DayStats, limit: int = 5) -> str:
+    top = sorted(stats.product_revenue.items(), key=lambda kv: -kv[1])[:limit]
+    return "\n".join(
+        f"• {html.escape(stats.product_names[key])}: <b>{_fmt_money(amount)}</b>" for key, amount in top
+    )
+
+
+def dash_text(days: dict[str, DayStats], sketches: dict[tuple, TDigest]) -> str | None:
+    now = datetime.utcnow()
+    today = now.date().isoformat()
+    week_from = (now - timedelta(days=6)).date().isoformat()  # 7 дней вместе с сегодняшним
+    month_from = now.replace(day=1).date().isoformat()
+    window_from = min(week_from, month_from)
+
+    window = period_stats(days, sketches, window_from)
+    if not window.stats.orders:
+        return None
+    week = period_stats(days, sketches, week_from)
+    month = period_stats(days, sketches, month_from)
+
+    text = (
+        "📊 <b>Дашборд владельца</b>\n\n"
+        "💰 <b>Выручка</b>\n"
+        f"• Сегодня: <b>{_fmt_money(period_stats(days, {}, today).stats.revenue)}</b>\n"
+        f"• За 7 дней: <b>{_fmt_money(week.stats.revenue)}</b>\n"
+        f"• За месяц: <b>{_fmt_money(month.stats.revenue)}</b>\n\n"
+        f"📦 <b>Статусы заказов</b> (с {datetime.fromisoformat(window_from):%d.%m})\n"
+        f"• В ожидании: <b>{window.stats.pending}</b>\n"
+        f"• Приняты: <b>{window.stats.approved}</b>\n"
+        f"• Отклонены: <b>{window.stats.rejected}</b>\n\n"
+        "⏱ <b>Время реакции</b> (p50 / p90 / p99)\n"
+        f"• За 7 дней: {_fmt_percentiles(week.reaction.get(''), _fmt_duration)}\n"
+        f"• За месяц: {_fmt_percentiles(month.reaction.get(''), _fmt_duration)}"
+    )
+
+    staff = sorted(
+        ((k, d) for k, d in month.reaction.items() if k),
+        key=lambda kv: -kv[1].count,
+    )[:5]
+    if staff:
+        text += "\n\n👥 <b>Реакция по сотрудникам за месяц</b>\n" + "\n".join(
+            f"• <code>{k}</code>: {_fmt_percentiles(d, _fmt_duration)}" for k, d in staff
+        )
+
+    if month.value:
+        text += (
+            "\n\n🧾 <b>Сумма заказа за месяц</b> (p50 / p90 / p99)\n"
+            f"• {_fmt_percentiles(month.value, lambda v: _fmt_money(round(v)))}"
+        )
+
+    if month.stats.product_revenue:
+        text += "\n\n🏆 <b>Топ товаров за месяц</b>\n" + _top_products_text(month.stats)
+
+    return text
+
+
+def period_report_text(title: str, p: PeriodStats) -> str:
+    s = p.stats
+    text = (
+        f"🗓 <b>{title}</b>\n\n"
+        f"• Заказов: <b>{s.orders}</b> (приняты {s.approved}, отклонены {s.rejected})\n"
+        f"• Выручка: <b>{_fmt_money(s.revenue)}</b>\n"
+        f"• Реакция p50 / p90 / p99: {_fmt_percentiles(p.reaction.get(''), _fmt_duration)}\n"
+        f"• Сумма заказа p50 / p90 / p99: {_fmt_percentiles(p.value, lambda v: _fmt_money(round(v)))}"
+    )
+    if s.product_revenue:
+        text += "\n\n🏆 <b>Топ товаров</b>\n" + _top_products_text(s, 3)
+    return text
+
+
+def owner_report_text(weekly: bool) -> str:
+    days, sketches = dash_data()
+    yesterday = datetime.utcnow().date() - timedelta(days=1)
+
+    text = period_report_text(
+        f"Отчет за {yesterday:%d.%m}",
+        period_stats(days, sketches, yesterday.isoformat(), yesterday.isoformat()),
+    )
+    if weekly:
+        week_from = yesterday - timedelta(days=6)
+        text += "\n\n" + period_report_text(
+            f"Неделя {week_from:%d.%m}–{yesterday:%d.%m}",
+            period_stats(days, sketches, week_from.isoformat(), yesterday.isoformat()),
+        )
+    return text
+
+
+async def owner_report_job(context: ContextTypes.DEFAULT_TYPE):
+    if not is_leader():
+        return
+
+    weekly = datetime.utcnow().weekday() == REPORT_WEEKDAY
+    for t in context.job.data:
+        with use_tenant(t):
+            try:
+                text = await asyncio.to_thread(owner_report_text, weekly)
+                await (t.bot or context.bot).send_message(
+                    chat_id=t.owner_chat_id,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                )
+            except Exception as e:
+                log.warning(f"⚠️ [{t.name}] owner report failed: {e!r}")
+
+
+async def dash_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id != current_tenant().owner_chat_id:
+        return
+
+    # замороженные дни из памяти + хвост листа за последние дни
+    days, sketches = await asyncio.to_thread(dash_data)
+    text = await asyncio.to_thread(dash_text, days, sketches)
+    if text is None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="📊 Дашборд\n\nЗаказов за период нет.",
+        )
+        return
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        parse_mode=ParseMode.HTML,
+    )
+
+# -------------------------
+# чекаут
+# -------------------------
+# Оформление — конечный автомат. Состояние — user_data["checkout"]:
+# шаг, срок (expires_at) и собранные данные. Каждый шаг описан в
+# CHECKOUT_STEPS: таймаут, как (пере)спросить и как принять текст;
+# ответ покупателя диспетчеризуется одним поиском по шагу.
+#
+# Переход (checkout_enter) продлевает срок и кладет его в кучу сроков
+# магазина. Брошенное оформление сбрасывается лениво (checkout_state при
+# следующем апдейте) и фоновой задачей checkout_sweep_job, которая снимает
+# с кучи истекшие сроки: состояние не копится, покупатель получает
+# сообщение, корзина остается.
+
+class CheckoutStep(NamedTuple):
+    timeout: int
+    prompt: Callable       # async (context, chat_id, checkout): задать вопрос шага
+    on_text: Callable | None  # async (update, context, checkout, text); None — ждем кнопку / фото
+
+
+def checkout_state(context: ContextTypes.DEFAULT_TYPE) -> dict | None:
+    """Текущее оформление или None (нет или истекло — тогда сбрасывается)."""
+    checkout = context.user_data.get("checkout")
+    if checkout is None:
+        return None
+    if checkout["expires_at"] <= time.time():
+        context.user_data.pop("checkout", None)
+        return None
+    return checkout
+
+
+async def checkout_enter(context: ContextTypes.DEFAULT_TYPE, chat_id: int, step: str):
+    checkout = context.user_data["checkout"]
+    checkout["step"] = step
+    checkout["expires_at"] = time.time() + CHECKOUT_STEPS[step].timeout
+    heapq.heappush(current_tenant().checkout_deadlines, (checkout["expires_at"], checkout["user_id"]))
+    await CHECKOUT_STEPS[step].prompt(context, chat_id, checkout)
+
+
+async def checkout_begin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
+    # key — ключ идемпотентности отправки (см. submitted checkouts)
+    context.user_data["checkout"] = {"chat_id": chat_id, "user_id": user_id, "key": uuid4().hex[:16]}
+    await checkout_enter(context, chat_id, "ask_name")
 
-    await clear_ui(context, chat_id)
 
-    text = (
-        "ℹ️ <b>Как заказать</b>\n\n"
-        "1) Откройте каталог\n"
-        "2) Выберите букет/композицию и добавьте в корзину\n"
-        "3) Оформите заказ (самовывоз/доставка)\n\n"
-        "После отправки заказа мы свяжемся для подтверждения.\n\n"
-        f"Контакт: {SHOP_PHONE}"
+async def checkout_expired(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    await render_cart(
+        context,
+        chat_id,
+        notice="⌛ <b>Оформление прервано</b>\nКорзина сохранена — начните заново.",
     )
+
+
+async def _ask(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, reply_markup, parse_mode=ParseMode.HTML):
+    await clear_ui(context, chat_id)
     m = await context.bot.send_message(
         chat_id=chat_id,
         text=text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=kb_home(),
+        parse_mode=parse_mode,
+        reply_markup=reply_markup,
     )
     track_msg(context, m.message_id)
+    return m
 
-async def render_product_list(
-    context: ContextTypes.DEFAULT_TYPE,
-    chat_id: int,
-    category: str,
-):
-    nav = _get_nav(context)
-    nav["screen"] = "product_list"
-    nav["last_category"] = category
 
-    await clear_ui(context, chat_id)
+def _checkout_preview_text(context: ContextTypes.DEFAULT_TYPE, checkout: dict) -> str:
+    kind = checkout.get("type", "pickup")
+    return build_checkout_preview(
+        cart=_get_cart(context),
+        kind_label="Самовывоз" if kind == "pickup" else "Доставка",
+        comment=checkout.get("comment", ""),
+        address=checkout.get("address"),
+    )
 
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"📦 <b>{category}</b>\nВыберите позицию:",
-        parse_mode=ParseMode.HTML,
-        reply_markup=kb_products(category),
+
+# --- вопросы шагов ---
+
+async def _prompt_name(context, chat_id, checkout):
+    await _ask(
+        context, chat_id,
+        "✍️ <b>Как вас зовут?</b>\n\n"
+        "Введите ваше имя и фамилию ⬇️",
+        ForceReply(selective=True),
     )
-    track_msg(context, msg.message_id)
 
-# -------------------------
-# /start
-# -------------------------
-async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    register_user_if_new(user)
 
-    chat_id = update.effective_chat.id
-    await render_home(context, chat_id)
+async def _prompt_phone(context, chat_id, checkout):
+    await _ask(
+        context, chat_id,
+        "📞 <b>Ваш номер телефона</b>\n\n"
+        "Введите номер для связи ⬇️",
+        ForceReply(selective=True),
+    )
 
-async def dash_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
 
-    if chat_id != OWNER_CHAT_ID_INT:
-        return
+async def _prompt_type(context, chat_id, checkout):
+    await _ask(context, chat_id, "🚚 <b>Выберите способ получения:</b>", kb_checkout_pickup_delivery())
 
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="orders!A:N",
-    ).execute()
+async def _prompt_address(context, chat_id, checkout):
+    await _ask(
+        context, chat_id,
+        "📍 <b>Укажите адрес доставки</b>\n\n"
+        "Введите адрес <b>на корейском языке</b>.\n"
+        "Это нужно для правильной навигации курьера ⬇️",
+        ForceReply(selective=True),
+    )
 
-    rows = result.get("values", [])
-    if len(rows) < 2:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="📊 Дашборд\n\nЗаказов пока нет.",
-        )
-        return
 
-    now = datetime.utcnow()
-    today = now.date()
-    week_ago = now - timedelta(days=7)
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+async def _prompt_comment(context, chat_id, checkout):
+    hint = (
+        "• Например: удобное время доставки"
+        if checkout.get("type") == "delivery"
+        else "• Укажите удобное время самовывоза"
+    )
+    await _ask(
+        context, chat_id,
+        "✍️ Напишите комментарий к заказу.\n\n"
+        f"{hint}\n\n"
+        "⬇️ Ответьте на это сообщение",
+        ForceReply(selective=True),
+        parse_mode=None,
+    )
 
-    revenue_today = 0
-    revenue_week = 0
-    revenue_month = 0
 
-    pending = approved = rejected = 0
-    reaction_times = []
+async def _prompt_preview(context, chat_id, checkout):
+    await _ask(context, chat_id, _checkout_preview_text(context, checkout), kb_checkout_preview())
 
-    for row in rows[1:]:
-        try:
-            created_at = datetime.fromisoformat(row[1])
-            total = int(row[5])
-            status = row[9]
-            reaction_seconds = row[12] if len(row) > 12 else ""
 
-        except Exception:
-            continue
+async def _prompt_wait_photo(context, chat_id, checkout):
+    m = await _ask(
+        context, chat_id,
+        "📎 <b>Прикрепите фото оплаты</b>\n\n"
+        "Фото нужно отправить <b>ответом на это сообщение</b>.\n"
+        "Нажмите 📎 внизу экрана ⬇️",
+        ForceReply(selective=True),
+    )
+    checkout["photo_reply_to"] = m.message_id
 
-        if created_at.date() == today:
-            revenue_today += total
 
-        if created_at >= week_ago:
-            revenue_week += total
+async def _prompt_ready(context, chat_id, checkout):
+    await _ask(
+        context, chat_id,
+        "✅ <b>Фото получено</b>\n\n"
+        "Теперь вы можете отправить заказ ⬇️\n\n"
+        + _checkout_preview_text(context, checkout),
+        kb_checkout_send(checkout["key"]),
+    )
 
-        if created_at >= month_start:
-            revenue_month += total
 
-        if status == "pending":
-            pending += 1
-        elif status == "approved":
-            approved += 1
-        elif status == "rejected":
-            rejected += 1
+# --- ответы текстом ---
 
-        if reaction_seconds:
-            try:
-                reaction_times.append(int(reaction_seconds))
-            except Exception:
-                pass
+async def _on_name(update, context, checkout, text):
+    if not text:
+        await update.message.reply_text("❌ Пожалуйста, введите имя.")
+        return
+    checkout["real_name"] = text
+    await checkout_enter(context, update.message.chat_id, "ask_phone")
 
-    avg_reaction_min = (
-        sum(reaction_times) / len(reaction_times) / 60
-        if reaction_times else 0
-    )
 
-    text = (
-        "📊 <b>Дашборд владельца</b>\n\n"
-        "💰 <b>Выручка</b>\n"
-        f"• Сегодня: <b>{_fmt_money(revenue_today)}</b>\n"
-        f"• За 7 дней: <b>{_fmt_money(revenue_week)}</b>\n"
-        f"• За месяц: <b>{_fmt_money(revenue_month)}</b>\n\n"
-        "📦 <b>Статусы заказов</b>\n"
-        f"• В ожидании: <b>{pending}</b>\n"
-        f"• Приняты: <b>{approved}</b>\n"
-        f"• Отклонены: <b>{rejected}</b>\n\n"
-        "⏱ <b>Среднее время реакции</b>\n"
-        f"• {avg_reaction_min:.1f} мин"
-    )
+async def _on_phone(update, context, checkout, text):
+    if not text:
+        await update.message.reply_text("❌ Пожалуйста, введите номер телефона.")
+        return
+    checkout["phone_number"] = text
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=text,
-        parse_mode=ParseMode.HTML,
+    save_user_contacts(
+        user_id=update.message.from_user.id,
+        real_name=checkout.get("real_name"),
+        phone_number=text,
     )
+    await checkout_enter(context, update.message.chat_id, "type")
+
+
+async def _on_address(update, context, checkout, text):
+    if not text:
+        await update.message.reply_text("❌ Пожалуйста, введите адрес на корейском.")
+        return
+    checkout["address"] = text
+    await checkout_enter(context, update.message.chat_id, "comment")
+
+
+async def _on_comment(update, context, checkout, text):
+    if not text:
+        await update.message.reply_text("✍️ Напишите комментарий или '-'")
+        return
+    checkout["comment"] = text
+    await checkout_enter(context, update.message.chat_id, "preview")
+
+
+CHECKOUT_STEPS: dict[str, CheckoutStep] = {
+    "ask_name": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_name, _on_name),
+    "ask_phone": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_phone, _on_phone),
+    "type": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_type, None),
+    "ask_address": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_address, _on_address),
+    "comment": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_comment, _on_comment),
+    "preview": CheckoutStep(CHECKOUT_TIMEOUT_SECONDS, _prompt_preview, None),
+    # перевод денег занимает время
+    "wait_photo": CheckoutStep(CHECKOUT_PAYMENT_TIMEOUT_SECONDS, _prompt_wait_photo, None),
+    "ready_to_send": CheckoutStep(CHECKOUT_PAYMENT_TIMEOUT_SECONDS, _prompt_ready, None),
+}
+
+
+async def dispatch_checkout_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Текст покупателя во время оформления. False — оформления нет."""
+    checkout = checkout_state(context)
+    if checkout is None:
+        return False
+
+    step = CHECKOUT_STEPS[checkout["step"]]
+    if step.on_text is None:
+        # на этом шаге ждем кнопку или фото — повторяем вопрос
+        await checkout_enter(context, update.message.chat_id, checkout["step"])
+    else:
+        await step.on_text(update, context, checkout, (update.message.text or "").strip())
+    return True
 
-# -------------------------
-# чекаут
-# -------------------------
 
 async def on_checkout_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not msg.reply_to_message:
         return
+    await dispatch_checkout_text(update, context)
 
-    chat_id = msg.chat_id
-    text = (msg.text or "").strip()
-    step = context.user_data.get("checkout_step")
 
-    # --- ЭТАП 1: ИМЯ ---
-    if step == "ask_name":
-        if not text:
-            await msg.reply_text("❌ Пожалуйста, введите имя.")
-            return
+async def on_checkout_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # покупатель написал не "ответом" — принимаем как ответ на текущий шаг
+    if not update.message:
+        return
+    await dispatch_checkout_text(update, context)
+
+
+async def checkout_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    for t in context.job.data:
+        heap = t.checkout_deadlines
+        while heap and heap[0][0] <= now:
+            _deadline, user_id = heapq.heappop(heap)
+            user_data = t.app.user_data.get(user_id) if t.app else None
+            checkout = user_data.get("checkout") if user_data else None
+            # завершено, отменено или срок продлен следующим шагом
+            if not checkout or checkout["expires_at"] > now:
+                continue
+
+            user_data.pop("checkout", None)
+            try:
+                await t.app.bot.send_message(
+                    chat_id=checkout["chat_id"],
+                    text="⌛ Оформление заказа прервано из-за неактивности. Корзина сохранена.",
+                    reply_markup=kb_home(),
+                )
+            except Exception as e:
+                log.warning(f"⚠️ [{t.name}] checkout timeout notice failed: {e!r}")
 
-        checkout = context.user_data.setdefault("checkout", {})
-        checkout["real_name"] = text
-        context.user_data["checkout_step"] = "ask_phone"
+# -------------------------
+# submitted checkouts: идемпотентность отправки заказа
+# -------------------------
+# Двойное нажатие "Отправить заказ" или повторная доставка callback'а
+# (в том числе после перезапуска) не должны создавать второй заказ.
+# Ключ оформления -> {order_id, notified} в памяти магазина и в файле
+# SESSION_DIR/<магазин>/checkout_keys.<воркер>.jsonl (дописывается по строке;
+# читаются файлы всех воркеров — после смены WORKERS чат мог переехать).
+# Повтор с известным ключом отвечает исходным номером заказа, не трогая
+# Sheets; сотрудники уведомляются, только если прошлый раз до этого не дошел.
 
-        await clear_ui(context, chat_id)
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "📞 <b>Ваш номер телефона</b>\n\n"
-                "Введите номер для связи ⬇️"
-            ),
-            parse_mode=ParseMode.HTML,
-            reply_markup=ForceReply(selective=True),
-        )
-        track_msg(context, m.message_id)
-        return
+CHECKOUT_KEYS_TTL_SECONDS = 7 * 24 * 3600
+# файл ключей только дописывается — раз в час он переписывается без истекших
+CHECKOUT_KEYS_COMPACT_SECONDS = 3600
 
-    # --- ЭТАП 2: ТЕЛЕФОН ---
-    if step == "ask_phone":
-        if not text:
-            await msg.reply_text("❌ Пожалуйста, введите номер телефона.")
-            return
 
-        checkout = context.user_data.setdefault("checkout", {})
-        checkout["phone_number"] = text
+def _checkout_keys_path(t: "Tenant", worker: int | None = None) -> str:
+    worker = WORKER_INDEX if worker is None else worker
+    return os.path.join(_session_dir(t), f"checkout_keys.{worker}.jsonl")
 
-        save_user_contacts(
-            user_id=msg.from_user.id,
-            real_name=checkout.get("real_name"),
-            phone_number=text,
-        )
 
-        context.user_data["checkout_step"] = "type"
+def _read_checkout_keys(path: str, cutoff: float) -> list[dict]:
+    out = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # строка, недописанная при падении
+                if rec.get("ts", 0) >= cutoff:
+                    out.append(rec)
+    except FileNotFoundError:
+        pass
+    return out
+
+
+def submitted_checkouts(t: "Tenant") -> OrderedDict:
+    if t.submitted_checkouts is not None:
+        return t.submitted_checkouts
+
+    cutoff = time.time() - CHECKOUT_KEYS_TTL_SECONDS
+    try:
+        names = [n for n in os.listdir(_session_dir(t)) if n.startswith("checkout_keys.") and n.endswith(".jsonl")]
+    except FileNotFoundError:
+        names = []
+    recs = [rec for n in names for rec in _read_checkout_keys(os.path.join(_session_dir(t), n), cutoff)]
 
-        await clear_ui(context, chat_id)
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text="🚚 <b>Выберите способ получения:</b>",
-            parse_mode=ParseMode.HTML,
-            reply_markup=kb_checkout_pickup_delivery(),
-        )
-        track_msg(context, m.message_id)
-        return
+    records: OrderedDict[str, dict] = OrderedDict()
+    for rec in sorted(recs, key=lambda r: r["ts"]):
+        records[rec["key"]] = rec
+    t.submitted_checkouts = records
+    return records
 
-    # --- ЭТАП 2.5: АДРЕС (ТОЛЬКО ДЛЯ ДОСТАВКИ) ---
-    if step == "ask_address":
-        if not text:
-            await msg.reply_text("❌ Пожалуйста, введите адрес на корейском.")
-            return
 
-        checkout = context.user_data.setdefault("checkout", {})
-        checkout["address"] = text
+def remember_checkout(t: "Tenant", key: str, order_id: str, notified: bool):
+    records = submitted_checkouts(t)
+    rec = {"key": key, "order_id": order_id, "notified": notified, "ts": time.time()}
+    records[key] = rec
+    records.move_to_end(key)
 
-        context.user_data["checkout_step"] = "comment"
+    cutoff = rec["ts"] - CHECKOUT_KEYS_TTL_SECONDS
+    while records and next(iter(records.values()))["ts"] < cutoff:
+        records.popitem(last=False)
 
-        await clear_ui(context, chat_id)
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "✍️ Напишите комментарий к заказу.\n\n"
-                "• Например: удобное время доставки\n\n"
-                "⬇️ Ответьте на это сообщение"
-            ),
-            reply_markup=ForceReply(selective=True),
-        )
-        track_msg(context, m.message_id)
-        return
+    try:
+        os.makedirs(_session_dir(t), exist_ok=True)
+        with open(_checkout_keys_path(t), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec) + "\n")
+    except OSError as e:
+        log.warning(f"⚠️ [{t.name}] checkout key not persisted: {e!r}")
 
-    # --- ЭТАП 3: КОММЕНТАРИЙ ---
-    if step != "comment":
-        return
 
-    if not text:
-        await msg.reply_text("✍️ Напишите комментарий или '-'")
+def compact_checkout_keys(t: "Tenant"):
+    """Переписывает файл ключей этого воркера без истекших записей (по таймеру и при остановке)."""
+    path = _checkout_keys_path(t)
+    if not os.path.exists(path):
         return
+    recs = _read_checkout_keys(path, time.time() - CHECKOUT_KEYS_TTL_SECONDS)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in recs:
+                f.write(json.dumps(rec) + "\n")
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"⚠️ [{t.name}] checkout keys not compacted: {e!r}")
 
-    checkout = context.user_data.setdefault("checkout", {})
-    checkout["comment"] = text
-    context.user_data["checkout_step"] = "preview"
 
-    cart = _get_cart(context)
-    kind = checkout.get("type", "pickup")
-    kind_label = "Самовывоз" if kind == "pickup" else "Доставка"
+async def checkout_keys_job(context: ContextTypes.DEFAULT_TYPE):
+    # в event loop, как и remember_checkout, — дозапись не попадет между чтением и заменой файла
+    for t in context.job.data:
+        compact_checkout_keys(t)
 
-    preview_text = build_checkout_preview(
-        cart=cart,
-        kind_label=kind_label,
-        comment=text,
-        address=checkout.get("address"),
-    )
 
+async def _checkout_already_sent(context: ContextTypes.DEFAULT_TYPE, chat_id: int, order_id: str):
     await clear_ui(context, chat_id)
     m = await context.bot.send_message(
         chat_id=chat_id,
-        text=preview_text,
+        text=(
+            "✅ <b>Заказ уже отправлен</b>\n\n"
+            f"Номер заказа: <code>{order_id}</code>\n"
+            "Скоро свяжемся с вами 💐"
+        ),
         parse_mode=ParseMode.HTML,
-        reply_markup=kb_checkout_preview(),
+        reply_markup=kb_home(),
     )
     track_msg(context, m.message_id)
 
+
 # -------------------------
 # main router (callbacks)
 # -------------------------
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if q is None:
-        return
+# callback_data — "ns:action:arg". Обработчик ищется в таблице маршрутов
+# за O(1): сначала по "ns:action", потом по "ns" (тогда arg — всё после "ns:").
+# Обработчик: async (update, context, chat_id, arg).
+
+def route_callback(routes: dict[str, Callable], data: str) -> tuple[Callable | None, str]:
+    ns, _, rest = data.partition(":")
+    action, _, arg = rest.partition(":")
+    handler = routes.get(f"{ns}:{action}")
+    if handler is not None:
+        return handler, arg
+    return routes.get(ns), rest
+
+async def _btn_home(update, context, chat_id, arg):
+    await render_home(context, chat_id)
 
-    data = q.data or ""
-    log.info(f"CALLBACK DATA = {data}")
 
-    await q.answer()
-    chat_id = q.message.chat_id
-    nav = _get_nav(context)
+async def _btn_categories(update, context, chat_id, arg):
+    await render_categories(context, chat_id)
 
-    # ---------- NAV ----------
-    if data == "nav:home":
-        await render_home(context, chat_id)
-        return
 
-    if data in ("home:catalog", "nav:catalog", "nav:categories"):
-        await render_categories(context, chat_id)
-        return
+async def _btn_cart(update, context, chat_id, arg):
+    await render_cart(context, chat_id)
 
-    if data in ("home:cart", "nav:cart"):
-        await render_cart(context, chat_id)
-        return
 
-    if data == "home:help":
-        await render_help(context, chat_id)
-        return
+async def _btn_help(update, context, chat_id, arg):
+    await render_help(context, chat_id)
 
-    if data == "nav:back":
-        screen = nav.get("screen", "home")
-        if screen == "product":
-            last_cat = nav.get("last_category")
-            if last_cat:
-                await render_product_list(context, chat_id, last_cat)
-            else:
-                await render_categories(context, chat_id)
-        elif screen == "product_list":
-            await render_categories(context, chat_id)
+
+async def _btn_back(update, context, chat_id, arg):
+    nav = _get_nav(context)
+    screen = nav.get("screen", "home")
+    if screen == "product":
+        last_cat = nav.get("last_category")
+        if last_cat:
+            await render_product_list(context, chat_id, last_cat)
         else:
-            await render_home(context, chat_id)
-        return
+            await render_categories(context, chat_id)
+    elif screen == "product_list":
+        await render_categories(context, chat_id)
+    else:
+        await render_home(context, chat_id)
 
-    # ---------- CATEGORIES / PRODUCTS ----------
-    if data.startswith("cat:"):
-        await render_product_list(context, chat_id, data.split(":", 1)[1])
-        return
 
-    if data.startswith("prod:"):
-        await render_product_card(context, chat_id, data.split(":", 1)[1])
+async def _btn_category(update, context, chat_id, ref):
+    category = resolve_category(ref)
+    if category is None:
+        # категорию переименовали или убрали — показываем актуальный список
+        await render_categories(context, chat_id)
         return
+    await render_product_list(context, chat_id, category)
 
-    # ---------- CART ----------
-    if data.startswith("cart:inc:"):
-        pid = data.split(":")[-1]
-        cart = _get_cart(context)
-        cart[pid] = cart.get(pid, 0) + 1
-        await render_product_card(context, chat_id, pid)
-        return
 
-    if data.startswith("cart:dec:"):
-        pid = data.split(":")[-1]
-        cart = _get_cart(context)
-        if pid in cart:
-            cart[pid] -= 1
-            if cart[pid] <= 0:
-                del cart[pid]
-        await render_product_card(context, chat_id, pid)
-        return
+async def _btn_product(update, context, chat_id, ref):
+    await render_product_card(context, chat_id, resolve_product(ref))
 
-    if data == "cart:clear":
-        context.user_data["cart"] = {}
-        await render_cart(context, chat_id)
-        return
 
-    # ---------- CHECKOUT ----------
+async def _btn_cart_inc(update, context, chat_id, ref):
+    pid = resolve_product(ref)
+    p = get_product_by_id(pid)
+    if p:
+        _get_cart(context).inc(p)
+    await render_product_card(context, chat_id, pid)
 
-    if data == "checkout:final_send":
-        checkout = context.user_data.get("checkout")
-        if not checkout:
-            return
 
-        # 1) строгая проверка шага
-        if not checkout.get("payment_photo_file_id"):
-            log.warning("⛔ final_send ignored: no payment photo")
-            return
+async def _btn_cart_dec(update, context, chat_id, ref):
+    pid = resolve_product(ref)
+    _get_cart(context).dec(pid)
+    await render_product_card(context, chat_id, pid)
 
-        # 2) обязательные данные
-        payment_file_id = checkout.get("payment_photo_file_id")
-        if not payment_file_id:
-            log.warning("⛔ final_send ignored: no payment photo")
-            return
 
-        cart = _get_cart(context)
-        if not cart:
-            log.warning("⛔ final_send ignored: empty cart")
-            return
+async def _btn_cart_clear(update, context, chat_id, arg):
+    _get_cart(context).clear()
+    await render_cart(context, chat_id)
 
-        kind = checkout.get("type", "pickup")
-        kind_label = "Самовывоз" if kind == "pickup" else "Доставка"
-        comment = checkout.get("comment", "")
 
-        user = q.from_user
+async def _btn_checkout_start(update, context, chat_id, arg):
+    cart = _get_cart(context)
+    if not cart:
+        await render_cart(context, chat_id)
+        return
 
-        # 3) создаем заказ
-        order_id = save_order_to_sheets(
-            user=user,
-            cart=cart,
-            kind=kind_label,
-            comment=comment,
-            address=checkout.get("address"),
+    # каталог не загружен (Sheets недоступен, снимка на диске нет): сверять
+    # не с чем — корзину не трогаем, оформление откладываем
+    catalog = get_catalog()
+    if catalog.source == "empty":
+        await render_cart(
+            context,
+            chat_id,
+            notice="⚠️ Каталог временно недоступен, оформить заказ можно чуть позже. Корзина сохранена.",
         )
-        if not order_id:
-            await clear_ui(context, chat_id)
-            m = await context.bot.send_message(
-                chat_id=chat_id,
-                text="❗ Не удалось отправить заказ. Попробуйте еще раз.",
-                reply_markup=kb_home(),
-            )
-            track_msg(context, m.message_id)
-            return
-
-        # 4) сохраняем payment_proof + статус pending
-        service = get_sheets_service()
-        sheet = service.spreadsheets()
-
-        result = sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range="orders!A:J",
-        ).execute()
-        rows = result.get("values", [])
-
-        target_row = None
-        for idx, row in enumerate(rows, start=1):
-            if row and row[0] == order_id:
-                target_row = idx
-                break
+        return
 
-        if target_row:
-            sheet.values().batchUpdate(
-                spreadsheetId=SPREADSHEET_ID,
-                body={
-                    "valueInputOption": "RAW",
-                    "data": [
-                        {"range": f"orders!I{target_row}", "values": [[payment_file_id]]},
-                        {"range": f"orders!J{target_row}", "values": [["pending"]]},
-                    ],
-                },
-            ).execute()
-
-        # 5) уведомляем сотрудника ОДИН РАЗ
-        await notify_staff(
+    # цены зафиксированы при добавлении — сверяем с каталогом один раз, перед оформлением
+    changes = cart.revalidate(catalog)
+    if changes:
+        await render_cart(
             context,
-            order_id,
+            chat_id,
+            notice="⚠️ <b>Каталог обновился</b>\n" + "\n".join(changes),
         )
+        return
 
-        # 6) чистим state
-        context.user_data.pop("checkout", None)
-        context.user_data.pop("checkout_step", None)
-        context.user_data["cart"] = {}
+    await checkout_begin(context, chat_id, update.callback_query.from_user.id)
 
-        # 7) финал покупателю
-        await clear_ui(context, chat_id)
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "✅ <b>Заказ отправлен</b>\n\n"
-                "Мы получили оплату и передали заказ в обработку.\n"
-                "Скоро свяжемся с вами 💐"
-            ),
-            parse_mode=ParseMode.HTML,
-            reply_markup=kb_home(),
-        )
-        track_msg(context, m.message_id)
-        return
 
-    if data == "checkout:start":
-        if not _get_cart(context):
-            await render_cart(context, chat_id)
-            return
+async def _btn_checkout_cancel(update, context, chat_id, arg):
+    context.user_data.pop("checkout", None)
+    await render_cart(context, chat_id)
 
-        context.user_data["checkout"] = {}
-        context.user_data["checkout_step"] = "ask_name"
 
-        await clear_ui(context, chat_id)
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "✍️ <b>Как вас зовут?</b>\n\n"
-                "Введите ваше имя и фамилию ⬇️"
-            ),
-            parse_mode=ParseMode.HTML,
-            reply_markup=ForceReply(selective=True),
-        )
-        track_msg(context, m.message_id)
-        return
+async def _active_checkout(context, chat_id, step: str | None = None) -> dict | None:
+    """
+    Оформление, если кнопка относится к его текущему шагу. Старая кнопка
+    с другого шага не двигает оформление вперед — повторяем текущий вопрос.
+    """
+    checkout = checkout_state(context)
+    if checkout is None:
+        await checkout_expired(context, chat_id)
+        return None
+    if step is not None and checkout["step"] != step:
+        await checkout_enter(context, chat_id, checkout["step"])
+        return None
+    return checkout
 
-    if data.startswith("checkout:type:"):
-        kind = data.split(":")[-1]
 
-        checkout = context.user_data.setdefault("checkout", {})
-        checkout["type"] = kind
+async def _btn_checkout_send(update, context, chat_id, key):
+    q = update.callback_query
+    checkout = checkout_state(context)
+
+    # повтор отправки (двойное нажатие, повторная доставка) — исходный заказ
+    key = key or (checkout or {}).get("key")
+    t = current_tenant()
+    sent = submitted_checkouts(t).get(key) if key else None
+    if sent:
+        log.info(f"♻️ final_send repeated: key={key} order={sent['order_id']}")
+        if not sent["notified"]:
+            await notify_staff(context, sent["order_id"])
+            remember_checkout(t, key, sent["order_id"], notified=True)
+        if checkout and checkout.get("key") == key:
+            context.user_data.pop("checkout", None)
+        await _checkout_already_sent(context, chat_id, sent["order_id"])
+        return
 
-        await clear_ui(context, chat_id)
+    if checkout is None:
+        await checkout_expired(context, chat_id)
+        return
 
-        # 🚚 ДОСТАВКА → СПРАШИВАЕМ АДРЕС
-        if kind == "delivery":
-            context.user_data["checkout_step"] = "ask_address"
+    # строгая проверка шага
+    payment_file_id = checkout.get("payment_photo_file_id")
+    if checkout["step"] != "ready_to_send" or not payment_file_id:
+        log.warning("⛔ final_send ignored: no payment photo")
+        return
 
-            m = await context.bot.send_message(
-                chat_id=chat_id,
-                text=(
-                    "📍 <b>Укажите адрес доставки</b>\n\n"
-                    "Введите адрес <b>на корейском языке</b>.\n"
-                    "Это нужно для правильной навигации курьера ⬇️"
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=ForceReply(selective=True),
-            )
-            track_msg(context, m.message_id)
-            return
+    cart = _get_cart(context)
+    if not cart:
+        log.warning("⛔ final_send ignored: empty cart")
+        return
+
+    kind = checkout.get("type", "pickup")
+    kind_label = "Самовывоз" if kind == "pickup" else "Доставка"
+    comment = checkout.get("comment", "")
 
-        # 🚶 САМОВЫВОЗ → СРАЗУ К КОММЕНТАРИЮ
-        context.user_data["checkout_step"] = "comment"
+    user = q.from_user
 
+    # 1) создаем заказ (вне event loop: запись ждет orders_lock, пока идет архивация)
+    order_id = await asyncio.to_thread(
+        save_order_to_sheets,
+        user=user,
+        cart=cart,
+        kind=kind_label,
+        comment=comment,
+        address=checkout.get("address"),
+    )
+    if not order_id:
+        await clear_ui(context, chat_id)
         m = await context.bot.send_message(
             chat_id=chat_id,
-            text=(
-                "✍️ Напишите комментарий к заказу.\n\n"
-                "• Укажите удобное время самовывоза\n\n"
-                "⬇️ Ответьте на это сообщение"
-            ),
-            reply_markup=ForceReply(selective=True),
+            text="❗ Не удалось отправить заказ. Попробуйте еще раз.",
+            reply_markup=kb_home(),
         )
         track_msg(context, m.message_id)
         return
-    
-    if data == "checkout:attach":
-        checkout = context.user_data.get("checkout")
-        if not checkout:
-            return
 
-        await clear_ui(context, chat_id)
+    # ключ — сразу после записи: повтор уже не создаст второй заказ
+    remember_checkout(current_tenant(), checkout["key"], order_id, notified=False)
 
-        m = await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "📎 <b>Прикрепите фото оплаты</b>\n\n"
-                "Фото нужно отправить <b>ответом на это сообщение</b>.\n"
-                "Нажмите 📎 внизу экрана ⬇️"
-            ),
-            parse_mode=ParseMode.HTML,
-            reply_markup=ForceReply(selective=True),
-        )
+    # 2) сохраняем payment_proof + статус pending
+    await asyncio.to_thread(update_order_cells, order_id, {"I": payment_file_id, "J": "pending"})
 
-        context.user_data["checkout_step"] = "wait_photo"
-        checkout["photo_reply_to"] = m.message_id
-        track_msg(context, m.message_id)
+    # 3) уведомляем сотрудника ОДИН РАЗ
+    await notify_staff(
+        context,
+        order_id,
+    )
+    remember_checkout(current_tenant(), checkout["key"], order_id, notified=True)
+
+    # 4) чистим state
+    context.user_data.pop("checkout", None)
+    _get_cart(context).clear()
+
+    # 5) финал покупателю
+    await clear_ui(context, chat_id)
+    m = await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "✅ <b>Заказ отправлен</b>\n\n"
+            "Мы получили оплату и передали заказ в обработку.\n"
+            "Скоро свяжемся с вами 💐"
+        ),
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb_home(),
+    )
+    track_msg(context, m.message_id)
+
+
+async def _btn_checkout_type(update, context, chat_id, kind):
+    checkout = await _active_checkout(context, chat_id, "type")
+    if checkout is None:
         return
+    checkout["type"] = kind
+
+    # 🚚 ДОСТАВКА → СПРАШИВАЕМ АДРЕС, 🚶 САМОВЫВОЗ → СРАЗУ К КОММЕНТАРИЮ
+    await checkout_enter(context, chat_id, "ask_address" if kind == "delivery" else "comment")
+
+
+async def _btn_checkout_attach(update, context, chat_id, arg):
+    if await _active_checkout(context, chat_id, "preview") is not None:
+        await checkout_enter(context, chat_id, "wait_photo")
+
+
+BUTTON_ROUTES: dict[str, Callable] = {
+    "nav:home": _btn_home,
+    "home:catalog": _btn_categories,
+    "nav:catalog": _btn_categories,
+    "nav:categories": _btn_categories,
+    "home:cart": _btn_cart,
+    "nav:cart": _btn_cart,
+    "home:help": _btn_help,
+    "nav:back": _btn_back,
+    "cat": _btn_category,          # cat:<id категории>
+    "prod": _btn_product,          # prod:<product_ref>
+    "cart:inc": _btn_cart_inc,
+    "cart:dec": _btn_cart_dec,
+    "cart:clear": _btn_cart_clear,
+    "checkout:start": _btn_checkout_start,
+    "checkout:cancel": _btn_checkout_cancel,
+    "checkout:final_send": _btn_checkout_send,  # checkout:final_send:<ключ>
+    "checkout:type": _btn_checkout_type,
+    "checkout:attach": _btn_checkout_attach,
+}
 
 
-    if data == "checkout:cancel":
-        context.user_data.pop("checkout", None)
-        context.user_data.pop("checkout_step", None)
-        await render_cart(context, chat_id)
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q is None:
         return
 
-    
+    data = q.data or ""
+    log.info(f"CALLBACK DATA = {data}")
+
+    await q.answer()
+    handler, arg = route_callback(BUTTON_ROUTES, data)
+    if handler is not None:
+        await handler(update, context, q.message.chat_id, arg)
+
 async def on_buyer_payment_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log.info("📸 BUYER PAYMENT PHOTO HANDLER FIRED")
     msg = update.message
@@ -1220,14 +4455,11 @@ async def on_buyer_payment_photo(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     chat_id = msg.chat_id
-    if chat_id in STAFF_CHAT_IDS:
-        return
-
-    checkout = context.user_data.get("checkout")
-    if not checkout:
+    if chat_id in current_tenant().staff_chat_ids:
         return
 
-    if context.user_data.get("checkout_step") != "wait_photo":
+    checkout = checkout_state(context)
+    if not checkout or checkout["step"] != "wait_photo":
         return
 
     expected_reply_to = checkout.get("photo_reply_to")
@@ -1235,36 +4467,10 @@ async def on_buyer_payment_photo(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     # берем самое большое фото
-    file_id = msg.photo[-1].file_id
-    checkout["payment_photo_file_id"] = file_id
+    checkout["payment_photo_file_id"] = msg.photo[-1].file_id
 
     # показываем подтверждение + кнопку отправки
-    cart = _get_cart(context)
-    kind = checkout.get("type", "pickup")
-    kind_label = "Самовывоз" if kind == "pickup" else "Доставка"
-    comment = checkout.get("comment", "")
-
-    preview_text = build_checkout_preview(
-        cart=cart,
-        kind_label=kind_label,
-        comment=comment,
-        address=checkout.get("address"),
-    )
-
-    await clear_ui(context, chat_id)
-    m = await context.bot.send_message(
-        chat_id=chat_id,
-        text=(
-            "✅ <b>Фото получено</b>\n\n"
-            "Теперь вы можете отправить заказ ⬇️\n\n"
-            + preview_text
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=kb_checkout_send(),  # сделаем на следующем шаге
-    )
-    track_msg(context, m.message_id)
-
-    context.user_data["checkout_step"] = "ready_to_send"
+    await checkout_enter(context, chat_id, "ready_to_send")
 
 async def on_staff_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -1274,7 +4480,7 @@ async def on_staff_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     chat_id = q.message.chat_id
 
-    if chat_id not in STAFF_CHAT_IDS:
+    if chat_id not in current_tenant().staff_chat_ids:
         return
 
     data = q.data or ""
@@ -1287,35 +4493,14 @@ async def on_staff_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.warning(f"⚠️ invalid callback data: {data}")
         return
 
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
-
-    # --- читаем заказы ---
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="orders!A:N",  # ⬅️ до reaction_seconds
-    ).execute()
-
-    rows = result.get("values", [])
-    if len(rows) < 2:
-        log.warning("⚠️ orders sheet empty")
-        return
-
-    data_rows = rows[1:]
-
-    target_row = None
-    target_index = None
-
-    for idx, row in enumerate(data_rows, start=2):
-        if row and row[0] == order_id:
-            target_row = row
-            target_index = idx
-            break
-
-    if not target_row:
+    # --- читаем заказ ---
+    found = find_order(order_id)
+    if not found:
         log.warning(f"⚠️ order {order_id} not found")
         return
 
+    _target_index, target_row = found
+
     current_status = target_row[9] if len(target_row) > 9 else ""
     if current_status != "pending":
         log.info(
@@ -1351,30 +4536,12 @@ async def on_staff_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reaction_seconds = ""
 
     # --- batch update ---
-    sheet.values().batchUpdate(
-        spreadsheetId=SPREADSHEET_ID,
-        body={
-            "valueInputOption": "RAW",
-            "data": [
-                {
-                    "range": f"orders!J{target_index}",
-                    "values": [[new_status]],
-                },
-                {
-                    "range": f"orders!K{target_index}",
-                    "values": [[handled_at.isoformat()]],
-                },
-                {
-                    "range": f"orders!L{target_index}",
-                    "values": [[str(chat_id)]],
-                },
-                {
-                    "range": f"orders!M{target_index}",
-                    "values": [[reaction_seconds]],
-                },
-            ],
-        },
-    ).execute()
+    await asyncio.to_thread(update_order_cells, order_id, {
+        "J": new_status,
+        "K": handled_at.isoformat(),
+        "L": str(chat_id),
+        "M": reaction_seconds,
+    })
 
     log.info(
         f"🧾 order {target_row[0]} {new_status} "
@@ -1401,115 +4568,196 @@ async def on_staff_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.warning(f"edit_message_caption failed: {e}")
 
 
-async def on_catalog_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if not q or not q.message:
+async def _catalog_back(update, context, chat_id, arg):
+    await render_catalog_categories(context, chat_id)
+
+
+async def _catalog_category(update, context, chat_id, ref):
+    category = resolve_category(ref)
+    if category is None:
+        await render_catalog_categories(context, chat_id)
         return
+    await render_catalog_products(context, chat_id, category)
 
-    await q.answer()
 
-    chat_id = q.message.chat_id
-    data = q.data or ""
+async def _catalog_bulk(update, context, chat_id, op):
+    await on_catalog_bulk(context, chat_id, op)
 
-    if chat_id not in STAFF_CHAT_IDS:
-        return
 
-    # --- NAV внутри staff-каталога ---
-    if data == "catalog:back":
-        await render_catalog_categories(context, chat_id)
+async def _catalog_bulk_apply(update, context, chat_id, arg):
+    plan = context.user_data.pop("catalog_bulk", None)
+    if not plan:
+        await context.bot.send_message(chat_id=chat_id, text="Нет действия для применения.")
         return
+    changes = plan["changes"]
+    applied = await apply_bulk_changes([(pid, field, new) for pid, field, _old, new in changes])
+    context.user_data["catalog_undo"] = {
+        "label": plan["label"],
+        "changes": [(pid, field, old) for pid, field, old, _new in changes],
+    }
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"✅ {plan['label']}: изменено товаров {applied}.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("↩️ Отменить", callback_data="catalog:bulk_undo:0")]
+        ]),
+    )
+    current_cat = context.user_data.get("catalog_category")
+    if current_cat:
+        await render_catalog_products(context, chat_id, current_cat)
 
-    if data.startswith("catalog:cat:"):
-        category = data.split(":", 2)[2]
-        await render_catalog_products(context, chat_id, category)
-        return
 
-    # --- действия по товару / добавление ---
-    parts = data.split(":")
-    if len(parts) < 3:
+async def _catalog_bulk_undo(update, context, chat_id, arg):
+    undo = context.user_data.pop("catalog_undo", None)
+    if not undo:
+        await context.bot.send_message(chat_id=chat_id, text="Отменять нечего.")
         return
+    restored = await apply_bulk_changes(undo["changes"])
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"↩️ Отменено «{undo['label']}»: восстановлено товаров {restored}.",
+    )
+    current_cat = context.user_data.get("catalog_category")
+    if current_cat:
+        await render_catalog_products(context, chat_id, current_cat)
 
-    action = parts[1]
-    product_id = parts[2]
 
-    if action == "add":
-        context.user_data["waiting_add_name"] = True
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="➕ Добавление товара\n\nВведите название товара:",
-        )
-        return
+async def _catalog_bulk_cancel(update, context, chat_id, arg):
+    context.user_data.pop("catalog_bulk", None)
+    await context.bot.send_message(chat_id=chat_id, text="Действие отменено.")
 
-    if action == "desc":
-        context.user_data["waiting_desc_for"] = product_id
-        await context.bot.send_message(chat_id=chat_id, text="📝 Введите описание товара:")
-        return
 
-    if action == "price":
-        context.user_data["waiting_price_for"] = product_id
-        await context.bot.send_message(chat_id=chat_id, text="✏️ Введите новую цену (только число, в вонах):")
-        return
+async def _catalog_export(update, context, chat_id, arg):
+    fmt = "json" if arg == "json" else "csv"
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=export_catalog(fmt),
+        filename=f"catalog-{datetime.utcnow():%Y%m%d}.{fmt}",
+        caption="📤 Каталог. Исправьте и пришлите файл обратно для импорта.",
+    )
 
-    if action == "photo":
-        set_waiting_photo(context, product_id)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "📷 Отправьте фото для товара.\n\n"
-                "Можно отправить одно фото.\n"
-                "Оно будет привязано к позиции."
-            ),
-        )
-        return
 
-    if action == "toggle":
-        products = read_products_from_sheets()
-        product = next((p for p in products if p["product_id"] == product_id), None)
-        if not product:
-            return
-        set_product_available(product_id, not product["available"])
-        # остаемся в той же категории, если она сохранена
-        current_cat = context.user_data.get("catalog_category")
-        if current_cat:
-            await render_catalog_products(context, chat_id, current_cat)
-        else:
-            await catalog_cmd(update, context)
-        return
+async def _catalog_import(update, context, chat_id, arg):
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "📥 Пришлите файл .csv или .json с колонками:\n"
+            f"{', '.join(CATALOG_COLUMNS)}\n\n"
+            "Пустой product_id — новый товар. Перед записью покажу сводку изменений."
+        ),
+    )
 
-# 1️⃣ ЕСЛИ ЭТО ФОТО — НИЧЕГО НЕ ПЕРЕКЛЮЧАЕМ
-    if action == "photo":
-        set_waiting_photo(context, product_id)
 
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=(
-                "📷 Отправьте фото для товара.\n\n"
-                "Можно отправить одно фото.\n"
-                "Оно будет привязано к позиции."
-            ),
-        )
+async def _catalog_import_apply(update, context, chat_id, arg):
+    upserts = context.user_data.pop("catalog_import", None)
+    if not upserts:
+        await context.bot.send_message(chat_id=chat_id, text="Нет импорта для применения.")
+        return
+    try:
+        updated, added = await asyncio.to_thread(apply_catalog_import, upserts)
+    except Exception:
+        log.exception("❌ catalog import failed")
+        await context.bot.send_message(chat_id=chat_id, text="❌ Не удалось записать в Google Sheets.")
         return
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"✅ Импорт применен: обновлено {updated}, добавлено {added}.",
+    )
+    await catalog_cmd(update, context)
+
+
+async def _catalog_import_cancel(update, context, chat_id, arg):
+    context.user_data.pop("catalog_import", None)
+    await context.bot.send_message(chat_id=chat_id, text="Импорт отменен.")
+
+
+async def _catalog_add(update, context, chat_id, arg):
+    context.user_data["waiting_add_name"] = True
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="➕ Добавление товара\n\nВведите название товара:",
+    )
 
-    # 2️⃣ ИНАЧЕ — это toggle
-    if action == "toggle":
-        set_product_available(product_id, not product["available"])
+
+async def _catalog_desc(update, context, chat_id, ref):
+    product_id = resolve_product(ref)
+    context.user_data["waiting_desc_for"] = product_id
+    await context.bot.send_message(chat_id=chat_id, text="📝 Введите описание товара:")
+
+
+async def _catalog_price(update, context, chat_id, ref):
+    product_id = resolve_product(ref)
+    context.user_data["waiting_price_for"] = product_id
+    await context.bot.send_message(chat_id=chat_id, text="✏️ Введите новую цену (только число, в вонах):")
+
+
+async def _catalog_photo(update, context, chat_id, ref):
+    product_id = resolve_product(ref)
+    set_waiting_photo(context, product_id)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "📷 Отправьте фото для товара.\n\n"
+            "Можно отправить одно фото.\n"
+            "Оно будет привязано к позиции."
+        ),
+    )
+
+
+async def _catalog_toggle(update, context, chat_id, ref):
+    product_id = resolve_product(ref)
+    products = get_products()
+    product = next((p for p in products if p["product_id"] == product_id), None)
+    if not product:
+        return
+    set_product_available(product_id, not product["available"])
+    # остаемся в той же категории, если она сохранена
+    current_cat = context.user_data.get("catalog_category")
+    if current_cat:
+        await render_catalog_products(context, chat_id, current_cat)
+    else:
         await catalog_cmd(update, context)
+
+
+CATALOG_ROUTES: dict[str, Callable] = {
+    "catalog:back": _catalog_back,
+    "catalog:cat": _catalog_category,          # catalog:cat:<id категории>
+    "catalog:bulk": _catalog_bulk,
+    "catalog:bulk_apply": _catalog_bulk_apply,
+    "catalog:bulk_undo": _catalog_bulk_undo,
+    "catalog:bulk_cancel": _catalog_bulk_cancel,
+    "catalog:export": _catalog_export,
+    "catalog:import": _catalog_import,
+    "catalog:import_apply": _catalog_import_apply,
+    "catalog:import_cancel": _catalog_import_cancel,
+    "catalog:add": _catalog_add,
+    "catalog:desc": _catalog_desc,
+    "catalog:price": _catalog_price,
+    "catalog:photo": _catalog_photo,
+    "catalog:toggle": _catalog_toggle,
+}
+
+
+async def on_catalog_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not q or not q.message:
         return
 
-SHOP_NAME = "Цветочный бутик"
-SHOP_PHONE = "010-1234-5678"
-SHOP_NOTE = "Свежие цветы. Индивидуальная упаковка."
+    await q.answer()
+
+    chat_id = q.message.chat_id
+    if chat_id not in current_tenant().staff_chat_ids:
+        return
 
+    handler, arg = route_callback(CATALOG_ROUTES, q.data or "")
+    if handler is not None:
+        await handler(update, context, chat_id, arg)
 
-# -------------------------
-# checkout conversation
-# -------------------------
-CHECKOUT_TYPE, CHECKOUT_COMMENT, CHECKOUT_CONFIRM = range(3)
 
 async def on_staff_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
-    if chat_id not in STAFF_CHAT_IDS:
+    if chat_id not in current_tenant().staff_chat_ids:
         return
 
     product_id = pop_waiting_photo(context)
@@ -1540,7 +4788,7 @@ async def on_staff_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def on_staff_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id not in STAFF_CHAT_IDS:
+    if chat_id not in current_tenant().staff_chat_ids:
         return
 
     text = (update.message.text or "").strip()
@@ -1645,234 +4893,627 @@ async def on_staff_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await catalog_cmd(update, context)
         return
 
-async def on_staff_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
+async def on_staff_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id not in current_tenant().staff_chat_ids:
+        return
+
+    product_id = pop_waiting_price(context)
+    if not product_id:
+        return
+
+    text = (update.message.text or "").strip()
+    if not text.isdigit():
+        await update.message.reply_text("❌ Цена должна быть числом. Попробуйте еще раз.")
+        context.user_data["waiting_price_for"] = product_id
+        return
+
+    price = int(text)
+    if price <= 0:
+        await update.message.reply_text("❌ Цена должна быть больше нуля.")
+        context.user_data["waiting_price_for"] = product_id
+        return
+
+    set_product_price(product_id, price)
+
+    await update.message.reply_text("✅ Цена обновлена.")
+    await catalog_cmd(update, context)
+
+async def on_staff_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    if chat_id not in current_tenant().staff_chat_ids:
+        return
+
+    product_id = pop_waiting_desc(context)
+    if not product_id:
+        return
+
+    text = (update.message.text or "").strip()
+    if not text:
+        await update.message.reply_text("❌ Описание не может быть пустым.")
+        context.user_data["waiting_desc_for"] = product_id
+        return
+
+    set_product_description(product_id, text)
+
+    await update.message.reply_text("✅ Описание сохранено.")
+    await catalog_cmd(update, context)
+
+
+
+# -------------------------
+# main/helpers
+# -------------------------
+
+def load_user_registry(rows: list[list[str]] | None = None):
+    if rows is None:
+        rows = sheets_read("users!A2:A")
+    current_tenant().known_users = {row[0] for row in rows if row}
+
+def register_user_if_new(user):
+    with current_tenant().users_lock:
+        return _register_user_locked(user)
+
+def _register_user_locked(user):
+    t = current_tenant()
+    if t.known_users is None:
+        load_user_registry()
+
+    if str(user.id) in t.known_users:
+        return False
+    # мог зарегистрировать другой воркер
+    replica = replica_ready(t)
+    if replica is not None and replica.find("users", str(user.id)):
+        t.known_users.add(str(user.id))
+        return False
+
+    sheets_append("users!A:D", [[
+        str(user.id),
+        user.username or "",
+        user.full_name or "",
+        datetime.utcnow().isoformat(),
+    ]])
+    t.known_users.add(str(user.id))
+
+    return True
+
+_sheets_lock = threading.Lock()
+_sheets_local = threading.local()
+_sheets_discovery: dict | None = None
+_sheets_creds = None
+
+def _sheets_bootstrap():
+    """Тяжелые импорты + discovery-документ + credentials — один раз на процесс."""
+    global _sheets_discovery, _sheets_creds
+    with _sheets_lock:
+        if _sheets_discovery is not None:
+            return
+        from google.oauth2.service_account import Credentials
+        from googleapiclient.discovery_cache import get_static_doc
+
+        _sheets_creds = Credentials.from_service_account_info(
+            GOOGLE_CREDS_INFO,
+            scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        )
+        _sheets_discovery = json.loads(get_static_doc("sheets", "v4"))
+
+def get_sheets_service():
+    # httplib2 не потокобезопасен — отдельный клиент на поток,
+    # discovery-документ и токен общие
+    service = getattr(_sheets_local, "service", None)
+    if service is None:
+        _sheets_bootstrap()
+        from googleapiclient.discovery import build_from_document
+
+        service = build_from_document(_sheets_discovery, credentials=_sheets_creds)
+        _sheets_local.service = service
+    return service
+
+
+
+def set_waiting_photo(context: ContextTypes.DEFAULT_TYPE, product_id: str):
+    context.user_data["waiting_photo_for"] = product_id
+
+# -------------------------
+# catalog import / export
+# -------------------------
+# Сотрудник выгружает каталог файлом (CSV или JSON), правит его и присылает
+# обратно документом. Файл проверяется целиком, показывается сводка изменений,
+# а применение — это одно чтение id + один batchUpdate + один append,
+# сколько бы товаров ни менялось.
+#
+# Колонки — как в листе products. Пустой product_id — новый товар.
+# Колонки, которых нет в файле, у существующих товаров не меняются.
+# Товары, которых нет в файле, остаются как есть (скрыть — available=FALSE).
+
+CATALOG_COLUMNS = ("product_id", "name", "price", "available", "category", "photo_file_id", "description")
+CATALOG_IMPORT_MAX_BYTES = 1_000_000
+
+_TRUE_WORDS = {"true", "1", "yes", "y", "да", "+"}
+_FALSE_WORDS = {"false", "0", "no", "n", "нет", "-"}
+
+
+class CatalogImportError(ValueError):
+    def __init__(self, errors: list[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def product_to_row(p: dict) -> list:
+    return [
+        p["product_id"],
+        p["name"],
+        int(p["price"]),
+        "TRUE" if p["available"] else "FALSE",
+        p["category"],
+        p.get("photo_file_id") or "",
+        p.get("description") or "",
+    ]
 
-    if chat_id not in STAFF_CHAT_IDS:
-        return
 
-    product_id = pop_waiting_price(context)
-    if not product_id:
-        return
+def export_catalog(fmt: str) -> bytes:
+    products = get_catalog().products
+    if fmt == "json":
+        return json.dumps({"products": products}, ensure_ascii=False, indent=2).encode("utf-8")
 
-    text = (update.message.text or "").strip()
-    if not text.isdigit():
-        await update.message.reply_text("❌ Цена должна быть числом. Попробуйте еще раз.")
-        context.user_data["waiting_price_for"] = product_id
-        return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CATALOG_COLUMNS)
+    for p in products:
+        writer.writerow(product_to_row(p))
+    # BOM — чтобы Excel открыл кириллицу без танцев
+    return buf.getvalue().encode("utf-8-sig")
 
-    price = int(text)
-    if price <= 0:
-        await update.message.reply_text("❌ Цена должна быть больше нуля.")
-        context.user_data["waiting_price_for"] = product_id
-        return
 
-    set_product_price(product_id, price)
+def _read_import_records(data: bytes, fmt: str) -> list[dict]:
+    text = data.decode("utf-8-sig")
+    if fmt == "json":
+        payload = json.loads(text)
+        records = payload.get("products") if isinstance(payload, dict) else payload
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise CatalogImportError(["JSON: ожидается список товаров или {\"products\": [...]}"])
+        return records
 
-    await update.message.reply_text("✅ Цена обновлена.")
-    await catalog_cmd(update, context)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.DictReader(io.StringIO(text), dialect=dialect))
+
+
+def _parse_price(value) -> int | None:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    digits = re.sub(r"[\s,₩]", "", str(value or ""))
+    return int(digits) if digits.isdigit() else None
+
+
+def _parse_available(value) -> bool | None:
+    if isinstance(value, bool):
+        return value
+    word = str(value or "").strip().lower()
+    if word in _TRUE_WORDS:
+        return True
+    if word in _FALSE_WORDS:
+        return False
+    return None
 
-async def checkout_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    q = update.callback_query
-    await q.answer()
-    chat_id = q.message.chat_id
 
-    cart = _get_cart(context)
-    if not cart:
-        await render_cart(context, chat_id)
-        return ConversationHandler.END
+def parse_catalog_import(data: bytes, fmt: str, known_ids: set[str] | None = None) -> list[dict]:
+    """
+    Проверяет файл целиком. Возвращает список частичных записей
+    {колонка: значение} (только колонки, которые есть в файле).
+    known_ids — product_id листа: строка с другим id — новый товар,
+    для нее нужны все обязательные поля.
+    При любой ошибке — CatalogImportError со списком строк.
+    """
+    try:
+        records = _read_import_records(data, fmt)
+    except (UnicodeDecodeError, json.JSONDecodeError, csv.Error) as e:
+        raise CatalogImportError([f"файл не читается: {e}"])
+
+    errors: list[str] = []
+    out: list[dict] = []
+    seen: set[str] = set()
+
+    for line, rec in enumerate(records, start=2 if fmt == "csv" else 1):
+        rec = {
+            (k or "").strip().lower(): (v.strip() if isinstance(v, str) else v)
+            for k, v in rec.items()
+            if (k or "").strip().lower() in CATALOG_COLUMNS
+        }
+        if not any(v not in (None, "") for v in rec.values()):
+            continue
 
-    context.user_data["checkout"] = {}
+        item: dict = {}
+        pid = str(rec.get("product_id") or "").strip()
+        if pid:
+            if pid in seen:
+                errors.append(f"{line}: product_id {pid} повторяется")
+            seen.add(pid)
+        item["product_id"] = pid
+        new = not pid or (known_ids is not None and pid not in known_ids)
+        what = f"нового товара {pid}" if pid else "нового товара"
+
+        for key in ("name", "category"):
+            if key in rec:
+                if not rec[key]:
+                    errors.append(f"{line}: пустое поле {key}")
+                item[key] = str(rec[key] or "")
+            elif new:
+                errors.append(f"{line}: для {what} нужно поле {key}")
+
+        if "price" in rec:
+            price = _parse_price(rec["price"])
+            if not price or price <= 0:
+                errors.append(f"{line}: цена {rec['price']!r} — нужно целое число больше нуля")
+            item["price"] = price
+        elif new:
+            errors.append(f"{line}: для {what} нужна цена")
+
+        if "available" in rec and rec["available"] not in (None, ""):
+            available = _parse_available(rec["available"])
+            if available is None:
+                errors.append(f"{line}: available {rec['available']!r} — нужно TRUE/FALSE")
+            item["available"] = available
+
+        for key in ("photo_file_id", "description"):
+            if key in rec:
+                item[key] = str(rec[key] or "")
+
+        out.append(item)
+
+    if not out and not errors:
+        errors.append("в файле нет товаров")
+    if errors:
+        raise CatalogImportError(errors)
+    return out
+
+
+def plan_catalog_import(items: list[dict], current: list[dict]) -> dict:
+    """
+    Сравнивает файл с текущим каталогом.
+    plan = {"upserts": [полный товар, ...], "new": n, "changed": n,
+            "unchanged": n, "untouched": n, "notes": [строки для сводки]}
+    """
+    by_id = {p["product_id"]: p for p in current}
+    upserts: list[dict] = []
+    notes: list[str] = []
+    new = changed = unchanged = 0
+
+    for item in items:
+        base = by_id.get(item["product_id"])
+        if base is None:
+            product = {
+                "product_id": item["product_id"] or f"P{uuid4().hex[:10]}",
+                "name": item["name"],
+                "price": item["price"],
+                "available": item.get("available", True),
+                "category": item["category"],
+                "photo_file_id": item.get("photo_file_id", ""),
+                "description": item.get("description", ""),
+            }
+            upserts.append(product)
+            new += 1
+            notes.append(f"➕ {product['name']} — {_fmt_money(product['price'])}")
+            continue
 
-    await clear_ui(context, chat_id)
-    m = await context.bot.send_message(
-        chat_id=chat_id,
-        text="✅ <b>Оформление заказа</b>\n\nВыберите способ получения:",
-        parse_mode=ParseMode.HTML,
-        reply_markup=kb_checkout_pickup_delivery(),
-    )
-    track_msg(context, m.message_id)
-    return CHECKOUT_TYPE
+        product = dict(base)
+        product.update({k: v for k, v in item.items() if v is not None})
+        if product_to_row(product) == product_to_row(base):
+            unchanged += 1
+            continue
 
+        upserts.append(product)
+        changed += 1
+        diff = []
+        if product["price"] != base["price"]:
+            diff.append(f"{_fmt_money(base['price'])} → {_fmt_money(product['price'])}")
+        if product["available"] != base["available"]:
+            diff.append("показан" if product["available"] else "скрыт")
+        if product["category"] != base["category"]:
+            diff.append(f"→ {product['category']}")
+        if product["name"] != base["name"]:
+            diff.append(f"было «{base['name']}»")
+        notes.append(f"✏️ {product['name']}: {', '.join(diff) or 'фото/описание'}")
+
+    touched = {i["product_id"] for i in items}
+    return {
+        "upserts": upserts,
+        "new": new,
+        "changed": changed,
+        "unchanged": unchanged,
+        "untouched": sum(1 for pid in by_id if pid not in touched),
+        "notes": notes,
+    }
+
+
+def apply_catalog_import(upserts: list[dict]) -> tuple[int, int]:
+    """
+    Номера строк определяются заново в момент применения — если лист
+    поменяли руками после предпросмотра, запись все равно попадет куда надо.
+    """
+    # сначала отложенные правки по ячейкам, чтобы они не перетерли импорт
+    flush_product_writes()
 
+    ids = sheets_read("products!A2:A")
+    row_of = {row[0]: idx for idx, row in enumerate(ids, start=2) if row}
 
+    updates = [
+        {"range": f"products!A{row_of[p['product_id']]}:G{row_of[p['product_id']]}", "values": [product_to_row(p)]}
+        for p in upserts
+        if p["product_id"] in row_of
+    ]
+    appends = [product_to_row(p) for p in upserts if p["product_id"] not in row_of]
 
-async def on_staff_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
+    if updates:
+        sheets_batch_update(updates)
+    if appends:
+        sheets_append("products!A:G", appends)
+    invalidate_catalog()
 
-    if chat_id not in STAFF_CHAT_IDS:
-        return
+    return len(updates), len(appends)
 
-    product_id = pop_waiting_desc(context)
-    if not product_id:
-        return
 
-    text = (update.message.text or "").strip()
-    if not text:
-        await update.message.reply_text("❌ Описание не может быть пустым.")
-        context.user_data["waiting_desc_for"] = product_id
-        return
+def import_summary(plan: dict) -> str:
+    lines = [
+        "📥 <b>Импорт каталога</b>\n",
+        f"Новых: {plan['new']}",
+        f"Изменится: {plan['changed']}",
+        f"Без изменений: {plan['unchanged']}",
+        f"Нет в файле (не трогаем): {plan['untouched']}",
+    ]
+    if plan["notes"]:
+        lines.append("")
+        lines.extend(plan["notes"][:15])
+        if len(plan["notes"]) > 15:
+            lines.append(f"… и еще {len(plan['notes']) - 15}")
+    return "\n".join(lines)
 
-    set_product_description(product_id, text)
 
-    await update.message.reply_text("✅ Описание сохранено.")
-    await catalog_cmd(update, context)
+async def on_staff_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not msg.document:
+        return
 
+    chat_id = msg.chat_id
+    if chat_id not in current_tenant().staff_chat_ids:
+        return
 
+    doc = msg.document
+    fmt = "json" if (doc.file_name or "").lower().endswith(".json") else "csv"
+    if doc.file_size and doc.file_size > CATALOG_IMPORT_MAX_BYTES:
+        await msg.reply_text("❌ Файл слишком большой (максимум 1 МБ).")
+        return
 
-# -------------------------
-# main/helpers
-# -------------------------
+    tg_file = await context.bot.get_file(doc.file_id)
+    data = bytes(await tg_file.download_as_bytearray())
 
-def set_product_description(product_id: str, description: str):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
+    # сравниваем со свежим листом, а не с кэшем
+    current = await asyncio.to_thread(read_products_from_sheets)
+    try:
+        items = parse_catalog_import(data, fmt, {p["product_id"] for p in current})
+    except CatalogImportError as e:
+        shown = "\n".join(f"• {err}" for err in e.errors[:10])
+        more = f"\n… и еще {len(e.errors) - 10}" if len(e.errors) > 10 else ""
+        await msg.reply_text(f"❌ Файл не принят, ничего не изменено:\n{shown}{more}")
+        return
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="products!A2:A",
-    ).execute()
+    plan = plan_catalog_import(items, current)
 
-    rows = result.get("values", [])
-    row_index = None
+    if not plan["upserts"]:
+        await msg.reply_text("✅ Каталог уже совпадает с файлом.")
+        return
 
-    for idx, row in enumerate(rows, start=2):
-        if row and row[0] == product_id:
-            row_index = idx
-            break
+    context.user_data["catalog_import"] = plan["upserts"]
+    await msg.reply_text(
+        import_summary(plan),
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb_catalog_import(),
+    )
 
-    if row_index is None:
-        return False
 
-    sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"products!G{row_index}",
-        valueInputOption="RAW",
-        body={"values": [[description]]},
-    ).execute()
+# -------------------------
+# catalog bulk actions
+# -------------------------
+# Действия над всей категорией из render_catalog_products: скрыть/показать
+# все, изменить цены (в процентах или на сумму), перенести в другую категорию.
+# Сначала предпросмотр, потом одна пачка правок (см. product writes),
+# прежние значения сохраняются для одной отмены.
 
-    return True
+BULK_PRICE_STEPS = ("pct+5", "pct+10", "pct+20", "pct-10", "pct-20", "krw+1000", "krw+5000", "krw-1000")
+BULK_PREVIEW_LINES = 15
 
-def register_user_if_new(user):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="users!A2:A",
-    ).execute()
+def _bulk_price(price: int, step: str) -> int:
+    kind, amount = step[:3], int(step[3:])
+    if kind == "pct":
+        # воны — округляем до 100
+        new = round(price * (100 + amount) / 100 / 100) * 100
+    else:
+        new = price + amount
+    return max(100, int(new))
 
-    rows = result.get("values", [])
-    existing_ids = {row[0] for row in rows if row}
 
-    if str(user.id) in existing_ids:
-        return False
+def _bulk_step_label(step: str) -> str:
+    amount = int(step[3:])
+    if step.startswith("pct"):
+        return f"{amount:+d}%"
+    return f"{'+' if amount > 0 else '−'}{_fmt_money(abs(amount))}"
 
-    sheet.values().append(
-        spreadsheetId=SPREADSHEET_ID,
-        range="users!A:D",
-        valueInputOption="RAW",
-        body={
-            "values": [[
-                str(user.id),
-                user.username or "",
-                user.full_name or "",
-                datetime.utcnow().isoformat(),
-            ]]
-        },
-    ).execute()
 
-    return True
+def plan_bulk_action(products: list[dict], op: str, arg: str = "") -> tuple[str, list[tuple[str, str, object, object]]]:
+    """
+    Возвращает (описание, [(product_id, поле, было, станет), ...]).
+    Товары, которые уже в нужном состоянии, в план не попадают.
+    """
+    changes: list[tuple[str, str, object, object]] = []
+
+    if op in ("hide", "show"):
+        target = op == "show"
+        label = "Показать все" if target else "Скрыть все"
+        for p in products:
+            if p["available"] != target:
+                changes.append((p["product_id"], "available", p["available"], target))
+
+    elif op == "price":
+        label = f"Цены {_bulk_step_label(arg)}"
+        for p in products:
+            new = _bulk_price(p["price"], arg)
+            if new != p["price"]:
+                changes.append((p["product_id"], "price", p["price"], new))
+
+    elif op == "move":
+        label = f"Перенести в «{arg}»"
+        for p in products:
+            if p["category"] != arg:
+                changes.append((p["product_id"], "category", p["category"], arg))
 
-def get_sheets_service():
-    creds = Credentials.from_service_account_info(
-        GOOGLE_CREDS_INFO,
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    return build("sheets", "v4", credentials=creds)
+    else:
+        raise ValueError(f"unknown bulk op: {op}")
 
+    return label, changes
 
 
-def set_waiting_photo(context: ContextTypes.DEFAULT_TYPE, product_id: str):
-    context.user_data["waiting_photo_for"] = product_id
+def bulk_preview_text(category: str, label: str, changes: list, products: list[dict]) -> str:
+    names = {p["product_id"]: p["name"] for p in products}
+    lines = [f"🛠 <b>{category}</b>: {label}\n", f"Изменится товаров: {len(changes)} из {len(products)}\n"]
+    for pid, field, old, new in changes[:BULK_PREVIEW_LINES]:
+        if field == "price":
+            lines.append(f"• {names[pid]}: {_fmt_money(old)} → {_fmt_money(new)}")
+        elif field == "available":
+            lines.append(f"• {names[pid]}: {'показан' if new else 'скрыт'}")
+        else:
+            lines.append(f"• {names[pid]}")
+    if len(changes) > BULK_PREVIEW_LINES:
+        lines.append(f"… и еще {len(changes) - BULK_PREVIEW_LINES}")
+    return "\n".join(lines)
 
-def set_product_available(product_id: str, available: bool):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="products!A2:A",
-    ).execute()
+def kb_catalog_bulk() -> list[list[InlineKeyboardButton]]:
+    return [
+        [
+            InlineKeyboardButton("🙈 Скрыть все", callback_data="catalog:bulk:hide"),
+            InlineKeyboardButton("👁 Показать все", callback_data="catalog:bulk:show"),
+        ],
+        [
+            InlineKeyboardButton("💲 Цены", callback_data="catalog:bulk:price"),
+            InlineKeyboardButton("📂 Перенести", callback_data="catalog:bulk:move"),
+        ],
+    ]
 
-    rows = result.get("values", [])
-    row_index = None
 
-    for idx, row in enumerate(rows, start=2):
-        if row and row[0] == product_id:
-            row_index = idx
-            break
+def kb_bulk_confirm() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Применить", callback_data="catalog:bulk_apply:0"),
+            InlineKeyboardButton("✖️ Отмена", callback_data="catalog:bulk_cancel:0"),
+        ]
+    ])
 
-    if row_index is None:
-        return False
 
-    sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"products!D{row_index}",
-        valueInputOption="RAW",
-        body={"values": [["TRUE" if available else "FALSE"]]},
-    ).execute()
+async def on_catalog_bulk(context: ContextTypes.DEFAULT_TYPE, chat_id: int, op: str):
+    category = context.user_data.get("catalog_category")
+    if not category:
+        await render_catalog_categories(context, chat_id)
+        return
 
-    return True
+    products = [p for p in get_products() if p.get("category") == category]
 
-def set_product_photo(product_id: str, file_id: str):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
+    # меню выбора параметра
+    if op == "price":
+        rows = [
+            [InlineKeyboardButton(_bulk_step_label(st), callback_data=f"catalog:bulk:{st}") for st in BULK_PRICE_STEPS[i:i + 4]]
+            for i in range(0, len(BULK_PRICE_STEPS), 4)
+        ]
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"💲 Как изменить цены в «{category}»?",
+            reply_markup=InlineKeyboardMarkup(rows),
+        )
+        return
 
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="products!A2:A",
-    ).execute()
+    if op == "move":
+        targets = sorted({p["category"] for p in get_products() if p.get("category")} - {category})
+        if not targets:
+            await context.bot.send_message(chat_id=chat_id, text="Других категорий нет.")
+            return
+        rows = [
+            [InlineKeyboardButton(cat, callback_data=f"catalog:bulk:to{category_ref(cat)}")]
+            for cat in targets
+        ]
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"📂 Куда перенести все товары из «{category}»?",
+            reply_markup=InlineKeyboardMarkup(rows),
+        )
+        return
 
-    rows = result.get("values", [])
-    row_index = None
+    if op.startswith("to"):
+        target = resolve_category(op[2:])
+        if not target or target == category:
+            return
+        label, changes = plan_bulk_action(products, "move", target)
+    elif op in BULK_PRICE_STEPS:
+        label, changes = plan_bulk_action(products, "price", op)
+    elif op in ("hide", "show"):
+        label, changes = plan_bulk_action(products, op)
+    else:
+        return
 
-    for idx, row in enumerate(rows, start=2):
-        if row and row[0] == product_id:
-            row_index = idx
-            break
+    if not changes:
+        await context.bot.send_message(chat_id=chat_id, text="Нечего менять: все товары уже в этом состоянии.")
+        return
 
-    if row_index is None:
-        return False
+    context.user_data["catalog_bulk"] = {"label": label, "changes": changes}
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=bulk_preview_text(category, label, changes, products),
+        parse_mode=ParseMode.HTML,
+        reply_markup=kb_bulk_confirm(),
+    )
 
-    sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"products!F{row_index}",  # ВОТ ТУТ F
-        valueInputOption="RAW",
-        body={"values": [[file_id]]},
-    ).execute()
 
-    return True
+async def apply_bulk_changes(changes: list[tuple[str, str, object]]) -> int:
+    accepted = queue_product_writes(changes)
+    # одна пачка сразу, не дожидаясь таймера
+    await asyncio.to_thread(flush_product_writes, current_tenant())
+    return accepted
 
 
 def kb_catalog_item(product_id: str, available: bool) -> InlineKeyboardMarkup:
     label = "🙈 Скрыть" if available else "👁 Показать"
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton(label, callback_data=f"catalog:toggle:{product_id}"),
-            InlineKeyboardButton("✏️ Цена", callback_data=f"catalog:price:{product_id}"),
-            InlineKeyboardButton("📝 Описание", callback_data=f"catalog:desc:{product_id}"),
-            InlineKeyboardButton("🖼 Фото", callback_data=f"catalog:photo:{product_id}"),
+            InlineKeyboardButton(label, callback_data=f"catalog:toggle:{product_ref(product_id)}"),
+            InlineKeyboardButton("✏️ Цена", callback_data=f"catalog:price:{product_ref(product_id)}"),
+            InlineKeyboardButton("📝 Описание", callback_data=f"catalog:desc:{product_ref(product_id)}"),
+            InlineKeyboardButton("🖼 Фото", callback_data=f"catalog:photo:{product_ref(product_id)}"),
         ]
     ])
 
 def kb_catalog_controls() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Добавить товар", callback_data="catalog:add:0")]
+        [InlineKeyboardButton("➕ Добавить товар", callback_data="catalog:add:0")],
+        [
+            InlineKeyboardButton("📤 CSV", callback_data="catalog:export:csv"),
+            InlineKeyboardButton("📤 JSON", callback_data="catalog:export:json"),
+            InlineKeyboardButton("📥 Загрузить", callback_data="catalog:import:0"),
+        ],
+    ])
+
+def kb_catalog_import() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Применить", callback_data="catalog:import_apply:0"),
+            InlineKeyboardButton("✖️ Отмена", callback_data="catalog:import_cancel:0"),
+        ]
     ])
 
 async def render_catalog_categories(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    products = read_products_from_sheets()
+    products = get_products()
     categories = sorted({
         p["category"] for p in products if p.get("category")
     })
@@ -1888,7 +5529,7 @@ async def render_catalog_categories(context: ContextTypes.DEFAULT_TYPE, chat_id:
         return
 
     rows = [
-        [InlineKeyboardButton(cat, callback_data=f"catalog:cat:{cat}")]
+        [InlineKeyboardButton(cat, callback_data=f"catalog:cat:{category_ref(cat)}")]
         for cat in categories
     ]
 
@@ -1904,10 +5545,10 @@ async def render_catalog_categories(context: ContextTypes.DEFAULT_TYPE, chat_id:
 async def catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
-    if chat_id not in STAFF_CHAT_IDS:
+    if chat_id not in current_tenant().staff_chat_ids:
         return
 
-    products = read_products_from_sheets()
+    products = get_products()
     categories = sorted({
         p["category"]
         for p in products
@@ -1938,7 +5579,7 @@ async def catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=f"📦 <b>{cat}</b>",
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Открыть", callback_data=f"catalog:cat:{cat}")]
+                [InlineKeyboardButton("Открыть", callback_data=f"catalog:cat:{category_ref(cat)}")]
             ]),
         )
         track_msg(context, msg.message_id)
@@ -1950,7 +5591,7 @@ async def render_catalog_products(
     category: str,
 ):
     products = [
-        p for p in read_products_from_sheets()
+        p for p in get_products()
         if p.get("category") == category
     ]
     context.user_data["catalog_category"] = category
@@ -1960,9 +5601,10 @@ async def render_catalog_products(
         chat_id=chat_id,
         text=f"🛠 <b>{category}</b>",
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Категории", callback_data="catalog:back")]
-        ]),
+        reply_markup=InlineKeyboardMarkup(
+            (kb_catalog_bulk() if products else [])
+            + [[InlineKeyboardButton("⬅️ Категории", callback_data="catalog:back")]]
+        ),
     )
     track_msg(context, header.message_id)
 
@@ -1993,29 +5635,59 @@ async def render_catalog_products(
         )
         track_msg(context, m.message_id)
 
-async def notify_staff(context: ContextTypes.DEFAULT_TYPE, order_id: str):
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
-
-    # --- читаем заказы ---
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="orders!A:N",
-    ).execute()
+def read_order_for_staff(order_id: str) -> tuple[list, str, str] | None:
+    """
+    Строка заказа + имя и телефон покупателя — одним batchGet:
+    строка заказа по индексу и из users только колонки id и контактов.
+    """
+    t = current_tenant()
+    replica = replica_ready(t)
+    if replica is not None:
+        found = replica.find("orders", order_id)
+        if found:
+            row = found[1]
+            user = replica.find("users", row[2] if len(row) > 2 else "")
+            u = user[1] if user else []
+            return row, (u[4] if len(u) > 4 else ""), (u[5] if len(u) > 5 else "")
+
+    row_index = t.orders_index.rows.get(order_id)
+    if row_index is None:
+        index_orders()
+        row_index = t.orders_index.rows.get(order_id)
+    if row_index is None:
+        return None
 
-    rows = result.get("values", [])
-    if len(rows) < 2:
-        return
+    plan = ReadPlan()
+    order = plan.add(f"orders!A{row_index}:N{row_index}", lambda rows: rows[0] if rows else [])
+    ids = plan.add("users!A:A")
+    contacts = plan.add("users!E:F")
+    plan.run()
+
+    row = plan[order]
+    if not row or row[0] != order_id:
+        # строки сдвинули руками — обычный путь с перестройкой индекса
+        found = find_order(order_id)
+        if not found:
+            return None
+        row = found[1]
+
+    buyer_chat_id = row[2] if len(row) > 2 else ""
+    for idx, u in enumerate(plan[ids]):
+        if u and u[0] == buyer_chat_id:
+            c = plan[contacts][idx] if idx < len(plan[contacts]) else []
+            c = c + [""] * (2 - len(c))
+            return row, c[0], c[1]
+    return row, "", ""
 
-    target = None
-    for row in rows[1:]:
-        if row and row[0] == order_id:
-            target = row
-            break
 
-    if not target:
+async def notify_staff(context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    # --- читаем заказ и контакты покупателя ---
+    found = await asyncio.to_thread(read_order_for_staff, order_id)
+    if not found:
         return
 
+    target, buyer_name, buyer_phone = found
+
     (
         _order_id,        # A
         created_at,       # B
@@ -2036,21 +5708,6 @@ async def notify_staff(context: ContextTypes.DEFAULT_TYPE, order_id: str):
     if status != "pending":
         return
 
-    # --- вытаскиваем имя / телефон из users ---
-    buyer_name = ""
-    buyer_phone = ""
-
-    users = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="users!A:F",
-    ).execute().get("values", [])
-
-    for u in users:
-        if u and u[0] == buyer_chat_id:
-            buyer_name = u[4] if len(u) > 4 else ""
-            buyer_phone = u[5] if len(u) > 5 else ""
-            break
-
     address_block = (
         f"\n📍 <b>Адрес:</b>\n<code>{address}</code>\n"
         if address else ""
@@ -2068,7 +5725,7 @@ async def notify_staff(context: ContextTypes.DEFAULT_TYPE, order_id: str):
         f"💬 Комментарий: <b>{comment or '—'}</b>"
     )
 
-    for staff_id in STAFF_CHAT_IDS:
+    for staff_id in current_tenant().staff_chat_ids:
         try:
             await context.bot.send_photo(
                 chat_id=staff_id,
@@ -2083,18 +5740,18 @@ async def notify_staff(context: ContextTypes.DEFAULT_TYPE, order_id: str):
 
 
 async def on_text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("checkout_step"):
+    if checkout_state(context):
         return  # ❗ не мешаем checkout FSM
 
     if not update.message:
         return
 
     chat_id = update.effective_chat.id
-    if chat_id in STAFF_CHAT_IDS:
+    if chat_id in current_tenant().staff_chat_ids:
         await on_staff_text(update, context)
 
 def build_checkout_preview(
-    cart: dict,
+    cart: Cart,
     kind_label: str,
     comment: str,
     address: str | None = None,
@@ -2113,10 +5770,160 @@ def build_checkout_preview(
         "Чтобы отправить заказ, прикрепите фото оплаты ⬇️"
     )
 
-def main():
-    
-    
-    app = Application.builder().token(BOT_TOKEN).build()
+# -------------------------
+# startup: снимок каталога с диска + прогрев
+# -------------------------
+def warm_up_sheets() -> dict[str, Exception]:
+    """
+    Все стартовые чтения — один batchGet; каждый шаг разбирает свой диапазон.
+    Лидер сначала заливает локальную копию таблицы — тогда шаги читают из нее.
+    Возвращает {шаг: ошибка} для шагов, которые не удались.
+    """
+    failed: dict[str, Exception] = {}
+    if is_leader():
+        try:
+            sync_replica()
+        except Exception as e:
+            failed["replica"] = e
+
+    steps = {
+        "catalog": ("products!A2:G", refresh_catalog),
+        "users": ("users!A2:A", load_user_registry),
+        "orders index": ("orders!A:B", index_orders),
+    }
+    if is_leader():
+        steps["orders header"] = ("orders!O1", ensure_orders_header)
+
+    plan = ReadPlan()
+    handles = {name: plan.add(range_) for name, (range_, _fn) in steps.items()}
+    plan.run()
+
+    for name, (_range, fn) in steps.items():
+        try:
+            fn(rows=plan[handles[name]])
+        except Exception as e:
+            failed[name] = e
+    return failed
+
+async def warm_up(app: Application):
+    t0 = time.perf_counter()
+    try:
+        failed = await asyncio.to_thread(warm_up_sheets)
+    except Exception as e:
+        # шаги, которые не прогрелись, дочитают лениво при первом обращении
+        failed = {"sheets": e}
+    for name, error in failed.items():
+        log.warning(f"⚠️ [{current_tenant().name}] warm-up {name} failed: {error!r}")
+
+    log.info(f"🔥 [{current_tenant().name}] warm-up done in {time.perf_counter() - t0:.2f}s")
+
+async def post_shutdown(app: Application):
+    # отложенные правки товаров не должны потеряться при остановке
+    t: Tenant = app.bot_data["tenant"]
+    try:
+        await asyncio.to_thread(flush_product_writes, t)
+    except Exception as e:
+        log.warning(f"⚠️ [{t.name}] product writes lost on shutdown: {e!r}")
+    # корзины и черновики переживают перезапуск
+    evict_idle_sessions(t, idle_seconds=-1)
+    compact_checkout_keys(t)
+
+async def post_init(app: Application):
+    t: Tenant = app.bot_data["tenant"]
+    with use_tenant(t):
+        # каталог с диска — сразу, чтобы покупатели видели витрину до ответа Sheets
+        load_catalog_snapshot()
+        # остальное — в фоне, не задерживая старт polling
+        # (post_init вызывается до app.start(), поэтому обычная asyncio-задача;
+        # она наследует текущий магазин из contextvars)
+        t.warm_up_task = asyncio.get_running_loop().create_task(warm_up(app))
+
+def build_application(
+    tenant: Tenant | None = None,
+    request: BaseRequest | None = None,
+    shared_request: BaseRequest | None = None,
+    scheduler_for: list[Tenant] | None = None,
+    polling: bool = True,
+) -> Application:
+    """
+    tenant          — магазин этого бота (по умолчанию первый)
+    request         — локальный заменитель Bot API, включая getUpdates (loadgen.py)
+    shared_request  — общий пул соединений к Bot API для ботов нескольких магазинов
+    scheduler_for   — магазины, фоновые задачи которых ведет JobQueue этого бота
+                      (по умолчанию только свой; [] — бот без JobQueue)
+    polling         — False для воркера: апдейты приносит роутер (см. sharding)
+    """
+    t = tenant or TENANTS[0]
+    jobs_for = [t] if scheduler_for is None else scheduler_for
+
+    builder = (
+        Application.builder()
+        .token(t.bot_token)
+        .concurrent_updates(AccountingUpdateProcessor(1, t))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .request(CountingRequest(request or shared_request or HTTPXRequest(connection_pool_size=256)))
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if not jobs_for:
+        builder = builder.job_queue(None)
+    if not polling:
+        builder = builder.updater(None)
+
+    app = builder.build()
+    app.bot_data["tenant"] = t
+    t.bot = app.bot
+    t.app = app
+
+    if not jobs_for:
+        pass
+    elif app.job_queue is not None:
+        sync_every = CATALOG_SYNC_SECONDS if is_leader() else CATALOG_FOLLOW_SECONDS
+        app.job_queue.run_repeating(
+            catalog_sync_job,
+            interval=sync_every,
+            first=sync_every,
+            name="catalog_sync",
+            data=jobs_for,
+        )
+        for jt in jobs_for:
+            jt.catalog_sync_active = True
+        app.job_queue.run_daily(
+            orders_archive_job,
+            time=dtime(hour=ORDERS_ARCHIVE_HOUR_UTC, tzinfo=timezone.utc),
+            name="orders_archive",
+            data=jobs_for,
+        )
+        app.job_queue.run_daily(
+            owner_report_job,
+            time=dtime(hour=REPORT_HOUR_UTC, tzinfo=timezone.utc),
+            name="owner_report",
+            data=jobs_for,
+        )
+        app.job_queue.run_repeating(
+            checkout_sweep_job,
+            interval=CHECKOUT_SWEEP_SECONDS,
+            first=CHECKOUT_SWEEP_SECONDS,
+            name="checkout_sweep",
+            data=jobs_for,
+        )
+        app.job_queue.run_repeating(
+            session_sweep_job,
+            interval=SESSION_SWEEP_SECONDS,
+            first=SESSION_SWEEP_SECONDS,
+            name="session_sweep",
+            data=jobs_for,
+        )
+        app.job_queue.run_repeating(
+            checkout_keys_job,
+            interval=CHECKOUT_KEYS_COMPACT_SECONDS,
+            first=CHECKOUT_KEYS_COMPACT_SECONDS,
+            name="checkout_keys_compact",
+            data=jobs_for,
+        )
+    else:
+        log.warning("JobQueue unavailable (pip install python-telegram-bot[job-queue]), catalog uses TTL refresh")
     # -------- COMMANDS --------
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("restart", restart_cmd))
@@ -2124,13 +5931,19 @@ def main():
     app.add_handler(CommandHandler("help", help_cmd))  # ← ВОТ ЭТОГО НЕ ХВАТАЛО
     app.add_handler(CommandHandler("catalog", catalog_cmd))
     app.add_handler(CommandHandler("dash", dash_cmd))
+    app.add_handler(CommandHandler("apistats", apistats_cmd))
+    app.add_handler(CommandHandler("sessions", sessions_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
+    app.add_handler(CommandHandler("archive", archive_cmd))
+    app.add_handler(CommandHandler("search", search_cmd))
+    app.add_handler(InlineQueryHandler(on_inline_query))
 
     # -------- CALLBACKS (ВСЕ КНОПКИ) --------
     
     app.add_handler(
         MessageHandler(
             (filters.PHOTO | filters.Document.IMAGE)
-            & ~filters.Chat(STAFF_CHAT_IDS),
+            & ~filters.Chat(t.staff_chat_ids),
             on_buyer_payment_photo
         )
     )
@@ -2167,29 +5980,231 @@ def main():
         )
     )
 
+    app.add_handler(
+        MessageHandler(
+            filters.TEXT & ~filters.REPLY & ~filters.COMMAND & ~filters.Chat(t.staff_chat_ids),
+            on_checkout_text
+        )
+    )
+
     # -------- STAFF --------
     app.add_handler(
         MessageHandler(
-            filters.PHOTO & filters.Chat(STAFF_CHAT_IDS),
+            filters.PHOTO & filters.Chat(t.staff_chat_ids),
             on_staff_photo
         )
     )
+
+    app.add_handler(
+        MessageHandler(
+            (filters.Document.FileExtension("csv") | filters.Document.FileExtension("json"))
+            & filters.Chat(t.staff_chat_ids),
+            on_staff_document
+        )
+    )
     
 # -------- BUYER PHOTO (payment proof) --------
-    
+
+    return app
+
+async def run_tenants():
+    """
+    Все магазины в одном event loop: общий пул HTTP-соединений к Bot API,
+    одна JobQueue (у первого бота) на фоновые задачи всех магазинов.
+    """
+    shared = HTTPXRequest(connection_pool_size=256)
+    apps = [
+        build_application(t, shared_request=shared, scheduler_for=TENANTS if i == 0 else [])
+        for i, t in enumerate(TENANTS)
+    ]
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    for app in apps:
+        await app.initialize()
+        await app.post_init(app)
+        await app.updater.start_polling(
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True,
+        )
+        await app.start()
+        log.info(f"Bot started: {app.bot_data['tenant'].name}")
+
+    try:
+        await stop.wait()
+    finally:
+        for app in reversed(apps):
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
+            # run_polling вызывает его сам; здесь приложения запущены вручную
+            await app.post_shutdown(app)
+
+# -------------------------
+# sharding: несколько процессов-воркеров
+# -------------------------
+# WORKERS=N: главный процесс только забирает апдейты (getUpdates всех ботов)
+# и раскладывает их по воркерам по chat_id. Все состояние диалога
+# (user_data / chat_data) лежит в памяти воркера, которому принадлежит чат,
+# поэтому один чат всегда обслуживает один и тот же процесс.
+# Общее состояние между воркерами: Google Sheets (заказы, пользователи)
+# и снимок каталога на диске. Воркер 0 — лидер: только он синхронизирует
+# каталог с Sheets и выполняет одиночные задачи (заголовок листа заказов).
+
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+
+def is_leader() -> bool:
+    return WORKER_INDEX == 0
+
+def shard_for(update: Update, count: int) -> int:
+    chat = update.effective_chat
+    user = update.effective_user
+    key = chat.id if chat else (user.id if user else 0)
+    return key % count
+
+async def serve_shard(queue, request: BaseRequest | None = None):
+    """
+    Цикл воркера: апдейты из очереди роутера -> Application.update_queue.
+    Элемент очереди — (имя магазина, update.to_dict()); None — остановка.
+    """
+    shared = request or HTTPXRequest(connection_pool_size=64)
+    apps = {
+        t.name: build_application(
+            t,
+            shared_request=shared,
+            scheduler_for=TENANTS if i == 0 else [],
+            polling=False,
+        )
+        for i, t in enumerate(TENANTS)
+    }
+
+    # SIGTERM (остановка дино / kill) — тот же чистый выход, что и None от роутера
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass
+
+    for app in apps.values():
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+    log.info(f"👷 worker {WORKER_INDEX}/{WORKER_COUNT} ready{' (leader)' if is_leader() else ''}")
+
+    try:
+        while not stop.is_set():
+            # с таймаутом: поток с queue.get не должен пережить остановку
+            item = await asyncio.to_thread(_queue_get, queue, 1.0)
+            if item is False:
+                continue
+            if item is None:
+                break
+            name, data = item
+            app = apps[name]
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        for app in apps.values():
+            await app.stop()
+            await app.shutdown()
+            # отложенные правки товаров, сессии, ключи оформлений
+            await app.post_shutdown(app)
+
+def _queue_get(queue, timeout: float):
+    # False — за timeout ничего не пришло
+    try:
+        return queue.get(timeout=timeout)
+    except Empty:
+        return False
+
+def run_worker(index: int, count: int, queue):
+    global WORKER_INDEX, WORKER_COUNT
+    WORKER_INDEX, WORKER_COUNT = index, count
+    # Ctrl+C получает вся группа процессов; воркер останавливает роутер
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(queue))
+
+async def route_updates(queues: list):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    async def poll(t: Tenant):
+        bot = Bot(t.bot_token, get_updates_request=HTTPXRequest(read_timeout=40))
+        async with bot:
+            await bot.delete_webhook(drop_pending_updates=True)
+            offset = None
+            while not stop.is_set():
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset,
+                        timeout=30,
+                        allowed_updates=ALLOWED_UPDATES,
+                    )
+                except Exception as e:
+                    log.warning(f"⚠️ [{t.name}] getUpdates failed: {e!r}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    queues[shard_for(update, len(queues))].put((t.name, update.to_dict()))
+
+    pollers = [asyncio.create_task(poll(t)) for t in TENANTS]
+    log.info(f"🔀 router started: {len(TENANTS)} bot(s) -> {len(queues)} workers")
+    await stop.wait()
+    for task in pollers:
+        task.cancel()
+    await asyncio.gather(*pollers, return_exceptions=True)
+
+def run_sharded(count: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(count)]
+    workers = [
+        ctx.Process(target=run_worker, args=(i, count, queues[i]), name=f"worker-{i}")
+        for i in range(count)
+    ]
+    for w in workers:
+        w.start()
+
+    try:
+        asyncio.run(route_updates(queues))
+    finally:
+        for q in queues:
+            q.put(None)
+        for w in workers:
+            w.join(timeout=30)
+
+def main():
+    if WORKERS > 1:
+        run_sharded(WORKERS)
+        return
+
+    if len(TENANTS) > 1:
+        asyncio.run(run_tenants())
+        return
+
+    app = build_application()
+
     log.info("Bot started")
     app.run_polling(
-        allowed_updates=[
-            "message",
-            "callback_query",
-        ],
+        allowed_updates=ALLOWED_UPDATES,
         drop_pending_updates=True,
     )
 
 def get_product_by_id(pid: str) -> dict | None:
-    for p in read_products_from_sheets():
-        if p["product_id"] == pid and p["available"]:
-            return p
+    p = get_catalog().by_id.get(pid)
+    if p and p["available"]:
+        return p
     return None
 
 def get_categories_from_products(products: list[dict]) -> list[str]:
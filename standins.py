@@ -0,0 +1,381 @@
+# standins.py — локальные заменители Google Sheets и Telegram Bot API
+#
+# Используются нагрузочным генератором (loadgen.py) и бенчмарками:
+#   - FakeSheetsService повторяет цепочку service.spreadsheets().values().get(...).execute()
+#   - FakeTelegramRequest подключается в Application.builder().request(...)
+#     и отвечает на методы Bot API без сети
+#
+# Задержки сети имитируются параметрами latency (в секундах).
+
+import asyncio
+import json
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+
+# -------------------------
+# Google Sheets
+# -------------------------
+_A1_RE = re.compile(r"^([A-Z]+)?(\d+)?$")
+
+
+def _col_index(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - ord("A") + 1)
+    return n - 1
+
+
+def _col_letters(index: int) -> str:
+    index += 1
+    out = ""
+    while index:
+        index, rem = divmod(index - 1, 26)
+        out = chr(ord("A") + rem) + out
+    return out
+
+
+def parse_a1(rng: str) -> Tuple[str, int, Optional[int], Optional[int], Optional[int]]:
+    """
+    "orders!A2:N" -> ("orders", col0, row0, col1, row1)
+    Строки 0-based, None = без ограничения.
+    """
+    sheet, _, cells = rng.partition("!")
+    if not cells:
+        return sheet, 0, 0, None, None
+
+    start, _, end = cells.partition(":")
+    m1 = _A1_RE.match(start)
+    m2 = _A1_RE.match(end or start)
+    if not m1 or not m2:
+        raise ValueError(f"bad range: {rng}")
+
+    c0 = _col_index(m1.group(1)) if m1.group(1) else 0
+    r0 = int(m1.group(2)) - 1 if m1.group(2) else 0
+    c1 = _col_index(m2.group(1)) if m2.group(1) else None
+    r1 = int(m2.group(2)) - 1 if m2.group(2) else None
+    return sheet, c0, r0, c1, r1
+
+
+def _cell_str(v) -> str:
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    return "" if v is None else str(v)
+
+
+class FakeSpreadsheet:
+    """
+    Таблица в памяти: {sheet_name: [[cell, ...], ...]}, первая строка — заголовок.
+    Потокобезопасна, считает вызовы.
+    """
+
+    def __init__(self, sheets: Dict[str, List[list]], latency: float = 0.0):
+        self.sheets = {name: [list(r) for r in rows] for name, rows in sheets.items()}
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _tick(self, kind: str):
+        # задержка "сети" — вне блокировки, как у параллельных HTTP-запросов
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def _rows(self, sheet: str) -> List[list]:
+        return self.sheets.setdefault(sheet, [])
+
+    def read(self, rng: str) -> List[List[str]]:
+        sheet, c0, r0, c1, r1 = parse_a1(rng)
+        rows = self._rows(sheet)
+        stop = len(rows) if r1 is None else min(r1 + 1, len(rows))
+
+        out: List[List[str]] = []
+        for row in rows[r0:stop]:
+            cells = row[c0:] if c1 is None else row[c0:c1 + 1]
+            cells = [_cell_str(v) for v in cells]
+            while cells and cells[-1] == "":
+                cells.pop()
+            out.append(cells)
+
+        # Sheets обрезает пустые строки в конце
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def write(self, rng: str, values: List[list]):
+        sheet, c0, r0, _c1, _r1 = parse_a1(rng)
+        rows = self._rows(sheet)
+        for i, src in enumerate(values):
+            r = r0 + i
+            while len(rows) <= r:
+                rows.append([])
+            row = rows[r]
+            for j, v in enumerate(src):
+                c = c0 + j
+                while len(row) <= c:
+                    row.append("")
+                row[c] = v
+
+    def append(self, rng: str, values: List[list]) -> str:
+        sheet, c0, _r0, _c1, _r1 = parse_a1(rng)
+        rows = self._rows(sheet)
+        last = len(rows)
+        while last > 0 and not any(_cell_str(v) for v in rows[last - 1]):
+            last -= 1
+        del rows[last:]
+
+        first = len(rows)
+        for src in values:
+            rows.append([""] * c0 + list(src))
+        width = max((len(v) for v in values), default=1)
+        return (
+            f"{sheet}!{_col_letters(c0)}{first + 1}:"
+            f"{_col_letters(c0 + width - 1)}{first + len(values)}"
+        )
+
+
+class _Call:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self, num_retries: int = 0):
+        return self._fn()
+
+
+class _FakeValues:
+    def __init__(self, book: FakeSpreadsheet):
+        self._book = book
+
+    def get(self, spreadsheetId: str, range: str, **_kw):
+        def run():
+            self._book._tick("values.get")
+            with self._book._lock:
+                values = self._book.read(range)
+            out = {"range": range, "majorDimension": "ROWS"}
+            if values:
+                out["values"] = values
+            return out
+        return _Call(run)
+
+    def batchGet(self, spreadsheetId: str, ranges: List[str], **_kw):
+        def run():
+            self._book._tick("values.batchGet")
+            value_ranges = []
+            with self._book._lock:
+                for rng in ranges:
+                    out = {"range": rng, "majorDimension": "ROWS"}
+                    values = self._book.read(rng)
+                    if values:
+                        out["values"] = values
+                    value_ranges.append(out)
+            return {"spreadsheetId": spreadsheetId, "valueRanges": value_ranges}
+        return _Call(run)
+
+    def update(self, spreadsheetId: str, range: str, body: dict, **_kw):
+        def run():
+            self._book._tick("values.update")
+            with self._book._lock:
+                self._book.write(range, body.get("values", []))
+            return {"updatedRange": range}
+        return _Call(run)
+
+    def append(self, spreadsheetId: str, range: str, body: dict, **_kw):
+        def run():
+            self._book._tick("values.append")
+            with self._book._lock:
+                updated = self._book.append(range, body.get("values", []))
+            return {"updates": {"updatedRange": updated}}
+        return _Call(run)
+
+    def batchUpdate(self, spreadsheetId: str, body: dict, **_kw):
+        def run():
+            self._book._tick("values.batchUpdate")
+            with self._book._lock:
+                for item in body.get("data", []):
+                    self._book.write(item["range"], item.get("values", []))
+            return {"totalUpdatedCells": len(body.get("data", []))}
+        return _Call(run)
+
+
+class _FakeSpreadsheets:
+    def __init__(self, book: FakeSpreadsheet):
+        self._book = book
+        self._values = _FakeValues(book)
+
+    def values(self):
+        return self._values
+
+    def batchUpdate(self, spreadsheetId: str, body: dict, **_kw):
+        # поддерживается только addSheet
+        def run():
+            self._book._tick("spreadsheets.batchUpdate")
+            with self._book._lock:
+                for req in body.get("requests", []):
+                    title = req["addSheet"]["properties"]["title"]
+                    if title in self._book.sheets:
+                        raise ValueError(f'A sheet with the name "{title}" already exists.')
+                    self._book.sheets[title] = []
+            return {"replies": [{} for _ in body.get("requests", [])]}
+        return _Call(run)
+
+
+class FakeSheetsService:
+    """Заменитель googleapiclient.discovery.build("sheets", "v4", ...)."""
+
+    def __init__(self, book: FakeSpreadsheet):
+        self.book = book
+        self._spreadsheets = _FakeSpreadsheets(book)
+
+    def spreadsheets(self):
+        return self._spreadsheets
+
+
+def demo_spreadsheet(products: int = 40, categories: int = 5, latency: float = 0.0) -> FakeSpreadsheet:
+    header_products = ["product_id", "name", "price", "available", "category", "photo_file_id", "description"]
+    header_orders = [
+        "order_id", "created_at", "user_id", "username", "items", "total_price", "type",
+        "comment", "payment_proof", "status", "handled_at", "handled_by", "reaction_seconds", "address",
+        "items_json",
+    ]
+    header_users = ["user_id", "username", "full_name", "registered_at", "real_name", "phone"]
+
+    rows = [header_products]
+    for i in range(products):
+        rows.append([
+            f"P{i:04d}",
+            f"Букет {i}",
+            str(10000 + 500 * i),
+            "TRUE",
+            f"Категория {i % categories}",
+            f"photo-{i}" if i % 3 else "",
+            f"Описание букета {i}",
+        ])
+
+    return FakeSpreadsheet(
+        {"products": rows, "orders": [header_orders], "users": [header_users]},
+        latency=latency,
+    )
+
+
+# -------------------------
+# Telegram Bot API
+# -------------------------
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "FlowerShopKR",
+    "username": "flowershopkr_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Отвечает на запросы Bot API из памяти. Запоминает последнее сообщение
+    бота в каждом чате (нужно сценариям, которые отвечают через ForceReply).
+    Содержимое "загруженных" документов кладется в files[file_id].
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.last_message: Dict[int, dict] = {}
+        self.sent: Dict[int, List[dict]] = {}
+        self.files: Dict[str, bytes] = {}
+        self._next_id = 1
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        return None
+
+    async def shutdown(self) -> None:
+        return None
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = int(params["chat_id"])
+        msg = {
+            "message_id": self._next_id,
+            "date": int(datetime.utcnow().timestamp()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        self._next_id += 1
+        msg.update(extra)
+        self.last_message[chat_id] = msg
+        self.sent.setdefault(chat_id, []).append(msg)
+        return msg
+
+    def _photo(self, file_id) -> list:
+        return [{
+            "file_id": str(file_id),
+            "file_unique_id": str(file_id)[:16],
+            "width": 800,
+            "height": 800,
+        }]
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self._message(
+                params,
+                photo=self._photo(params.get("photo")),
+                caption=params.get("caption", ""),
+            )
+        if method == "sendMediaGroup":
+            media = params.get("media") or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [
+                self._message(params, photo=self._photo(m.get("media")), caption=m.get("caption", ""))
+                for m in media
+            ]
+        if method == "sendDocument":
+            return self._message(
+                params,
+                document={"file_id": f"doc-{self._next_id}", "file_unique_id": f"doc-{self._next_id}"},
+                caption=params.get("caption", ""),
+            )
+        if method == "getFile":
+            file_id = str(params["file_id"])
+            return {"file_id": file_id, "file_unique_id": file_id[:16], "file_path": file_id}
+        if method in ("editMessageCaption", "editMessageText"):
+            return self._message(params, caption=params.get("caption", ""), text=params.get("text", ""))
+        return True
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        if "/file/bot" in url:
+            # скачивание файла по file_path
+            return 200, self.files.get(api_method, b"")
+
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        payload = {"ok": True, "result": self._result(api_method, params)}
+        return 200, json.dumps(payload).encode("utf-8")
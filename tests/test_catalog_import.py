@@ -0,0 +1,57 @@
+# Импорт каталога (parse_catalog_import / plan_catalog_import) без Sheets и Telegram.
+#   python -m pytest -q tests
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py требует ENV при импорте — заглушки как в loadgen.py
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+os.environ.setdefault("OWNER_CHAT_ID", "1")
+os.environ.setdefault("GOOGLE_CREDENTIALS_JSON", "{}")
+os.environ.setdefault("SPREADSHEET_ID", "test")
+os.environ.setdefault("CATALOG_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "flowershop_test_catalog.json"))
+os.environ.setdefault("SESSION_DIR", os.path.join(tempfile.gettempdir(), "flowershop_test_sessions"))
+os.environ.setdefault("REPLICA_PATH", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CURRENT = [
+    {
+        "product_id": "P1",
+        "name": "Розы красные",
+        "price": 50000,
+        "available": True,
+        "category": "Розы",
+        "photo_file_id": "",
+        "description": "",
+    },
+]
+KNOWN = {p["product_id"] for p in CURRENT}
+
+
+def test_unknown_id_without_required_fields_is_a_line_error():
+    with pytest.raises(main.CatalogImportError) as e:
+        main.parse_catalog_import(b"product_id,price\nPdeleted,5000\n", "csv", KNOWN)
+    assert any(err.startswith("2:") and "name" in err for err in e.value.errors)
+    assert any("category" in err for err in e.value.errors)
+
+
+def test_unknown_id_with_required_fields_is_a_new_product():
+    data = "product_id,name,price,category\nP9,Пионы,70000,Пионы\n".encode("utf-8")
+    items = main.parse_catalog_import(data, "csv", KNOWN)
+    plan = main.plan_catalog_import(items, CURRENT)
+    assert plan["new"] == 1
+    assert plan["upserts"][0]["product_id"] == "P9"
+
+
+def test_known_id_may_update_a_single_column():
+    items = main.parse_catalog_import(b"product_id,price\nP1,55000\n", "csv", KNOWN)
+    plan = main.plan_catalog_import(items, CURRENT)
+    assert plan["changed"] == 1
+    assert plan["upserts"][0]["price"] == 55000